@@ -0,0 +1,135 @@
+import os
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from schema import SCALE
+from common import COLUMNS, VALUE_COLUMNS
+
+# numpy dtype names, numpy itself is only imported when a day is written or loaded.
+# The sensor columns are archived as they are stored, integer tenths, which fit int16 exactly.
+DTYPES = ('int64', 'int16', 'int16', 'int16', 'int16')
+# int16 value archived for a NULL sensor value
+NULL_VALUE = -32768
+
+##### ArchiveDay class holding one station's expiring records of one local day, as read from websocket_data.
+##### end is the ts the records were read up to, the next midnight or the retention cutoff if that comes first.
+class ArchiveDay:
+
+    def __init__(self, station_id, day, end, columns):
+        self.station_id = station_id
+        self.day = day
+        self.end = end
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['ts'])
+
+##### DailyArchive class to write expiring records to compressed, columnar per-day .npz files before retention deletes them.
+##### Files are laid out as archive_dir/station_id/YYYY-MM-DD.npz, one array per column.
+##### The RetentionEngine reads one day at a time with read_day() and hands it to write(), which writes and fsyncs the file
+##### on the archive's own thread, so file I/O never holds the write lock. The day's records are only deleted once write() succeeded.
+class DailyArchive:
+
+    def __init__(self, archive_dir, logger):
+        self.archive_dir = archive_dir
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='DailyArchive')
+
+    def read_day(self, cursor, station_id, before_ts):
+        # Read the station's records of the oldest local day with ts below before_ts, None when there are none
+        import numpy as np
+        cursor.execute('SELECT MIN(ts) FROM websocket_data WHERE station_id = ? AND ts < ?', (station_id, before_ts))
+        first_ts = cursor.fetchone()[0]
+        if first_ts is None:
+            return None
+        day = dt.date.fromtimestamp(first_ts)
+        end = min(before_ts, int(dt.datetime.combine(day + dt.timedelta(days=1), dt.time()).timestamp()))
+
+        # the stored integer tenths are read as they are, NULL values become NULL_VALUE
+        values = ', '.join(f'IFNULL({column}, {NULL_VALUE})' for column in VALUE_COLUMNS)
+        cursor.execute(f'SELECT ts, {values} FROM websocket_data WHERE station_id = ? AND ts < ? ORDER BY ts', (station_id, end))
+        block = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, len(COLUMNS))
+        return ArchiveDay(station_id, day, end, to_columns(block))
+
+    def write(self, archive_day, done):
+        # Write archive_day on the archive's thread, then call done(archive_day, ok) there
+        def task():
+            try:
+                self.write_day(archive_day.station_id, archive_day.day, archive_day.columns)
+                ok = True
+            except Exception as err:
+                # e.g. an unwritable directory, a full disk or a corrupt existing file, the records stay in the database
+                self.logger.debug(f'Error archiving {len(archive_day)} records - station_id: {archive_day.station_id}, day: {archive_day.day}: {err}')
+                ok = False
+            done(archive_day, ok)
+        return self.executor.submit(task)
+
+    def close(self):
+        # Wait for a write in progress
+        self.executor.shutdown(wait=True)
+
+    def write_day(self, station_id, day, columns):
+        import numpy as np
+        path = archive_path(self.archive_dir, station_id, day)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # a day may span several retention passes, merge with what is already on disk. The new records come first,
+        # so np.unique(), which keeps the first occurrence of a ts, keeps them over the ones already archived.
+        if os.path.exists(path):
+            existing = load_archive_file(path)
+            merged = {name: np.concatenate((columns[name], existing[name])) for name in COLUMNS}
+            _, index = np.unique(merged['ts'], return_index=True)
+            columns = {name: merged[name][index] for name in COLUMNS}
+
+        # write to a temporary file, fsync it and rename, the records are only deleted once the file is durable
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez_compressed(file, **columns)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        if os.name == 'posix':
+            # make the rename itself durable
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.logger.debug(f'Archived {len(columns["ts"])} records - station_id: {station_id}, day: {day}, file: {path}')
+
+def to_columns(block):
+    # {column: array} of an n x 5 int64 block of (ts, tenths...) rows, raises ValueError for a value int16 can't hold
+    import numpy as np
+    values = block[:, 1:]
+    if len(values) and (values.min() < NULL_VALUE or values.max() > np.iinfo(np.int16).max):
+        raise ValueError('Sensor value out of the int16 archive range')
+    return {name: block[:, i].astype(dtype) for i, (name, dtype) in enumerate(zip(COLUMNS, DTYPES))}
+
+def archive_path(archive_dir, station_id, day):
+    return os.path.join(archive_dir, station_id, f'{day.isoformat()}.npz')
+
+def load_archive_file(path):
+    # The stored columns, sensor columns of files written before they were archived as int16 tenths are converted
+    import numpy as np
+    with np.load(path) as data:
+        columns = {name: data[name] for name in data.files}
+    for name in VALUE_COLUMNS:
+        if columns[name].dtype.kind == 'f':
+            tenths = np.round(columns[name].astype(np.float64) * SCALE)
+            columns[name] = np.where(np.isnan(tenths), NULL_VALUE, tenths).astype(np.int16)
+    return columns
+
+# Function to load an archived day back as column arrays without touching SQLite, returns None if the day wasn't archived.
+# ts is int64 and the sensor columns float64 in their real units, NaN for NULL values, like query.py.
+def load_archived_day(archive_dir, station_id, day):
+    import numpy as np
+    if isinstance(day, str):
+        day = dt.date.fromisoformat(day)
+    path = archive_path(archive_dir, station_id, day)
+    if not os.path.exists(path):
+        return None
+    columns = load_archive_file(path)
+    for name in VALUE_COLUMNS:
+        tenths = columns[name]
+        columns[name] = np.where(tenths == NULL_VALUE, np.nan, tenths / SCALE)
+    return columns
@@ -0,0 +1,21 @@
+import random
+
+##### Backoff class to compute reconnect delays: exponential growth from initial to maximum seconds, with jitter
+##### so stations that dropped together don't reconnect in lockstep. reset() after a connection that delivered data.
+class Backoff:
+
+    def __init__(self, initial=1.0, maximum=60.0, multiplier=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        # fraction of the delay that is randomized, 0.5 waits between half and the whole of the delay
+        self.jitter = min(max(jitter, 0.0), 1.0)
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.initial * self.multiplier ** self.attempt)
+        self.attempt += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempt = 0
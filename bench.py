@@ -0,0 +1,177 @@
+'''
+SQLite_WSS_Data ingest benchmark suite
+- runs the real ingest path of main.py (decoder, DatabaseWriter, gap fill, rollups) against a local ReplayServer
+- reports messages/sec, p50/p99 latency from recv to commit, gap fill cost and database size growth per scenario
+- run directly: python bench.py --scenario clean gaps --messages 5000 --json results.json
+'''
+
+import os, io, sys, json, time, sqlite3, asyncio, argparse, tempfile, contextlib
+import numpy as np
+import main
+from db_writer import DatabaseWriter
+from replay_server import ReplayServer, synthetic_payloads, load_payloads, midnight_ts
+from common import QuietLogger
+
+# ReplayServer options of each scenario, 'stations' is the number of station connections and 'reorder_window' the
+# reorder_window_seconds of main.py, 0 unless set so the other scenarios measure ingest without the reorder hold
+SCENARIOS = {
+    'clean': {},
+    'duplicates': {'duplicate_prob': 0.05},
+    'gaps': {'gap_prob': 0.02, 'max_gap': 24},
+    'disconnects': {'disconnect_every': 1000},
+    'stations': {'stations': 4},
+    'reorder': {'swap_prob': 0.02, 'reorder_window': 10},
+}
+REPLAY_PORT = 8781
+DRAIN_TIMEOUT = 60 # seconds to wait for the writer to commit the replayed messages
+
+##### BenchStats class collecting commit latencies from a DatabaseWriter post-commit hook and gap fill timings
+class BenchStats:
+
+    def __init__(self):
+        self.latencies = []
+        self.first_queued = None
+        self.last_commit = None
+        self.gap_fills = 0
+        self.gap_rows = 0
+        self.gap_seconds = 0.0
+
+    def on_commit(self, batch):
+        now = time.perf_counter()
+        for station_id, _, queued_at in batch:
+            if station_id is None:
+                # retention and other writer jobs aren't readings
+                continue
+            self.latencies.append(now - queued_at)
+            if self.first_queued is None or queued_at < self.first_queued:
+                self.first_queued = queued_at
+        self.last_commit = now
+
+    def timed_gap_fill(self, insert_missed_readings):
+        def wrapper(station_id, last_data, next_data, missed_count, cursor, cache):
+            start = time.perf_counter()
+            try:
+                return insert_missed_readings(station_id, last_data, next_data, missed_count, cursor, cache)
+            finally:
+                self.gap_seconds += time.perf_counter() - start
+                self.gap_fills += 1
+                self.gap_rows += missed_count
+        return wrapper
+
+def database_bytes(database_path):
+    return sum(os.path.getsize(path) for path in (database_path, database_path + '-wal') if os.path.exists(path))
+
+# Function to run one scenario against a fresh database, returns a dict of results
+async def run_scenario(name, payloads, rate=0, batch_size=main.commit_batch_size, interval_ms=main.commit_interval_ms, stations=1, reorder_window=0,
+                       **replay_options):
+    stats = BenchStats()
+    server = ReplayServer(payloads, port=REPLAY_PORT, rate=rate, **replay_options)
+    targets = {f'BENCH{i:02d}': server.uri(f'BENCH{i:02d}') for i in range(stations)}
+
+    # every DatabaseWriter built by run_stations reports its commits to stats
+    class BenchWriter(DatabaseWriter):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.add_post_commit(stats.on_commit)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_path = os.path.join(tmp_dir, 'bench.db')
+        saved = {key: getattr(main, key, None) for key in ('logger', 'stations', 'database_path', 'archive_dir', 'retention_days', 'retention_rows',
+                                                     'fanout_host', 'spool_path', 'reorder_window_seconds', 'commit_batch_size', 'commit_interval_ms', 'DatabaseWriter', 'insert_missed_readings')}
+        main.logger = QuietLogger()
+        main.stations = targets
+        main.database_path = database_path
+        main.archive_dir = None
+        # replayed readings start at today's midnight, nothing may expire during the run
+        main.retention_days = 3650
+        main.retention_rows = None
+        main.fanout_host = None
+        main.spool_path = os.path.join(tmp_dir, 'bench.spool')
+        main.reorder_window_seconds = reorder_window
+        main.commit_batch_size = batch_size
+        main.commit_interval_ms = interval_ms
+        main.DatabaseWriter = BenchWriter
+        main.insert_missed_readings = stats.timed_gap_fill(saved['insert_missed_readings'])
+
+        await server.start()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_task = asyncio.create_task(main.run_stations(targets, asyncio.Event()))
+                await server.wait_finished(targets)
+                # every message sent has been received once the writer has committed as many readings
+                deadline = time.perf_counter() + DRAIN_TIMEOUT
+                while len(stats.latencies) < server.stats['sent'] and time.perf_counter() < deadline and not run_task.done():
+                    await asyncio.sleep(0.05)
+                run_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await run_task
+        finally:
+            await server.stop()
+            for key, value in saved.items():
+                setattr(main, key, value)
+        wall_seconds = time.perf_counter() - start
+
+        connection = sqlite3.connect(database_path)
+        try:
+            rows = connection.execute('SELECT COUNT(*) FROM websocket_data').fetchone()[0]
+        finally:
+            connection.close()
+        size = database_bytes(database_path)
+
+    latencies = np.array(stats.latencies) * 1000
+    ingest_seconds = (stats.last_commit - stats.first_queued) if stats.latencies else 0
+    return {
+        'scenario': name,
+        'reorder_window': reorder_window,
+        'sent': server.stats['sent'],
+        'committed': len(stats.latencies),
+        'msgs_per_sec': len(stats.latencies) / ingest_seconds if ingest_seconds > 0 else 0.0,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        'gap_fills': stats.gap_fills,
+        'gap_rows': stats.gap_rows,
+        'gap_fill_ms': stats.gap_seconds * 1000,
+        'gap_us_per_row': stats.gap_seconds * 1e6 / stats.gap_rows if stats.gap_rows else 0.0,
+        'rows': rows,
+        'db_bytes': size,
+        'bytes_per_row': size / rows if rows else 0.0,
+        'wall_seconds': wall_seconds,
+        'replay': server.stats,
+    }
+
+def print_results(results):
+    header = f'{"scenario":<12} {"sent":>7} {"msg/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"gaps":>5} {"gap rows":>8} {"gap ms":>8} {"us/row":>7} {"rows":>7} {"DB KiB":>8} {"B/row":>6}'
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f'{r["scenario"]:<12} {r["sent"]:>7} {r["msgs_per_sec"]:>9.0f} {r["p50_ms"]:>8.1f} {r["p99_ms"]:>8.1f} {r["gap_fills"]:>5} {r["gap_rows"]:>8} '
+              f'{r["gap_fill_ms"]:>8.1f} {r["gap_us_per_row"]:>7.1f} {r["rows"]:>7} {r["db_bytes"] / 1024:>8.0f} {r["bytes_per_row"]:>6.0f}')
+
+async def run_suite(args):
+    payloads = load_payloads(args.payloads, midnight_ts()) if args.payloads else synthetic_payloads(args.messages, seed=args.seed)
+    results = []
+    for name in args.scenario:
+        options = dict(SCENARIOS[name])
+        results.append(await run_scenario(name, payloads, rate=args.rate, batch_size=args.batch_size, interval_ms=args.interval_ms, seed=args.seed, **options))
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the SQLite_WSS_Data ingest path against a local replay server.')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--messages', type=int, default=5000, help='synthetic messages replayed per station')
+    parser.add_argument('--payloads', help='file of recorded messages to replay instead of synthetic ones')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second per station, 0 replays as fast as ingest keeps up')
+    parser.add_argument('--batch-size', type=int, default=main.commit_batch_size)
+    parser.add_argument('--interval-ms', type=int, default=main.commit_interval_ms)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file, e.g. to compare before and after a change')
+    args = parser.parse_args()
+
+    results = asyncio.run(run_suite(args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if all(r['committed'] >= r['sent'] for r in results) else 1)
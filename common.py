@@ -0,0 +1,25 @@
+from urllib.parse import urlparse, parse_qs
+
+READING_INTERVAL = 5 # seconds between weatherstem readings
+# the columns of a reading, in the order they are stored, queried and held in memory
+COLUMNS = ('ts', 'temperature', 'humidity', 'dew_point', 'heat_index')
+VALUE_COLUMNS = COLUMNS[1:]
+
+##### Small helpers shared by the servers and command line tools
+
+# Function to read a query parameter of a websocket connection's request path, e.g. ?station=001D0A71267A
+def query_param(websocket, name, default=None):
+    # websockets >= 13 exposes the request path on websocket.request, older versions on websocket.path
+    request = getattr(websocket, 'request', None)
+    path = request.path if request is not None else getattr(websocket, 'path', '/')
+    return parse_qs(urlparse(path).query).get(name, [default])[0]
+
+# PrintLogger class standing in for CustomLogger in the command line tools, debug messages go to stdout
+class PrintLogger:
+    def debug(self, message):
+        print(message)
+
+# QuietLogger class dropping every message, for the benchmark and the tests
+class QuietLogger:
+    def debug(self, message, *args, category=None):
+        pass
@@ -0,0 +1,350 @@
+import time, asyncio, sqlite3, threading, contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BATCH_SIZE = 60 # rows per commit
+DEFAULT_BATCH_INTERVAL_MS = 1000 # milliseconds a queued reading may wait before it is committed
+DEFAULT_LOCK_TIMEOUT_MS = 100 # with a spool, milliseconds to wait for the write lock before a batch is spooled instead
+DRAIN_BATCH_SIZE = 2000 # spooled readings replayed per transaction
+DRAIN_BUDGET = 0.2 # seconds spent draining the spool per call before yielding to the event loop
+INTERPOLATED_HISTORY = 4096 # ts of interpolated rows remembered per station, so a late real reading can replace its row
+
+##### ReadingCache class to hold the last inserted reading and a running row count in memory.
+##### It is seeded from the database once, and again when it can't follow a change, so the write path does no read queries per message.
+class ReadingCache:
+
+    def __init__(self):
+        self.last = None
+        self.count = 0
+        self.seeded = False
+        # ts of the most recent interpolated rows, oldest first
+        self.interpolated = set()
+        self.interpolated_order = deque()
+
+    def seed(self, last, count):
+        self.last = tuple(last) if last is not None else None
+        self.count = count
+        self.seeded = True
+
+    def invalidate(self):
+        # Force a reseed from the database before the next use, e.g. after rows were deleted by a trim
+        self.seeded = False
+
+    def record_insert(self, col_data):
+        # Keep the cache in step with one inserted row
+        self.count += 1
+        if self.last is None or col_data[0] > self.last[0]:
+            self.last = tuple(col_data)
+
+    def record_delete(self, rowcount, before_ts):
+        # Keep the cache in step with rowcount rows deleted below before_ts
+        self.count -= rowcount
+        if self.last is not None and self.last[0] < before_ts:
+            # the latest row itself was deleted
+            self.invalidate()
+
+    def record_bulk_insert(self, bulk_data, rowcount):
+        if rowcount != len(bulk_data):
+            # Some rows were ignored as duplicates, the cache can't tell which ones
+            self.invalidate()
+            return
+        self.count += rowcount
+        latest = max(bulk_data, key=lambda record: record[0])
+        if self.last is None or latest[0] > self.last[0]:
+            self.last = tuple(latest)
+
+    def record_interpolated(self, ts_values):
+        # Remember the ts of interpolated rows, forgetting the oldest beyond INTERPOLATED_HISTORY
+        for ts in ts_values:
+            if ts in self.interpolated:
+                continue
+            self.interpolated.add(ts)
+            self.interpolated_order.append(ts)
+            if len(self.interpolated_order) > INTERPOLATED_HISTORY:
+                self.interpolated.discard(self.interpolated_order.popleft())
+
+    def take_interpolated(self, ts):
+        # True if ts is an interpolated row a real reading should replace, it is then no longer treated as interpolated
+        if ts not in self.interpolated:
+            return False
+        self.interpolated.discard(ts)
+        return True
+
+    def record_replace(self, col_data):
+        # Keep the cache in step with a row whose values were replaced, the row count doesn't change
+        if self.last is not None and col_data[0] == self.last[0]:
+            self.last = tuple(col_data)
+
+##### DatabaseWriter class to implement a group-commit write-behind queue between websocket.recv() and SQLite.
+##### Readings are queued by the receive loop and drained in batches, one commit per batch_size rows or batch_interval_ms.
+##### Every batch runs on the writer's own thread, which owns the connection, so a commit or a lock wait never stalls the event loop.
+class DatabaseWriter:
+
+    def __init__(self, connection, handler, logger, batch_size=DEFAULT_BATCH_SIZE, batch_interval_ms=DEFAULT_BATCH_INTERVAL_MS, metrics=None,
+                 spool=None, lock_timeout_ms=DEFAULT_LOCK_TIMEOUT_MS):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        # handler(station_id, col_data, cursor, cache) performs the per-reading database work without committing
+        self.handler = handler
+        self.logger = logger
+        self.batch_size = max(1, int(batch_size))
+        self.batch_interval = max(0, batch_interval_ms) / 1000
+        # one ReadingCache per station_id
+        self.caches = {}
+        self.queue = asyncio.Queue()
+        self.stop_event = asyncio.Event()
+        self.task = None
+        self.loop = None
+        # the single thread all SQLite work on the connection runs on once the writer is created
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='DatabaseWriter')
+        self.loop_thread = None
+        # (hook(cursor), on_error()) pairs run before every commit, in the batch's transaction
+        self.pre_commit = []
+        # hook(batch) run after every successful commit, batch items are (station_id, item, queued_at) with queued_at from time.perf_counter() when the item was received
+        self.post_commit = []
+        # optional Metrics instance, see metrics.py
+        self.metrics = metrics
+        # optional ReadingSpool taking the readings of batches that couldn't be committed, see spool.py
+        self.spool = spool
+        self.lock_timeout_ms = lock_timeout_ms
+        # jobs of spooled batches, run with the first batch committed after the spool is drained
+        self.deferred_jobs = []
+
+    def cache_for(self, station_id):
+        cache = self.caches.get(station_id)
+        if cache is None:
+            cache = self.caches[station_id] = ReadingCache()
+        return cache
+
+    def put(self, station_id, col_data, received_at=None):
+        # Called from the receive loop of each station, never blocks. received_at is the time.perf_counter() the reading was received,
+        # when it was held before being queued, e.g. by a ReorderBuffer, so ingest_lag_seconds includes the hold.
+        self.queue.put_nowait((station_id, col_data, time.perf_counter() if received_at is None else received_at))
+
+    def add_pre_commit(self, hook, on_error=None):
+        self.pre_commit.append((hook, on_error))
+
+    def add_post_commit(self, hook):
+        self.post_commit.append(hook)
+
+    def submit(self, job):
+        # job(cursor, caches) runs on the writer's thread in queue order and is committed with its batch.
+        # Jobs may resubmit themselves from the writer's thread.
+        if self.loop_thread is not None and threading.get_ident() != self.loop_thread:
+            self.submit_threadsafe(job)
+            return
+        self.queue.put_nowait((None, job, time.perf_counter()))
+
+    def submit_threadsafe(self, job):
+        # For callers on other threads, e.g. the trim scheduler
+        if self.loop is None or self.loop.is_closed():
+            self.logger.debug(f'DatabaseWriter is not running, job {job} dropped')
+            return
+        self.loop.call_soon_threadsafe(self.submit, job)
+
+    async def call(self, func, *args):
+        # Run func(*args) on the writer's thread between batches and return its result, e.g. a query on the writer's connection
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        # Signal the writer to finish, then wait for the queued readings to be committed
+        self.stop_event.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+        self.executor.shutdown(wait=True)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=self.batch_interval or DEFAULT_BATCH_INTERVAL_MS / 1000))
+                except asyncio.TimeoutError:
+                    if self.spool is not None and self.spool.pending:
+                        await self.call(self.drain_spool)
+                    continue
+
+                # Collect more readings until the batch is full or the commit interval has elapsed
+                deadline = loop.time() + self.batch_interval
+                while len(batch) < self.batch_size:
+                    if not self.queue.empty():
+                        batch.append(self.queue.get_nowait())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0 or self.stop_event.is_set():
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # the receive loops keep queueing readings while the batch is written. Shielded, so a cancelled
+                # writer still writes the batch it handed to the thread.
+                written, batch = batch, []
+                await asyncio.shield(self.call(self.write_batch, written))
+        finally:
+            # Commit whatever is still pending, including on task cancellation. The executor runs one batch at a time,
+            # so this waits for a batch still being written when the task was cancelled.
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.executor.submit(self.write_batch, batch).result()
+            if self.spool is not None and self.spool.pending:
+                self.executor.submit(self.drain_spool).result()
+
+    def begin(self):
+        # Take the write lock for a batch, returns False if it couldn't be taken. With a spool, waits at most lock_timeout_ms
+        # rather than busy_timeout, so a database locked by another writer never stalls the event loop for long.
+        if self.connection.in_transaction:
+            return True
+        short_timeout = self.spool is not None and self.lock_timeout_ms is not None
+        if short_timeout:
+            busy_timeout = self.connection.execute('PRAGMA busy_timeout').fetchone()[0]
+            self.connection.execute(f'PRAGMA busy_timeout = {int(self.lock_timeout_ms)}')
+
+        start = time.perf_counter()
+        locked = True
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as err:
+            self.logger.debug('Error taking the write lock: %s', err, category='db_error')
+            locked = False
+            if self.metrics is not None:
+                self.metrics.inc('lock_timeouts_total')
+        finally:
+            if short_timeout:
+                self.connection.execute(f'PRAGMA busy_timeout = {busy_timeout}')
+        if self.metrics is not None:
+            self.metrics.observe('lock_wait_seconds', time.perf_counter() - start)
+        return locked
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+
+        if self.spool is not None:
+            if self.spool.pending:
+                self.drain_spool()
+            if self.spool.pending or not self.begin():
+                # readings go behind the ones already spooled, so they are still applied in arrival order
+                self.spool_batch(batch)
+                return
+        else:
+            # without a spool the batch's statements retry the lock themselves
+            self.begin()
+
+        if self.deferred_jobs:
+            batch = [(None, job, time.perf_counter()) for job in self.deferred_jobs] + batch
+            self.deferred_jobs = []
+
+        if not self.apply_and_commit(batch) and self.spool is not None:
+            self.spool_batch(batch)
+
+    def spool_batch(self, batch):
+        readings = [(station_id, item) for station_id, item, _ in batch if station_id is not None]
+        self.deferred_jobs += [item for station_id, item, _ in batch if station_id is None]
+        try:
+            self.spool.append(readings)
+        except OSError as err:
+            self.logger.debug(f'Error spooling {len(readings)} readings, they are lost: {err}')
+            return
+        self.logger.debug(f'Spooled {len(readings)} readings, spool depth: {self.spool.depth}')
+        if self.metrics is not None:
+            self.metrics.inc('spool_records_total', len(readings))
+            self.metrics.set('spool_depth', self.spool.depth)
+
+    def drain_spool(self):
+        # Replay spooled readings in order, one transaction per DRAIN_BATCH_SIZE, until the spool is empty,
+        # the lock can't be taken or DRAIN_BUDGET is used up
+        start = time.perf_counter()
+        drained = 0
+        while self.spool.pending and time.perf_counter() - start < DRAIN_BUDGET:
+            if not self.begin():
+                break
+            records, offset = self.spool.read(max_records=DRAIN_BATCH_SIZE)
+            if not self.apply_and_commit([(station_id, reading, None) for station_id, reading in records], drained=True):
+                break
+            try:
+                self.spool.advance(offset, len(records))
+            except OSError as err:
+                # the readings are committed, replaying them again later is harmless
+                self.logger.debug(f'Error updating the spool offset: {err}')
+                break
+            drained += len(records)
+
+        if drained:
+            seconds = time.perf_counter() - start
+            self.logger.debug(f'Drained {drained} spooled readings in {seconds * 1000:.0f} ms, spool depth: {self.spool.depth}')
+            if self.metrics is not None:
+                self.metrics.inc('spool_drained_total', drained)
+                self.metrics.set('spool_drain_rate', drained / seconds if seconds > 0 else 0.0)
+                self.metrics.set('spool_depth', self.spool.depth)
+
+    def apply_and_commit(self, batch, drained=False):
+        # Run the batch's readings and jobs and commit them, returns False if the batch was rolled back
+        metrics = self.metrics
+        for station_id, item, _ in batch:
+            try:
+                if station_id is None:
+                    # a submitted job rather than a reading
+                    item(self.cursor, self.caches)
+                else:
+                    self.handler(station_id, item, self.cursor, self.cache_for(station_id))
+            except Exception as err:
+                self.logger.debug(f'Error handling {item} from station {station_id} in DatabaseWriter: {err}')
+
+        for hook, on_error in self.pre_commit:
+            try:
+                hook(self.cursor)
+            except sqlite3.Error as err:
+                # a failing hook never costs the batch its readings
+                self.logger.debug(f'Error in DatabaseWriter pre-commit hook {hook}: {err}')
+                if on_error is not None:
+                    on_error()
+
+        start = time.perf_counter()
+        try:
+            self.connection.commit()
+        except sqlite3.Error as err:
+            self.logger.debug(f'Error committing batch of {len(batch)} readings: {err}')
+            if metrics is not None:
+                metrics.inc('commit_errors_total')
+            with contextlib.suppress(sqlite3.Error):
+                self.connection.rollback()
+            # the caches may hold rows that were rolled back
+            for cache in self.caches.values():
+                cache.invalidate()
+            return False
+
+        if metrics is not None:
+            now = time.perf_counter()
+            metrics.observe('stage_seconds', now - start, stage='commit')
+            metrics.observe('batch_size', len(batch))
+            metrics.set('writer_queue_depth', self.queue.qsize())
+            metrics.set('last_commit_timestamp_seconds', time.time())
+
+        if drained:
+            # replayed from the spool, the receive time of these readings isn't known
+            return True
+
+        if metrics is not None:
+            readings = 0
+            for station_id, _, queued_at in batch:
+                if station_id is not None:
+                    metrics.observe('ingest_lag_seconds', now - queued_at)
+                    readings += 1
+            metrics.inc('readings_committed_total', readings)
+
+        for hook in self.post_commit:
+            try:
+                hook(batch)
+            except Exception as err:
+                self.logger.debug(f'Error in DatabaseWriter post-commit hook {hook}: {err}')
+        return True
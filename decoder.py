@@ -0,0 +1,104 @@
+import json, math
+from typing import NamedTuple
+
+# Optional faster JSON backends, used when installed. The stdlib json module is always available as a fallback.
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Typed record holding only the five fields stored in the database. It is a tuple, so it can be passed straight to sqlite3.
+class Reading(NamedTuple):
+    ts: int
+    temperature: float
+    humidity: float
+    dew_point: float
+    heat_index: float
+
+# Raised for malformed or partial payloads
+class DecodeError(ValueError):
+    pass
+
+if msgspec is not None:
+    # msgspec decodes straight into these structs, only the fields listed here are built, everything else is skipped
+    class _PolledConditions(msgspec.Struct):
+        temp: float
+        hum: float
+        dew_point: float
+        heat_index: float
+
+    class _Message(msgspec.Struct):
+        ts: int | float
+        polledConditions: list[_PolledConditions]
+
+def make_reading(ts, temp, hum, dew_point, heat_index):
+    # NaN and infinities (the json backend accepts NaN, Infinity and 1e400) can't be stored as a ts or interpolated, every backend rejects them
+    if not (math.isfinite(ts) and math.isfinite(temp) and math.isfinite(hum) and math.isfinite(dew_point) and math.isfinite(heat_index)):
+        raise DecodeError('Non-finite field in message')
+    return Reading(int(ts), round(float(temp), 1), round(float(hum), 1), round(float(dew_point), 1), round(float(heat_index), 1))
+
+##### ReadingDecoder class to decode a weatherstem message into a Reading using the fastest available JSON backend.
+class ReadingDecoder:
+
+    BACKENDS = ('msgspec', 'orjson', 'json')
+
+    def __init__(self, backend='auto'):
+        if backend == 'auto':
+            backend = 'msgspec' if msgspec is not None else 'orjson' if orjson is not None else 'json'
+        if backend not in self.BACKENDS:
+            raise ValueError(f'Unknown decoder backend: {backend}')
+        if (backend == 'msgspec' and msgspec is None) or (backend == 'orjson' and orjson is None):
+            raise ValueError(f'Decoder backend {backend} is not installed')
+
+        self.backend = backend
+        if backend == 'msgspec':
+            self._msgspec_decoder = msgspec.json.Decoder(_Message)
+            self.decode = self._decode_msgspec
+        elif backend == 'orjson':
+            self._loads = orjson.loads
+            self.decode = self._decode_dict
+        else:
+            self._loads = json.loads
+            self.decode = self._decode_dict
+
+    def _decode_msgspec(self, message):
+        try:
+            data = self._msgspec_decoder.decode(message)
+        except (msgspec.DecodeError, msgspec.ValidationError) as err:
+            raise DecodeError(str(err)) from None
+
+        if not data.polledConditions:
+            raise DecodeError('polledConditions is empty')
+
+        conditions = data.polledConditions[0]
+        return make_reading(data.ts, conditions.temp, conditions.hum, conditions.dew_point, conditions.heat_index)
+
+    def _decode_dict(self, message):
+        # Cheap rejection of payloads that can't contain a reading before paying for a full parse
+        key = 'polledConditions' if isinstance(message, str) else b'polledConditions'
+        if key not in message:
+            raise DecodeError('polledConditions missing from message')
+
+        try:
+            data = self._loads(message)
+        except ValueError as err:
+            # json.JSONDecodeError and orjson.JSONDecodeError are both ValueError subclasses
+            raise DecodeError(str(err)) from None
+
+        try:
+            ts = data['ts']
+            # index polledConditions once rather than per column
+            conditions = data['polledConditions'][0]
+            values = (conditions['temp'], conditions['hum'], conditions['dew_point'], conditions['heat_index'])
+        except (KeyError, IndexError, TypeError) as err:
+            raise DecodeError(f'Missing field in message: {err}') from None
+
+        if not all(type(value) in (int, float) for value in (ts, *values)):
+            raise DecodeError('Non-numeric field in message')
+
+        return make_reading(ts, *values)
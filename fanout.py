@@ -0,0 +1,94 @@
+import json, asyncio
+import websockets
+from common import query_param
+
+DEFAULT_QUEUE_SIZE = 100 # messages buffered per subscriber
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'disconnect')
+
+# Subscriber class holding one local client's bounded queue and station filter
+class Subscriber:
+
+    def __init__(self, websocket, station_id, queue_size):
+        self.websocket = websocket
+        # None subscribes to every station
+        self.station_id = station_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def end(self):
+        # Replace whatever is queued with the None sentinel, the sender closes the connection when it gets it
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+##### FanoutServer class to rebroadcast decoded readings from memory to local WebSocket subscribers.
+##### Subscribers connect to ws://host:port/ for every station or ws://host:port/?station=STATION_ID for one station.
+##### A subscriber whose queue is full either loses its oldest message ('drop_oldest') or is disconnected ('disconnect').
+class FanoutServer:
+
+    def __init__(self, host, port, logger, queue_size=DEFAULT_QUEUE_SIZE, slow_consumer='drop_oldest'):
+        if slow_consumer not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f'Unknown slow consumer policy: {slow_consumer}')
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.queue_size = max(1, int(queue_size))
+        self.slow_consumer = slow_consumer
+        self.subscribers = set()
+        self.server = None
+        self.closing = False
+
+    async def start(self):
+        self.server = await websockets.serve(self.handler, self.host, self.port)
+        self.logger.debug(f'Fan-out server listening on ws://{self.host}:{self.port}')
+
+    async def stop(self):
+        if self.server is not None:
+            # release senders waiting on an empty queue
+            self.closing = True
+            for subscriber in list(self.subscribers):
+                subscriber.end()
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            self.logger.debug('Fan-out server stopped')
+
+    def publish(self, station_id, reading):
+        # Called from the receive loop, never blocks. The message is encoded once for all subscribers.
+        if not self.subscribers:
+            return
+        message = json.dumps({'station_id': station_id, **reading._asdict()})
+        for subscriber in list(self.subscribers):
+            if subscriber.station_id is not None and subscriber.station_id != station_id:
+                continue
+            if subscriber.queue.full():
+                if self.slow_consumer == 'disconnect':
+                    self.logger.debug(f'Fan-out subscriber {subscriber.websocket.remote_address} too slow, disconnecting')
+                    self.subscribers.discard(subscriber)
+                    subscriber.end()
+                    continue
+                subscriber.queue.get_nowait()
+                subscriber.dropped += 1
+            subscriber.queue.put_nowait(message)
+
+    async def handler(self, websocket):
+        station_id = query_param(websocket, 'station')
+
+        subscriber = Subscriber(websocket, station_id, self.queue_size)
+        self.subscribers.add(subscriber)
+        self.logger.debug(f'Fan-out subscriber connected: {websocket.remote_address}, station: {station_id}')
+        try:
+            while True:
+                message = await subscriber.queue.get()
+                if message is None:
+                    if self.closing:
+                        await websocket.close(code=1001, reason='server shutting down')
+                    else:
+                        await websocket.close(code=1013, reason='subscriber too slow')
+                    break
+                await websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            self.logger.debug(f'Fan-out subscriber disconnected: {websocket.remote_address}, dropped messages: {subscriber.dropped}')
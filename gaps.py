@@ -0,0 +1,33 @@
+from common import READING_INTERVAL
+
+GAP_THRESHOLD = 6 # seconds, readings further apart than this have readings missing between them
+
+##### The gap rule and interpolation shared by the live path (main.py), the bulk importer and the gap repair tool.
+##### numpy is only imported by the interpolation, so the live path doesn't load it until a gap has to be filled.
+
+# Function to count the readings missed in gaps of the given seconds, an int or an int64 array:
+# a gap of more than GAP_THRESHOLD seconds misses gap // READING_INTERVAL - 1 readings
+def missed_readings(gaps):
+    return (gaps > GAP_THRESHOLD) * (gaps // READING_INTERVAL - 1)
+
+# Function to interpolate every gap between the records before[i] and after[i] (g x 5 float64 arrays) at once.
+# Returns the missed records in gap order, READING_INTERVAL seconds apart, values linearly interpolated and rounded to 1 decimal.
+def interpolate_gaps(before, after):
+    import numpy as np
+    missed = missed_readings(after[:, 0].astype(np.int64) - before[:, 0].astype(np.int64))
+    gap_index = np.flatnonzero(missed > 0)
+    counts = missed[gap_index]
+    # for every filled record: the gap it belongs to and its position k = 1..missed inside the gap
+    owner = np.repeat(gap_index, counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    start = before[owner]
+    step = (after[owner] - start) / (missed[owner] + 1)[:, None]
+    step[:, 0] = READING_INTERVAL
+    filled = start + step * k[:, None]
+    filled[:, 1:] = np.round(filled[:, 1:], 1)
+    return filled
+
+# Function to interpolate the records missed between two readings, returns a (missed x 5) array
+def interpolate_gap(last_data, next_data):
+    import numpy as np
+    return interpolate_gaps(np.asarray([last_data], dtype=np.float64), np.asarray([next_data], dtype=np.float64))
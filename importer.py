@@ -0,0 +1,183 @@
+'''
+SQLite_WSS_Data bulk import tool
+- loads recorded weatherstem messages, one JSON message per line, into the database offline
+- lines are decoded in a process pool, sorted by ts and gap filled as one batch, then written with large executemany() transactions
+- run directly: python importer.py websocket_data.db capture-1.jsonl capture-2.jsonl --station-id 001D0A71267A
+'''
+
+import os, sys, time, sqlite3, argparse
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decoder import ReadingDecoder, DecodeError
+from storage import STORAGE_PROFILE, apply_storage_profile
+from schema import check_schema, SchemaVersionError, INSERT_SQL, READINGS_VIEW
+from common import PrintLogger
+from rollups import RollupTables
+from gaps import interpolate_gaps
+
+CHUNK_LINES = 20000 # lines decoded per worker task
+WRITE_ROWS = 50000 # records inserted per transaction
+
+##### worker process side
+_decoder = None
+
+def init_worker(backend):
+    global _decoder
+    _decoder = ReadingDecoder(backend)
+
+def decode_lines(lines):
+    # Decode a chunk of lines into a (n x 5) float64 array of ts, temperature, humidity, dew_point, heat_index. Returns (array, lines skipped).
+    decoder = _decoder or ReadingDecoder()
+    readings = []
+    for line in lines:
+        try:
+            readings.append(decoder.decode(line))
+        except DecodeError:
+            pass
+    block = np.array(readings, dtype=np.float64).reshape(-1, 5)
+    return block, len(lines) - len(block)
+
+def read_chunks(paths, chunk_lines=CHUNK_LINES):
+    # Stream the files as lists of non-empty lines
+    chunk = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    chunk.append(line)
+                    if len(chunk) >= chunk_lines:
+                        yield chunk
+                        chunk = []
+    if chunk:
+        yield chunk
+
+##### import steps
+def sort_unique(block):
+    # Sort by ts and keep the first record of every ts, the live path ignores a second reading with the same ts too
+    block = block[np.argsort(block[:, 0], kind='stable')]
+    _, first = np.unique(block[:, 0], return_index=True)
+    return block[first]
+
+def fill_gaps(block):
+    # Fill every time gap of a sorted block at once. Returns (records, interpolated) sorted by ts, interpolated marks the filled records.
+    filled = interpolate_gaps(block[:-1], block[1:])
+    if len(filled) == 0:
+        return block, np.zeros(len(block), dtype=bool)
+
+    records = np.concatenate([block, filled])
+    interpolated = np.r_[np.zeros(len(block), dtype=bool), np.ones(len(filled), dtype=bool)]
+    order = np.argsort(records[:, 0], kind='stable')
+    return records[order], interpolated[order]
+
+def existing_records(cursor, station_id, first_ts, last_ts):
+    # Records already stored over the imported range, plus the nearest record on either side so gaps at the edges are filled too
+    cursor.execute(f'SELECT ts, temperature, humidity, dew_point, heat_index FROM {READINGS_VIEW} WHERE station_id = ? AND ts >= ? AND ts <= ?', (station_id, first_ts, last_ts))
+    rows = cursor.fetchall()
+    cursor.execute(f'SELECT ts, temperature, humidity, dew_point, heat_index FROM {READINGS_VIEW} WHERE station_id = ? AND ts < ? ORDER BY ts DESC LIMIT 1', (station_id, first_ts))
+    rows += cursor.fetchall()
+    cursor.execute(f'SELECT ts, temperature, humidity, dew_point, heat_index FROM {READINGS_VIEW} WHERE station_id = ? AND ts > ? ORDER BY ts LIMIT 1', (station_id, last_ts))
+    rows += cursor.fetchall()
+    rows = [row for row in rows if None not in row]
+    return np.array(rows, dtype=np.float64).reshape(-1, 5)
+
+def write_records(connection, station_id, records, interpolated, logger, write_rows=WRITE_ROWS):
+    # Insert the records in write_rows sized transactions, with their rollups upserted in the same transaction
+    cursor = connection.cursor()
+    rollups = RollupTables(logger)
+    inserted = 0
+    for start in range(0, len(records), write_rows):
+        block = records[start:start + write_rows]
+        ts = block[:, 0].astype(np.int64)
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.executemany(INSERT_SQL,
+                               zip([station_id] * len(block), ts.tolist(), *block[:, 1:].T.tolist()))
+            rollups.upsert_block(cursor, station_id, ts, block[:, 1:], interpolated[start:start + write_rows])
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        inserted += len(block)
+        logger.debug(f'Import chunk - rows: {len(block)}, total: {inserted}')
+    return inserted
+
+# Function to import JSONL files of recorded messages for one station, returns a dict of counts
+def import_files(connection, paths, station_id, logger, workers=None, backend='auto', gap_fill=True, write_rows=WRITE_ROWS, chunk_lines=CHUNK_LINES):
+    start = time.perf_counter()
+
+    blocks, skipped = [], 0
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        init_worker(backend)
+        for block, errors in map(decode_lines, read_chunks(paths, chunk_lines)):
+            blocks.append(block)
+            skipped += errors
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(backend,)) as pool:
+            # at most two chunks per worker are read ahead, so memory holds the decoded arrays rather than the raw lines
+            read_ahead = 2 * workers
+            pending = deque()
+            for chunk in read_chunks(paths, chunk_lines):
+                pending.append(pool.submit(decode_lines, chunk))
+                if len(pending) >= read_ahead:
+                    block, errors = pending.popleft().result()
+                    blocks.append(block)
+                    skipped += errors
+            while pending:
+                block, errors = pending.popleft().result()
+                blocks.append(block)
+                skipped += errors
+    decoded = time.perf_counter()
+
+    block = sort_unique(np.concatenate(blocks) if blocks else np.empty((0, 5)))
+    counts = {'lines_skipped': skipped, 'readings': len(block), 'duplicates': 0, 'gap_rows': 0, 'inserted': 0}
+    if len(block) == 0:
+        logger.debug('Nothing to import')
+        return counts
+
+    # the stored records take part in gap filling but are never overwritten
+    stored = existing_records(connection.cursor(), station_id, int(block[0, 0]), int(block[-1, 0]))
+    is_new = ~np.isin(block[:, 0], stored[:, 0])
+    counts['duplicates'] = int((~is_new).sum())
+    combined = sort_unique(np.concatenate([stored, block[is_new]]))
+    new_ts = block[is_new, 0]
+
+    if gap_fill:
+        records, interpolated = fill_gaps(combined)
+    else:
+        records, interpolated = combined, np.zeros(len(combined), dtype=bool)
+    keep = interpolated | np.isin(records[:, 0], new_ts)
+    records, interpolated = records[keep], interpolated[keep]
+    counts['gap_rows'] = int(interpolated.sum())
+    prepared = time.perf_counter()
+
+    counts['inserted'] = write_records(connection, station_id, records, interpolated, logger, write_rows)
+    logger.debug(f'Import done - {counts}, seconds decode: {decoded - start:.1f}, prepare: {prepared - decoded:.1f}, write: {time.perf_counter() - prepared:.1f}')
+    return counts
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Import recorded weatherstem messages (JSONL, one message per line) into a SQLite_WSS_Data database.')
+    parser.add_argument('database_path')
+    parser.add_argument('paths', nargs='+', help='JSONL files, imported as one batch')
+    parser.add_argument('--station-id', required=True, help='station_id the messages were received for')
+    parser.add_argument('--workers', type=int, default=None, help='decoder processes, default one per CPU, 1 decodes in this process')
+    parser.add_argument('--backend', default='auto', choices=('auto',) + ReadingDecoder.BACKENDS)
+    parser.add_argument('--no-gap-fill', action='store_true', help='insert the recorded readings only, without interpolating time gaps')
+    parser.add_argument('--write-rows', type=int, default=WRITE_ROWS, help='records inserted per transaction')
+    args = parser.parse_args()
+
+    logger = PrintLogger()
+    connection = sqlite3.connect(args.database_path, timeout=STORAGE_PROFILE['busy_timeout'] / 1000, isolation_level=None)
+    try:
+        apply_storage_profile(connection, STORAGE_PROFILE)
+        check_schema(connection, args.station_id, logger)
+        import_files(connection, args.paths, args.station_id, logger, workers=args.workers, backend=args.backend,
+                     gap_fill=not args.no_gap_fill, write_rows=args.write_rows)
+    except (sqlite3.Error, SchemaVersionError, OSError, ValueError) as err:
+        print(f'Import failed: {err}')
+        sys.exit(1)
+    finally:
+        connection.close()
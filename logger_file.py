@@ -1,9 +1,48 @@
-import logging
-from logging.handlers import TimedRotatingFileHandler
-
+import queue, atexit, logging, threading, time
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+
+# QueueHandler that hands records to the listener thread unformatted, the message is only built from its args when it is written
+class DeferredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        return record
+
+##### RateLimiter class allowing at most burst records per interval seconds for each debug category.
+##### Categories without a limit are always allowed. The number of records suppressed in a window is reported with the next allowed one.
+class RateLimiter:
+
+    def __init__(self, limits=None):
+        # category -> (interval, burst)
+        self.limits = dict(limits or {})
+        # category -> [window_start, count, suppressed]
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def allow(self, category):
+        # Returns (allowed, suppressed since the last allowed record)
+        limit = self.limits.get(category)
+        if limit is None:
+            return True, 0
+        interval, burst = limit
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(category)
+            if window is None or now - window[0] >= interval:
+                suppressed = window[2] if window is not None else 0
+                self.windows[category] = [now, 1, 0]
+                return True, suppressed
+            if window[1] < burst:
+                window[1] += 1
+                suppressed, window[2] = window[2], 0
+                return True, suppressed
+            window[2] += 1
+            return False, 0
+
+##### CustomLogger class writing through a QueueHandler to a QueueListener thread, so the caller never waits on the log file.
+##### Messages take %-style args that are only formatted on the listener thread, and only for records that pass the level check.
 class CustomLogger:
     
-    def __init__(self, name=None, clear_log=False, level=logging.NOTSET):
+    def __init__(self, name=None, clear_log=False, level=logging.NOTSET, rate_limits=None):
         
         self.file_path = './debug/debug.txt'
         
@@ -30,37 +69,71 @@ class CustomLogger:
 
         # Set the logging level for the handler to DEBUG as well
         self.handler.setLevel(level)
-        # Add the handler to the logger
-        self.logger.addHandler(self.handler)
-        
-    def log(self, message, level=logging.DEBUG):
+
+        # The logger only puts records on a queue, the listener thread formats and writes them with the file handler
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = DeferredQueueHandler(self.queue)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = QueueListener(self.queue, self.handler, respect_handler_level=True)
+        self.listener.start()
+        # records still queued at interpreter exit are written out
+        atexit.register(self.stop_listener)
+
+        # category -> (interval seconds, burst), see RateLimiter
+        self.rate_limiter = RateLimiter(rate_limits)
+
+    def enabled(self, level=logging.DEBUG):
+        # Cheap level check for call sites that would do extra work to build a message
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, message, args, category):
+        if not self.logger.isEnabledFor(level):
+            return
+        if category is not None:
+            allowed, suppressed = self.rate_limiter.allow(category)
+            if not allowed:
+                return
+            if suppressed:
+                message = f'{message} [{suppressed} {category} messages suppressed]'
+        # stacklevel 3 attributes the record to the caller of debug(), info(), ... rather than to this class
+        self.logger.log(level, message, *args, stacklevel=3)
+
+    def log(self, message, level=logging.DEBUG, *args, category=None):
         # Log a message with the specified log level
-        self.logger.log(level, message)
+        self._log(level, message, args, category)
 
-    def debug(self, message):
-        # Log a message with DEBUG level
-        self.log(message, logging.DEBUG)
+    def debug(self, message, *args, category=None):
+        # Log a message with DEBUG level, args are formatted into message with % only if the record is written
+        self._log(logging.DEBUG, message, args, category)
 
-    def info(self, message):
+    def info(self, message, *args, category=None):
         # Log a message with INFO level
-        self.log(message, logging.INFO)
+        self._log(logging.INFO, message, args, category)
 
-    def warning(self, message):
+    def warning(self, message, *args, category=None):
         # Log a message with WARNING level
-        self.log(message, logging.WARNING)
+        self._log(logging.WARNING, message, args, category)
 
-    def error(self, message):
+    def error(self, message, *args, category=None):
         # Log a message with ERROR level
-        self.log(message, logging.ERROR)
+        self._log(logging.ERROR, message, args, category)
 
-    def critical(self, message):
+    def critical(self, message, *args, category=None):
         # Log a message with CRITICAL level
-        self.log(message, logging.CRITICAL)
+        self._log(logging.CRITICAL, message, args, category)
+
+    def stop_listener(self):
+        # Write out the queued records and stop the listener thread, safe to call more than once
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.logger.removeHandler(self.queue_handler)
+            self.handler.close()
 
     def close(self, message='Closing logger.'):
         # Close the logger when you're done
         self.log(message, logging.DEBUG)
-        self.handler.close()
+        self.stop_listener()
 
 ########## unused and archived code ##########
 
@@ -5,39 +5,130 @@ SQLite_WSS_Data main script file
 - manage received data and database
 '''
 
-import sys, copy, time, json, traceback
+import sys, copy, time, traceback
+# startup phases are timed from here, see mark_startup()
+startup_start = time.perf_counter()
 from logger_file import logging, CustomLogger
-from flag_manager import FlagManager
 from process_lock import ProcessLock
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
+from db_writer import DatabaseWriter
+from spool import ReadingSpool
+from decoder import ReadingDecoder, DecodeError
+from storage import STORAGE_PROFILE, apply_storage_profile
+from retention import RetentionEngine
+from schema import check_schema, SchemaVersionError, INSERT_OR_IGNORE_SQL, UPSERT_SQL, READINGS_VIEW
+from rollups import RollupTables
+from ring_buffer import RecentReadings
+from reorder import ReorderBuffer
+from metrics import Metrics, MetricsExporter
+from backoff import Backoff
+from scheduler import LoopScheduler
+from gaps import GAP_THRESHOLD, missed_readings, interpolate_gap
+from common import COLUMNS, READING_INTERVAL
 import datetime as dt
-import numpy as np
-import jsonschema
 import contextlib
 import socket
 import asyncio
 import websockets
 import sqlite3
 
-wss_uri = 'wss://websockets.weatherstem.com?target=001D0A71267A'
+# stations to collect data from, keyed by station_id. One websocket connection per station runs in the same asyncio event loop.
+# The first station is the one assigned to records migrated from a database created before station_id was added.
+# Migration can also be run offline, see schema.py.
+stations = {
+    '001D0A71267A': 'wss://websockets.weatherstem.com?target=001D0A71267A',
+}
 
 database_path = '/Users/7alph/Documents/PyFiles/SQLite_WSS_Data/websocket_data.db'
 
+# SQLite storage profile (journal_mode, synchronous, cache_size, mmap_size, busy_timeout) applied to the writer connection.
+# Consumers should open read-only connections with storage.connect_read_only(database_path).
+storage_profile = STORAGE_PROFILE
+
+# group-commit settings for the database writer: commit once per commit_batch_size rows or every commit_interval_ms milliseconds
+commit_batch_size = 60
+commit_interval_ms = 1000
+# readings of batches that can't take the write lock within spool_lock_timeout_ms are appended to spool_path and replayed in order
+# once the lock frees, None disables the spool and batches wait up to busy_timeout for the lock
+spool_path = './spool/readings.spool'
+spool_lock_timeout_ms = 100
+
+# retention window: keep retention_days days of records (1 keeps today only), or when retention_rows is set the newest retention_rows records per station
+retention_days = 1
+retention_rows = None
+# expired records are deleted retention_chunk_size rows per transaction, a retention pass runs at midnight and every retention_interval_minutes
+retention_chunk_size = 2000
+retention_interval_minutes = 10
+# expiring records are archived to compressed per-day .npz files in archive_dir before they are deleted, None disables archiving
+archive_dir = './archive'
+
+# seconds each station's readings are held to put late and out of order readings back in ts order before they are written,
+# so gaps are only interpolated once the window confirms them. 0 writes readings as they arrive.
+reorder_window_seconds = 10
+
+# hours of the newest readings of each station kept in memory (ring_buffer.py) for recent-window reads, None disables it
+recent_hours = 1
+
+# local fan-out server rebroadcasting every decoded reading to WebSocket subscribers, fanout_host None disables it
+fanout_host = None # e.g. '127.0.0.1'
+fanout_port = 8765
+# messages buffered per subscriber, and what happens to a subscriber that falls behind: 'drop_oldest' or 'disconnect'
+fanout_queue_size = 100
+fanout_slow_consumer = 'drop_oldest'
+
+# reconnect delay in seconds after a dropped connection, doubling from reconnect_initial_delay up to reconnect_max_delay with jitter
+reconnect_initial_delay = 1
+reconnect_max_delay = 60
+
+# JSON backend used to decode received messages: 'auto' picks msgspec or orjson when installed, otherwise the stdlib 'json'
+decoder_backend = 'auto'
+
+# ingest metrics in the Prometheus text format, written to metrics_textfile every metrics_interval_seconds and/or served on
+# http://metrics_http_host:metrics_http_port/metrics. None disables either export, the metrics are always collected.
+metrics_textfile = None # e.g. './metrics/sqlite_wss.prom'
+metrics_interval_seconds = 15
+metrics_http_host = None # e.g. '127.0.0.1'
+metrics_http_port = 9108
+
+# logging level of debug/debug.txt, and debug categories logged at most burst times per interval seconds: {category: (interval, burst)}
+log_level = logging.NOTSET
+log_rate_limits = {
+    'time_gap': (60, 5),
+    'gap_fill': (60, 20),
+    'decode_error': (60, 5),
+    'db_error': (60, 10),
+}
+
 # global reference to database connection used to close connection on program exit
 db_connection = None
-# global reference to trim_scheduler (BackgroundScheduler instance) used to shutdown trim_scheduler on program exit
-trim_scheduler = None
+# global reference to the RollupTables instance kept up to date by the insert functions, None when rollups are not maintained
+rollup_tables = None
+# global reference to the RecentReadings ring buffers filled by the insert functions, None when disabled
+recent_readings = None
+# ReorderBuffer of each station, keyed by station_id
+reorder_buffers = {}
+# global reference to the FanoutServer instance publishing received readings, None when the fan-out server is disabled
+fanout_server = None
+# per-stage timings and counters of the ingest path, see metrics.py
+metrics = Metrics()
+# global reference to the LoopScheduler running maintenance jobs in the event loop, used to stop it on program exit
+maintenance_scheduler = None
+# startup phases already marked, the first station connection completes startup
+startup_phases = []
 
 # Function to establish a SQLite3 database connection
 def connect_to_database(): 
     global db_connection
 
     try:
-        connection = sqlite3.connect(database_path, timeout=5, isolation_level='IMMEDIATE')
+        # opened here, then used only from the DatabaseWriter's thread once the writer exists
+        connection = sqlite3.connect(database_path, timeout=storage_profile['busy_timeout'] / 1000, isolation_level='IMMEDIATE', check_same_thread=False)
         print_and_log(f'Connected to database: {database_path}')
         
         db_connection = connection
+
+        # this is the single writer connection, every write including retention deletes goes through it
+        applied = apply_storage_profile(connection, storage_profile)
+        logger.debug(f'Storage profile applied: {applied}')
         
         return database_create(connection)
 
@@ -48,36 +139,14 @@ def connect_to_database():
 def database_create(connection):
     # get the cursor for this instance
     cursor = connection.cursor()
-    # create table and index if they don't exist yet
-    create_table(cursor)
-    create_index(cursor)
-    # commit any changes to database
-    connection.commit()
-    return connection, cursor
-
-def create_table(cursor):
-    # Create a table to store received data
-    try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS websocket_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, 
-                ts INTEGER UNIQUE, 
-                temperature FLOAT, 
-                humidity FLOAT, 
-                dew_point FLOAT, 
-                heat_index FLOAT
-            )'''
-        )
-    except sqlite3.Error as err:
-        logger.debug(f'Error in create_table(): {err}')
-
-def create_index(cursor):
-    # Create index idx_ts on the ts column
+    # check PRAGMA user_version, creating the table or migrating an older layout in place as needed
     try:
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ts ON websocket_data (ts)')
-    except sqlite3.Error as err:
-        logger.debug(f'Error in create_index(): {err}')
+        version = check_schema(connection, next(iter(stations)), logger)
+    except SchemaVersionError as err:
+        print_and_log(f'Error in database_create(): {err}')
+        return None, None
+    logger.debug(f'Database schema version: {version}')
+    return connection, cursor
 
 def is_database_connected(connection):
 
@@ -100,273 +169,268 @@ def close_database_connection():
         except sqlite3.Error as err:
             logger.debug(f'Error closing the database connection: {err}')
 
-# Function to check for and fill time gaps in data before next data entry into database 
-def fill_time_gaps(next_data, cursor):
+# Function to check for and fill time gaps in a station's data before next data entry into database 
+def fill_time_gaps(station_id, next_data, cursor, cache):
     # get the timestamp being inserted next 
     next_ts = next_data[0]
     
-    last_data = get_latest_data(cursor)
+    # the latest record and record count are kept in memory by the cache, only query the database to (re)seed it
+    if not cache.seeded:
+        seed_reading_cache(station_id, cache, cursor)
+
+    last_data = cache.last
     
-    count = get_record_count(cursor)
+    count = cache.count
     
     # if record count is zero then this the database was reset at midnight. Insert a starting record for midnight.
     if count == 0 or last_data is None:
-        logger.debug(f'next_ts: {next_ts}, (count == 0 or last_data is None)')
+        logger.debug('station_id: %s, next_ts: %s, (count == 0 or last_data is None)', station_id, next_ts)
 
-        insert_midnight_record(next_data, cursor)    
-        fill_time_gaps(next_data, cursor)
+        insert_midnight_record(station_id, next_data, cursor, cache)    
+        # nothing was inserted, stop here rather than recurse forever
+        if cache.count == 0 or cache.last is None:
+            return
+        fill_time_gaps(station_id, next_data, cursor, cache)
         return
 
     # Check if there is only one record
     if count == 1 and last_data is not None:
-        logger.debug(f'next_ts: {next_ts}, (count == 1 and last_data is not None)')
-        insert_midnight_record(last_data, cursor)    
+        logger.debug('station_id: %s, next_ts: %s, (count == 1 and last_data is not None)', station_id, next_ts)
+        insert_midnight_record(station_id, last_data, cursor, cache)    
 
     # if last_data is None then something went wrong. Nothing to do but log the error and return
     if last_data is None:
-        logger.debug(f'next_ts: {next_ts}, problem in fill_time_gaps(). An empty database?')
+        logger.debug('next_ts: %s, problem in fill_time_gaps(). An empty database?', next_ts)
         return
 
     # Calculate the seconds elapsed since the last recorded entry
     time_gap = next_ts -  last_data[0]
 
-    if 5 < time_gap < 10:
-        logger.debug(f'Logging time_gap - Gap: {time_gap}')
+    if READING_INTERVAL < time_gap < 2 * READING_INTERVAL:
+        logger.debug('Logging time_gap - station_id: %s, Gap: %s', station_id, time_gap, category='time_gap')
 
-    if time_gap > 6:
-        # There is a time gap exceeding 6 seconds
-        # Calculate the number of missed readings
-        quotient = time_gap // 5
+    if time_gap > GAP_THRESHOLD:
+        # There is a time gap exceeding 6 seconds, count the missed readings with the rule shared with the importer and repair tools
+        missed_count = missed_readings(time_gap)
 
-        logger.debug(f'time gap exceeding 6 sec - Gap: {time_gap}, quotient: {quotient}')
+        logger.debug('time gap exceeding 6 sec - station_id: %s, Gap: %s, missed: %s', station_id, time_gap, missed_count, category='gap_fill')
 
-        if quotient > 1:
-            missed_count = quotient - 1
-        else:
+        if missed_count <= 0:
             return
 
-        insert_missed_readings(last_data, next_data, missed_count, cursor)
+        insert_missed_readings(station_id, last_data, next_data, missed_count, cursor, cache)
+
+def seed_reading_cache(station_id, cache, cursor):
+    cache.seed(get_latest_data(station_id, cursor), get_record_count(station_id, cursor))
+    logger.debug('Reading cache seeded - station_id: %s, count: %s, last: %s', station_id, cache.count, cache.last)
+
+# Function to load a station's newest records still within the ring buffer's window into it, so recent reads are served from memory after a restart
+def seed_recent_readings(station_id, cursor):
+    ring = recent_readings.ring(station_id)
+    cursor.execute(f'SELECT ts, temperature, humidity, dew_point, heat_index FROM {READINGS_VIEW} WHERE station_id = ? ORDER BY ts DESC LIMIT ?', (station_id, ring.capacity))
+    ring.seed(reversed(cursor.fetchall()))
+    logger.debug('Recent readings seeded - station_id: %s, readings: %s', station_id, len(ring))
 
-def get_latest_data(cursor):
+def get_latest_data(station_id, cursor):
     try:
-        # Get the latest timestamp and data in the database
-        cursor.execute('SELECT ts, temperature, humidity, dew_point, heat_index FROM websocket_data WHERE ts = (SELECT MAX(ts) FROM websocket_data)')
+        # Get the latest timestamp and data in the database for the station
+        cursor.execute(f'SELECT ts, temperature, humidity, dew_point, heat_index FROM {READINGS_VIEW} WHERE station_id = ? ORDER BY ts DESC LIMIT 1', (station_id,))
         return cursor.fetchone()
     except sqlite3.Error as err:
         logger.debug(f'Error get_latest_data(): {err}')
         return None
 
-def get_record_count(cursor):
+def get_record_count(station_id, cursor):
     try:
-        cursor.execute('SELECT COUNT(*) FROM websocket_data')
+        cursor.execute('SELECT COUNT(*) FROM websocket_data WHERE station_id = ?', (station_id,))
         return cursor.fetchone()[0]
     except sqlite3.Error as err:
         logger.debug(f'Error get_record_count(): {err}')
         return 0
 
-def insert_midnight_record(record, cursor):
+def insert_midnight_record(station_id, record, cursor, cache):
 
     col_data = copy.deepcopy(list(record))
     col_data[0] = midnight_time()[0]
-    insert_db_record(col_data, cursor) 
-    logger.debug(f'Midnight Record - data: {col_data}')
+    # the midnight record is a copy of a real reading, rollups count it as interpolated
+    insert_db_record(station_id, col_data, cursor, cache, interpolated=True) 
+    logger.debug('Midnight Record - station_id: %s, data: %s', station_id, col_data)
 
-def insert_missed_readings(last_data, next_data, missed_count, cursor):
+def insert_missed_readings(station_id, last_data, next_data, missed_count, cursor, cache):
 
     last_ts, last_temperature, last_humidity, last_dew_point, last_heat_index = last_data
     next_ts, next_temperature, next_humidity, next_dew_point, next_heat_index = next_data
 
-    logger.debug(f'Missing readings - missed: {missed_count}')
-    logger.debug(f'Last readings - Last ts: {last_ts}, Last Temp: {last_temperature}, Last Humidity: {last_humidity}...')
-    logger.debug(f'Next readings - Next ts: {next_ts}, Next Temp: {next_temperature}, Next Humidity: {next_humidity}...')
+    logger.debug('Missing readings - station_id: %s, missed: %s, last ts: %s, temp: %s, humidity: %s, next ts: %s, temp: %s, humidity: %s',
+                 station_id, missed_count, last_ts, last_temperature, last_humidity, next_ts, next_temperature, next_humidity, category='gap_fill')
     
-    # Estimate the missed readings, interpolate between adjacent readings.
-    temperature_values = interpolate_values(last_temperature, next_temperature, num_values=missed_count)
-    humidity_values = interpolate_values(last_humidity, next_humidity, num_values=missed_count)
-    dew_point_values = interpolate_values(last_dew_point, next_dew_point, num_values=missed_count)
-    heat_index_values = interpolate_values(last_heat_index, next_heat_index, num_values=missed_count)
-    
-    # build a list of tuples for all missed records in the time gap
-    bulk_data = [
-    (
-        last_ts + ((i + 1) * 5),
-        temperature_values[i],
-        humidity_values[i],
-        dew_point_values[i],
-        heat_index_values[i],
-    )
-    for i in range(missed_count)
-    ]
-    
-    logger.debug(f'Insert missed records bulk data: {bulk_data}')
-    # insert missed records into the table
-    insert_bulk_records(bulk_data, cursor)
-
+    # Estimate the missed readings, interpolate between adjacent readings. One (missed_count x 5) array for all columns.
+    block = interpolate_gap(last_data, next_data)
+    validate_bulk_data(block)
 
-def interpolate_values(start_value, end_value, num_values=1):
-
-    if num_values <= 0:
-        raise ValueError('Number of values to interpolate must be at least 1')
-
-    if num_values == 1:
-        interpolated_value = (start_value + end_value) / 2
-        return np.round(np.array([interpolated_value]), 1)
-
-    # Calculate the step size for interpolation
-    step = (end_value - start_value) / (num_values + 1)
-    # Generate the interpolated values as a NumPy array
-    return np.round(np.array([start_value + step * (i + 1) for i in range(num_values)]), 1)
-
-def trim_database(trim_flag, cursor):
+    import numpy as np
+    # build a list of tuples for all missed records in the time gap, ts as int and values as float for sqlite3
+    bulk_data = list(zip(block[:, 0].astype(np.int64).tolist(), *block[:, 1:].T.tolist()))
     
-    if trim_flag.is_set():
-        return
-
-    midnight_ts, midnight, now = midnight_time()
-    logger.debug(f'trim_database() Time: {now}')
-    try:
-        # SQL DELETE statement to remove rows where timestamp is earlier than trim_limit
-        cursor.execute(f'DELETE FROM websocket_data WHERE ts < {midnight_ts}')
-        rows_deleted = cursor.rowcount
-    except sqlite3.Error as err:
-        logger.debug(f'Error in trim_database(): {err}')
-        return
-
-    trim_flag.set_flag()
-
-    logger.debug(f'trim_database() rows_deleted: {rows_deleted}')
-
-def trim_operation():
-
-    midnight_ts, midnight, now = midnight_time()
-    logger.debug(f'trim_operation() Time: {now}')
-
-    try:
-        connection = sqlite3.connect(database_path, timeout=5, isolation_level='IMMEDIATE')
-        cursor = connection.cursor()
-    except sqlite3.Error as err:
-        logger.debug(f'Error connecting to the database: {err}')
-        return
+    # the interpolated records themselves aren't logged, only the range they cover
+    logger.debug('Insert missed records - station_id: %s, records: %s, ts: %s..%s', station_id, len(bulk_data), bulk_data[0][0], bulk_data[-1][0], category='gap_fill')
+    # insert missed records into the table
+    insert_bulk_records(station_id, bulk_data, cursor, cache)
 
-    try:
-        # SQL DELETE statement to remove rows where timestamp is earlier than trim_limit
-        cursor.execute(f'DELETE FROM websocket_data WHERE ts < {midnight_ts}')
-        rows_deleted = cursor.rowcount
-        connection.commit()
-    except sqlite3.Error as err:
-        logger.debug(f'Error in trim_operation(): {err}')
-        return
-    # Close the database connection
-    connection.close()
 
-    logger.debug(f'trim_operation() rows_deleted: {rows_deleted}')
+# Function run every second by the maintenance scheduler, releases readings held past the reorder window of stalled stations
+def release_reorder_buffers(writer):
+    for station_id, reorder in reorder_buffers.items():
+        for ready, received_at in reorder.release_due():
+            writer.put(station_id, ready, received_at)
 
-def start_trim_scheduler():
-    global trim_scheduler
+def start_maintenance_scheduler(retention, exporter, writer):
+    global maintenance_scheduler
 
-    if trim_scheduler is not None:
-        trim_scheduler.shutdown()
+    if maintenance_scheduler is not None:
+        maintenance_scheduler.stop()
 
-    scheduler = BackgroundScheduler()
+    scheduler = LoopScheduler(logger, metrics=metrics)
 
-    midnight_trigger = CronTrigger(hour=0, minute=0)
-    midnight_trigger2 = CronTrigger(hour=0, minute=1)
+    # the scheduler only hands the retention pass to the writer, it never opens a second writer connection
+    scheduler.daily(0, 0, retention.schedule, name='retention_midnight')
+    scheduler.every(retention_interval_minutes * 60, retention.schedule, name='retention')
+    exporter.schedule(scheduler)
+    if reorder_window_seconds > 0:
+        scheduler.every(1, lambda: release_reorder_buffers(writer), name='reorder_release')
 
-    scheduler.add_job(trim_operation, trigger=midnight_trigger, misfire_grace_time=30)
-    scheduler.add_job(trim_operation, trigger=midnight_trigger2, misfire_grace_time=30)
-    
     scheduler.start()
 
-    trim_scheduler = scheduler
+    maintenance_scheduler = scheduler
     return scheduler
 
+# Function to record the time from startup_start to the end of a startup phase, in the log and the startup_seconds metric
+def mark_startup(phase):
+    if phase in startup_phases:
+        return
+    elapsed = time.perf_counter() - startup_start
+    startup_phases.append(phase)
+    metrics.set('startup_seconds', elapsed, phase=phase)
+    logger.debug(f'Startup phase {phase} done after {elapsed * 1000:.1f} ms')
+
 def midnight_time():
     now = dt.datetime.now()
     midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
     return int(midnight.timestamp()), midnight, now
 
-def get_column_data(data):
-
-    ts = int(data['ts'])
-    temp = round(data['polledConditions'][0]['temp'], 1)
-    hum = round(data['polledConditions'][0]['hum'], 1)
-    dew_point = round(data['polledConditions'][0]['dew_point'], 1)
-    heat_index = round(data['polledConditions'][0]['heat_index'], 1)
-    # return tuple of data columns 
-    return ts, temp, hum, dew_point, heat_index
-
-# Function to handle received JSON data and save it to the database
-def handle_received_data(data, trim_flag, connection, cursor):
-
-    col_data = get_column_data(data)
+# Function called by the DatabaseWriter to save received column data to the database. The writer commits once per batch.
+def handle_received_data(station_id, col_data, cursor, cache):
 
-    fill_time_gaps(col_data, cursor)    
-    insert_db_record(col_data, cursor)
-    trim_database(trim_flag, cursor)
+    start = time.perf_counter()
+    fill_time_gaps(station_id, col_data, cursor, cache)    
+    filled = time.perf_counter()
+    insert_db_record(station_id, col_data, cursor, cache)
+    metrics.observe('stage_seconds', filled - start, stage='fill_time_gaps')
+    metrics.observe('stage_seconds', time.perf_counter() - filled, stage='insert')
 
-    connection.commit()
+def insert_db_record(station_id, col_data, cursor, cache, interpolated=False):
+    if not interpolated and cache.take_interpolated(col_data[0]):
+        replace_interpolated_record(station_id, col_data, cursor, cache)
+        return
+    try:
+        # the sensor values are stored as integer tenths, encoded by the statement itself
+        cursor.execute(INSERT_OR_IGNORE_SQL, (station_id, *col_data))
+        if cursor.rowcount == 1:
+            cache.record_insert(col_data)
+            if interpolated:
+                # e.g. the midnight record, a real reading with the same ts that arrives late replaces it
+                cache.record_interpolated((col_data[0],))
+            if recent_readings is not None:
+                recent_readings.append(station_id, col_data)
+            if rollup_tables is not None:
+                rollup_tables.add(station_id, col_data, interpolated)
+        elif not interpolated:
+            metrics.inc('duplicates_ignored_total', station=station_id)
+    except sqlite3.Error as err:
+        logger.debug('Error inserting data into the database: %s', err, category='db_error')
 
-def insert_db_record(col_data, cursor):
+# Function to replace the values of an interpolated record with a real reading that arrived after the gap was filled
+def replace_interpolated_record(station_id, col_data, cursor, cache):
     try:
-        cursor.execute('INSERT OR IGNORE INTO websocket_data (ts, temperature, humidity, dew_point, heat_index) VALUES (?, ?, ?, ?, ?)', col_data)
+        cursor.execute(f'SELECT ts, temperature, humidity, dew_point, heat_index FROM {READINGS_VIEW} WHERE station_id = ? AND ts = ?', (station_id, col_data[0]))
+        old_data = cursor.fetchone()
+        cursor.execute(UPSERT_SQL, (station_id, *col_data))
+        if old_data is None:
+            # the interpolated record is gone, e.g. expired, the reading was inserted as a new record
+            cache.record_insert(col_data)
+            if rollup_tables is not None:
+                rollup_tables.add(station_id, col_data)
+        else:
+            cache.record_replace(col_data)
+            if rollup_tables is not None:
+                rollup_tables.replace(station_id, old_data, col_data)
+            metrics.inc('interpolated_replaced_total', station=station_id)
+        if recent_readings is not None and not recent_readings.replace(station_id, col_data):
+            recent_readings.append(station_id, col_data)
+        logger.debug('Interpolated record replaced by a late reading - station_id: %s, ts: %s', station_id, col_data[0], category='gap_fill')
     except sqlite3.Error as err:
-        logger.debug(f'Error inserting data into the database: {err}')
+        logger.debug('Error replacing an interpolated record: %s', err, category='db_error')
 
-def insert_bulk_records(bulk_data, cursor):
+def insert_bulk_records(station_id, bulk_data, cursor, cache):
     
     if len(bulk_data) <= 0:
         logger.debug('Nothing to do, empty list passed to insert_bulk_records()')
         return
     
-    validate_bulk_data(bulk_data)
-    
     try:
-        cursor.executemany('INSERT OR IGNORE INTO websocket_data (ts, temperature, humidity, dew_point, heat_index) VALUES (?, ?, ?, ?, ?)', bulk_data)
-        logger.debug(f'Bulk data insert of {cursor.rowcount} data records')
+        # leave out records already stored so exactly the inserted records are counted by the cache and rollups
+        cursor.execute('SELECT ts FROM websocket_data WHERE station_id = ? AND ts BETWEEN ? AND ?', (station_id, bulk_data[0][0], bulk_data[-1][0]))
+        existing = {row[0] for row in cursor.fetchall()}
+        if existing:
+            bulk_data = [record for record in bulk_data if record[0] not in existing]
+
+        cursor.executemany(INSERT_OR_IGNORE_SQL,
+                           [(station_id, *record) for record in bulk_data])
+        cache.record_bulk_insert(bulk_data, cursor.rowcount)
+        # these records are only estimates, a real reading with the same ts that arrives late replaces them
+        cache.record_interpolated(record[0] for record in bulk_data)
+        if recent_readings is not None:
+            recent_readings.extend(station_id, bulk_data)
+        metrics.inc('gap_rows_inserted_total', cursor.rowcount, station=station_id)
+        if rollup_tables is not None:
+            for record in bulk_data:
+                rollup_tables.add(station_id, record, True)
+        logger.debug('Bulk data insert of %s data records', cursor.rowcount, category='gap_fill')
     except sqlite3.Error as err:
-        logger.debug(f'Error inserting bulk data into the database: {err}')
+        logger.debug('Error inserting bulk data into the database: %s', err, category='db_error')
         
-def validate_bulk_data(bulk_data):
-    
-    schema = {
-        'type': 'array',
-        'items': {
-            'minItems': 5,
-            'maxItems': 5,
-            'items': {'type': 'number'}
-        }
-    }
-
-    jsonschema.validate(bulk_data, schema)
-
-    for record in bulk_data:
-        if not isinstance(record, tuple):
-            raise ValueError('Records in bulk_data must be tuples')
-    
-    for record in bulk_data:
-        if any(not isinstance(value, (int, float)) for value in record):
-            raise ValueError('All record values in bulk_data must be numeric')
+def validate_bulk_data(block):
+    # Cheap shape and dtype check of the interpolated block, no per-value Python loops
+    import numpy as np
+    if not isinstance(block, np.ndarray) or block.ndim != 2 or block.shape[1] != len(COLUMNS):
+        raise ValueError('bulk_data must be a (n x 5) array of records')
+
+    if block.dtype.kind != 'f':
+        raise ValueError('All record values in bulk_data must be numeric')
+
+    if not np.isfinite(block).all():
+        raise ValueError('All record values in bulk_data must be finite')
 
 def print_and_log(msg):
     print(msg)
     logger.debug(msg)
     
-def shutdown_trim_scheduler():
-    global trim_scheduler
-    if trim_scheduler is not None:
-        trim_scheduler.shutdown()
-        logger.debug('trim scheduler is shutdown')
-    trim_scheduler = None
+def shutdown_maintenance_scheduler():
+    global maintenance_scheduler
+    if maintenance_scheduler is not None:
+        maintenance_scheduler.stop()
+        logger.debug('maintenance scheduler is shutdown')
+    maintenance_scheduler = None
 
 # function called to cleanup, quit program and exit to command prompt
 def graceful_exit(code=0):
     # Stop asyncio coroutine loops that connect to WSS server and receive server data
     exit_event.set()
-    # Shutdown scheduler threads
-    shutdown_trim_scheduler()
+    # Stop the maintenance jobs
+    shutdown_maintenance_scheduler()
     # Close connection to SQLite3 database file
     close_database_connection()
-    # Release the process lock. This will close the file and delete the file from the system temp folder
+    # Release the process lock. This unlocks and closes the lock file, the file itself is kept in the system temp folder
     lock.release()
     # Close the logger handler
     logger.close(f'Closing logger, graceful_exit() called with code {code}')
@@ -376,19 +440,119 @@ def graceful_exit(code=0):
     sys.exit(0)
 
 ##### asyncio and websockets coroutines and functions below this line to handle connecting, receiving, and handling wss data from server
-async def connect_to_server(wss_uri, exit_event):
+async def run_stations(stations, exit_event):
     print_and_log('Running SQLite_WSS_Data...')
 
+    # one database connection, writer and maintenance scheduler are shared by all station connections
+    connection, cursor = connect_to_database()
+    if connection is None:
+        print_and_log('Unable to connect to database, exiting')
+        return
+    mark_startup('database')
+
+    decoder = ReadingDecoder(decoder_backend)
+    logger.debug(f'Message decoder backend: {decoder.backend}')
+
+    # readings left in the spool by a previous run are replayed before new ones
+    spool = ReadingSpool(spool_path, logger) if spool_path is not None else None
+    if spool is not None:
+        metrics.set('spool_depth', spool.depth)
+
+    # readings from every station are queued to the writer and committed in batches
+    writer = DatabaseWriter(connection, handle_received_data, logger,
+                            batch_size=commit_batch_size, batch_interval_ms=commit_interval_ms, metrics=metrics,
+                            spool=spool, lock_timeout_ms=spool_lock_timeout_ms)
+
+    # rollup buckets touched by a batch are upserted in the batch's transaction
+    global rollup_tables
+    rollup_tables = RollupTables(logger)
+    writer.add_pre_commit(rollup_tables.flush, rollup_tables.discard)
+    # seed the writer's reading caches once on the writer's thread, the write path keeps them up to date from here on
+    for station_id in stations:
+        await writer.call(seed_reading_cache, station_id, writer.cache_for(station_id), writer.cursor)
+    # recent readings are read from memory, see ring_buffer.py
+    global recent_readings
+    if recent_hours is not None:
+        recent_readings = RecentReadings(recent_hours)
+        for station_id in stations:
+            await writer.call(seed_recent_readings, station_id, writer.cursor)
+    mark_startup('caches')
+
+    # expired records are deleted in chunks by writer jobs, interleaved with ingest
+    archive = None
+    if archive_dir is not None:
+        from archive import DailyArchive
+        archive = DailyArchive(archive_dir, logger)
+    retention = RetentionEngine(writer, stations, logger, retention_days=retention_days, retention_rows=retention_rows, chunk_size=retention_chunk_size, archive=archive, metrics=metrics)
+
+    reorder_buffers.clear()
+    for station_id in stations:
+        reorder_buffers[station_id] = ReorderBuffer(reorder_window_seconds)
+
+    writer.start()
+    # run a retention pass at startup to expire records left from before the program was started
+    writer.submit(retention.start_pass)
+
+    # optional local fan-out of every decoded reading to WebSocket subscribers
+    global fanout_server
+    if fanout_host is not None:
+        from fanout import FanoutServer
+        fanout_server = FanoutServer(fanout_host, fanout_port, logger, queue_size=fanout_queue_size, slow_consumer=fanout_slow_consumer)
+        await fanout_server.start()
+
+    exporter = MetricsExporter(metrics, logger, textfile=metrics_textfile, interval=metrics_interval_seconds, http_host=metrics_http_host, http_port=metrics_http_port)
+    await exporter.start()
+    # retention passes and the metrics file are scheduled in this event loop
+    start_maintenance_scheduler(retention, exporter, writer)
+    mark_startup('services')
+
+    try:
+        # one connection coroutine per station, running concurrently in this event loop
+        await asyncio.gather(*(connect_to_server(station_id, wss_uri, writer, decoder, exit_event) for station_id, wss_uri in stations.items()))
+    finally:
+        if fanout_server is not None:
+            await fanout_server.stop()
+        await exporter.stop()
+        logger.debug('Shutting down maintenance scheduler and closing database connection')
+        shutdown_maintenance_scheduler()
+        # commit any held and queued readings before the database connection is closed
+        for station_id, reorder in reorder_buffers.items():
+            for ready, received_at in reorder.flush():
+                writer.put(station_id, ready, received_at)
+        await writer.stop()
+        if archive is not None:
+            # wait for an archive write in progress, its records are only deleted by the next retention pass
+            archive.close()
+        if spool is not None:
+            spool.close()
+        close_database_connection()
+
+async def connect_to_server(station_id, wss_uri, writer, decoder, exit_event):
+
     # Set the connection ping interval in seconds
     ping_interval = 30  # seconds
     # Set the connection ping timeout in seconds
     ping_timeout = 6  # seconds
 
+    backoff = Backoff(reconnect_initial_delay, reconnect_max_delay)
+    # perf_counter() of the moment the last connection was lost, None while connected or before the first connection
+    disconnected_at = None
+
     while not exit_event.is_set():    
         try:
             async with websockets.connect(wss_uri, ping_interval=ping_interval, ping_timeout=ping_timeout) as websocket:
                 print_and_log(f'Connected to server: {wss_uri}')
-                await handle_connection(websocket, exit_event)
+                mark_startup('first_connection')
+                if disconnected_at is not None:
+                    # time from losing the connection to being connected again, backoff delays included
+                    reconnect_seconds = time.perf_counter() - disconnected_at
+                    metrics.observe('reconnect_seconds', reconnect_seconds, station=station_id)
+                    logger.debug(f'Reconnected station {station_id} after {reconnect_seconds:.1f} seconds')
+                    disconnected_at = None
+                received = await handle_connection(station_id, websocket, writer, decoder, exit_event)
+                if received:
+                    # the link worked, the next drop starts over from the initial delay
+                    backoff.reset()
 
         except websockets.ConnectionClosed as err:
             print_and_log(f'WebSocket ConnectionClosed. {err} Attempting to reconnect...')
@@ -411,25 +575,29 @@ async def connect_to_server(wss_uri, exit_event):
             traceback.print_exc()
             logger.debug(f'Exception (connect_to_server): {err}')
 
-        print_and_log('Please wait...Attempting to reconnect to server')    
-        await asyncio.sleep(5)  # Wait for a few seconds before reconnecting
-
-    await websocket.close() 
-    
-    with contextlib.suppress(asyncio.CancelledError):
-        await exit_event.wait()
+        if exit_event.is_set():
+            break
+        if disconnected_at is None:
+            disconnected_at = time.perf_counter()
+
+        delay = backoff.next_delay()
+        print_and_log(f'Please wait...Attempting to reconnect to server for station: {station_id} in {delay:.1f} seconds')    
+        metrics.inc('reconnects_total', station=station_id)
+        # wait before reconnecting, returning straight away if exit_event is set meanwhile
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(exit_event.wait(), timeout=delay)
         
-async def handle_connection(websocket, exit_event):
-
-    connection, cursor = connect_to_database()
-    
-    trim_flag = FlagManager()
-    
-    start_trim_scheduler()
+# Function to receive and queue readings until the connection drops or exit_event is set, returns the number of readings received
+async def handle_connection(station_id, websocket, writer, decoder, exit_event):
 
+    reorder = reorder_buffers[station_id]
+    received_count = 0
     while not exit_event.is_set():
         try:
+            recv_start = time.perf_counter()
             message = await websocket.recv()
+            received = time.perf_counter()
+            metrics.observe('stage_seconds', received - recv_start, stage='recv')
             # Handle the received message
             
             # check if exit_event was set while awaiting message
@@ -437,20 +605,31 @@ async def handle_connection(websocket, exit_event):
                 logger.debug('The exit_event flag was set while awaiting message')
                 break
             
-            # Parse the received JSON data
+            # Decode the received JSON data into a Reading, malformed or partial messages are skipped
             try:
-                data = json.loads(message)
-            except json.JSONDecodeError as err:
-                logger.debug(f'Error decoding JSON: {err.msg}')
-                logger.debug(f'Dump of JSON received: {message}')
-                print('JSONDecodeError: Check log for details')
+                reading = decoder.decode(message)
+            except DecodeError as err:
+                logger.debug('Error decoding JSON: %s - Dump of JSON received: %.2000s', err, message, category='decode_error')
+                print('DecodeError: Check log for details')
+                metrics.inc('decode_errors_total', station=station_id)
                 continue
-
-            # Save the data to the SQLite3 database
-            handle_received_data(data, trim_flag, connection, cursor)
+            metrics.observe('stage_seconds', time.perf_counter() - received, stage='decode')
+            metrics.inc('readings_received_total', station=station_id)
+            metrics.set('last_reading_timestamp_seconds', reading.ts, station=station_id)
+
+            # Queue the data to be saved to the SQLite3 database, in ts order once the reorder window has passed
+            reordered = reorder.reordered
+            for ready, received_at in reorder.push(reading, received):
+                writer.put(station_id, ready, received_at)
+            if reorder.reordered > reordered:
+                metrics.inc('readings_reordered_total', station=station_id)
+            received_count += 1
+            # and push it to local subscribers straight from memory
+            if fanout_server is not None:
+                fanout_server.publish(station_id, reading)
 
         except websockets.ConnectionClosed as err:
-            # If the connection is closed, close database, exit the inner loop and allow the outer loop to attempt reconnection
+            # If the connection is closed, exit the inner loop and allow the outer loop to attempt reconnection
             print_and_log(f'websockets.ConnectionClosed in handle_connection: {err}')
             if err.code == 1006:
                 logger.debug('Error Code 1006: Connection closed due to a ping timeout')
@@ -472,29 +651,28 @@ async def handle_connection(websocket, exit_event):
             logger.debug(f'Exception (handle_connection): {err}')
             break
 
-    logger.debug('Shutting down trim_scheduler and closing database connection')
-    shutdown_trim_scheduler()
-    close_database_connection()
-
     await websocket.close() 
+    return received_count
 
 
 ############################## __main__ ##############################
 
 if __name__ == '__main__':
 
-    logger = CustomLogger(clear_log=False, level=logging.NOTSET )
+    logger = CustomLogger(clear_log=False, level=log_level, rate_limits=log_rate_limits)
     logger.debug('##### Starting in SQLite_WSS_Data, entering __main__ #####')
+    mark_startup('imports')
     
-    # use a lock file to ensure only one instance of this program is running
-    with ProcessLock('SQLite_WSS_Data.lock', logger) as lock:
+    # use a lock file to ensure only one instance of this program is running per database
+    with ProcessLock('SQLite_WSS_Data.lock', logger, shard=database_path) as lock:
+        mark_startup('lock')
         # create event flag to signal asyncio coroutine to end when flag is set 
         exit_event = asyncio.Event()
 
-        ##### Connect to wss server wss_uri in asyncio coroutine which serves as the main program loop.
+        ##### Connect to the wss server of each station in asyncio coroutines which serve as the main program loop.
         ##### Receive, handle and process data until exit_event flag is set for a graceful exit.
         try:
-            asyncio.run(connect_to_server(wss_uri, exit_event))
+            asyncio.run(run_stations(stations, exit_event))
 
         except KeyboardInterrupt:
             logger.debug('User aborted through keyboard (Ctrl + c)')
@@ -503,9 +681,9 @@ if __name__ == '__main__':
             logger.debug(f'The asyncio task was cancelled. {err}')
         except Exception as err:
             traceback.print_exc()
-            logger.debug(f'Exception in __main__ (try: connect_to_server): {err}')
+            logger.debug(f'Exception in __main__ (try: run_stations): {err}')
         finally:
-            logger.debug('connect_to_server() asyncio coroutine event loop is exiting')
+            logger.debug('run_stations() asyncio coroutine event loop is exiting')
             # Make attempt to release ProcessLock lock file. There is no effect if it has already been released
             lock.release()
 
@@ -0,0 +1,196 @@
+'''
+SQLite_WSS_Data ingest metrics
+- in-process counters, gauges and histograms, cheap enough to update on every message
+- exported in the Prometheus text format, to a periodically rewritten file and/or a local HTTP endpoint
+'''
+
+import os, time, bisect, asyncio, threading, contextlib
+
+PREFIX = 'sqlite_wss'
+# seconds, from 100 microseconds for a decode up to a minute for a stalled commit
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# histograms that don't measure seconds
+METRIC_BUCKETS = {'batch_size': (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)}
+
+# help text of every metric, metrics are listed in this order in the export
+METRIC_HELP = {
+    'stage_seconds': ('histogram', 'Time spent per ingest stage: recv, decode, fill_time_gaps, insert, trim, commit'),
+    'lock_wait_seconds': ('histogram', 'Time spent waiting for the SQLite write lock at the start of each batch'),
+    'ingest_lag_seconds': ('histogram', 'Time from a reading being received to its batch being committed'),
+    'reconnect_seconds': ('histogram', 'Time from losing a station connection to being connected again'),
+    'job_seconds': ('histogram', 'Run time of scheduled maintenance jobs'),
+    'batch_size': ('histogram', 'Items committed per DatabaseWriter batch'),
+    'readings_received_total': ('counter', 'Readings decoded and queued to the writer'),
+    'readings_committed_total': ('counter', 'Readings committed by the writer'),
+    'decode_errors_total': ('counter', 'Messages that could not be decoded'),
+    'duplicates_ignored_total': ('counter', 'Readings ignored because the station already had a record with their ts'),
+    'gap_rows_inserted_total': ('counter', 'Interpolated records inserted to fill time gaps'),
+    'retention_rows_deleted_total': ('counter', 'Records deleted by the retention engine'),
+    'archive_errors_total': ('counter', 'Days of expired records that could not be archived and were kept in the database'),
+    'reconnects_total': ('counter', 'WebSocket reconnect attempts'),
+    'lock_timeouts_total': ('counter', 'Batches that could not take the SQLite write lock within busy_timeout'),
+    'readings_reordered_total': ('counter', 'Readings that arrived with a ts older than one already received and were put back in order'),
+    'interpolated_replaced_total': ('counter', 'Interpolated records replaced by a real reading that arrived late'),
+    'commit_errors_total': ('counter', 'Batches rolled back because the commit failed'),
+    'spool_records_total': ('counter', 'Readings written to the spool because the database was locked'),
+    'spool_drained_total': ('counter', 'Spooled readings replayed into the database'),
+    'spool_depth': ('gauge', 'Readings in the spool waiting to be replayed'),
+    'spool_drain_rate': ('gauge', 'Readings per second replayed by the last spool drain'),
+    'writer_queue_depth': ('gauge', 'Items waiting in the DatabaseWriter queue after the last batch'),
+    'last_commit_timestamp_seconds': ('gauge', 'Unix time of the last successful commit'),
+    'last_reading_timestamp_seconds': ('gauge', 'ts of the last reading received per station'),
+    'startup_seconds': ('gauge', 'Seconds from the start of main.py to the end of each startup phase'),
+}
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # counts[i] is the number of values in (buckets[i - 1], buckets[i]], the last slot is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+##### Metrics class holding every metric, keyed by name and a sorted tuple of label pairs.
+##### Updated from the event loop thread (the receive loops) and the DatabaseWriter's thread (batches and jobs), under one lock.
+class Metrics:
+
+    def __init__(self, prefix=PREFIX, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(METRIC_BUCKETS.get(name, self.buckets))
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        families = {}
+        with self.lock:
+            for store in (self.histograms, self.counters, self.gauges):
+                for (name, labels), value in store.items():
+                    families.setdefault(name, []).append((labels, value))
+
+        order = list(METRIC_HELP) + sorted(name for name in families if name not in METRIC_HELP)
+        for name in order:
+            samples = families.get(name)
+            if not samples:
+                continue
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            full_name = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            for labels, value in sorted(samples, key=lambda sample: sample[0]):
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{full_name}_bucket{format_labels(labels, ("le", le))} {cumulative}')
+                    lines.append(f'{full_name}_sum{format_labels(labels)} {value.sum}')
+                    lines.append(f'{full_name}_count{format_labels(labels)} {value.count}')
+                else:
+                    lines.append(f'{full_name}{format_labels(labels)} {value}')
+
+        lines.append(f'# HELP {self.prefix}_start_time_seconds Unix time the process started collecting metrics')
+        lines.append(f'# TYPE {self.prefix}_start_time_seconds gauge')
+        lines.append(f'{self.prefix}_start_time_seconds {self.started}')
+        return '\n'.join(lines) + '\n'
+
+##### MetricsExporter class to publish Metrics as a Prometheus text file rewritten every interval seconds
+##### (for node_exporter's textfile collector) and/or on a local HTTP endpoint, http://host:port/metrics.
+class MetricsExporter:
+
+    def __init__(self, metrics, logger, textfile=None, interval=15, http_host=None, http_port=9108):
+        self.metrics = metrics
+        self.logger = logger
+        self.textfile = textfile
+        self.interval = max(1, interval)
+        self.http_host = http_host
+        self.http_port = http_port
+        self.server = None
+
+    async def start(self):
+        if self.http_host is not None:
+            self.server = await asyncio.start_server(self.handle_http, self.http_host, self.http_port)
+            self.logger.debug(f'Metrics endpoint listening on http://{self.http_host}:{self.http_port}/metrics')
+
+    def schedule(self, scheduler):
+        # Rewrite the text file every interval from a LoopScheduler, see scheduler.py
+        if self.textfile is not None:
+            self.write_textfile()
+            scheduler.every(self.interval, self.write_textfile, name='metrics_flush')
+
+    async def stop(self):
+        if self.textfile is not None:
+            # leave the final values behind
+            self.write_textfile()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def write_textfile(self):
+        # written to a temporary file and renamed, so a scrape never reads a partial file
+        try:
+            directory = os.path.dirname(self.textfile)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f'{self.textfile}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.metrics.render())
+            os.replace(tmp_path, self.textfile)
+        except OSError as err:
+            self.logger.debug(f'Error writing metrics file {self.textfile}: {err}')
+
+    async def handle_http(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # the headers are read and ignored
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+                status, body = '200 OK', self.metrics.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as err:
+            self.logger.debug(f'Metrics request failed: {err}')
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
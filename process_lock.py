@@ -1,38 +1,99 @@
-import os, sys, errno, time, tempfile
+import os, sys, json, time, hashlib, tempfile
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
 
 MAX_RETRIES = 5
-RETRY_DELAY = 0.5 # seconds
+RETRY_DELAY = 0.1 # seconds, only spent while another live process holds the lock, e.g. a previous instance still shutting down
+# byte locked on Windows, past the owner record so other processes can still read who holds the lock
+LOCK_OFFSET = 1 << 20
+
+# Function to build the lock file name of one station or database shard, e.g. lock_name('SQLite_WSS_Data.lock', database_path)
+def lock_name(lockfile_name, shard=None):
+    if shard is None:
+        return lockfile_name
+    base, ext = os.path.splitext(lockfile_name)
+    return f'{base}-{hashlib.sha1(str(shard).encode("utf-8")).hexdigest()[:12]}{ext}'
+
+def pid_alive(pid):
+    if fcntl is None:
+        # no cheap check without extra packages on Windows, the kernel lock alone decides
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
-##### ProcessLock (context manager) class to implement a file based process lock with retries and logging.
+##### ProcessLock (context manager) class to implement a process lock on an OS advisory lock (flock on POSIX, msvcrt.locking on Windows).
+##### The kernel drops the lock when the owning process dies, so a lock file left behind by a crash or kill -9 never blocks a restart.
+##### The owner's pid and start time are written to the lock file, and one lock can be taken per station or database shard.
 class ProcessLock:
 
-    def __init__(self, lockfile_name, logger):
-        self.lockfile_path = os.path.join(tempfile.gettempdir(), lockfile_name)
+    def __init__(self, lockfile_name, logger, shard=None):
+        self.lockfile_path = os.path.join(tempfile.gettempdir(), lock_name(lockfile_name, shard))
         self.logger = logger
+        self.shard = shard
         self.lock_file = None
 
     def __enter__(self):
         self.logger.debug(f'ProcessLock attempting to acquire lock file: {self.lockfile_path}')
         for i in range(MAX_RETRIES):
             attempt = i + 1
-            try:
-                self.lock_file = open(self.lockfile_path, 'x')
-                self.logger.debug(f'ProcessLock lock file acquired: {self.lockfile_path}')
+            if self.try_acquire():
                 break
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    self.logger.debug(f'Unexpected error in attempt {attempt} of {MAX_RETRIES} to acquire lock file: {e}')
-                    raise
-                self.logger.debug(f'ProcessLock failed to acquire lock file on attempt: {attempt} of {MAX_RETRIES}')
-                if attempt == MAX_RETRIES:
-                    print('Unable to acquire lock, process is already running.')
-                    print(f'Lock file, {self.lockfile_path}, already exists, exiting.')
-                    self.logger.debug(f'Exiting script! Lock file already exists: {self.lockfile_path}')
-                    self.logger.close('Closing logger instance from ProcessLock before sys.exit().')
-                    sys.exit(1)
-                time.sleep(RETRY_DELAY)        
+            owner = self.owner()
+            self.logger.debug(f'ProcessLock failed to acquire lock file on attempt: {attempt} of {MAX_RETRIES}, held by: {owner}')
+            if attempt == MAX_RETRIES:
+                print('Unable to acquire lock, process is already running.')
+                if owner is not None:
+                    print(f'Lock file, {self.lockfile_path}, is held by pid {owner.get("pid")}, exiting.')
+                self.logger.debug(f'Exiting script! Lock file is held: {self.lockfile_path}')
+                self.logger.close('Closing logger instance from ProcessLock before sys.exit().')
+                sys.exit(1)
+            time.sleep(RETRY_DELAY)
         return self
 
+    def try_acquire(self):
+        # Take the lock without blocking, returns False if another process holds it
+        lock_file = open(self.lockfile_path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(LOCK_OFFSET)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+
+        # the lock is ours, whatever the file still says about its previous owner is stale
+        previous = self.owner()
+        if previous is not None:
+            state = 'running' if pid_alive(previous.get('pid', -1)) else 'dead'
+            self.logger.debug(f'ProcessLock recovered a stale lock file of pid {previous.get("pid")} ({state}), started at {previous.get("started")}')
+
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(json.dumps({'pid': os.getpid(), 'started': time.time(), 'shard': self.shard}))
+        lock_file.flush()
+        self.lock_file = lock_file
+        self.logger.debug(f'ProcessLock lock file acquired: {self.lockfile_path}')
+        return True
+
+    def owner(self):
+        # Returns the {'pid', 'started', 'shard'} record in the lock file, None if there is none
+        try:
+            with open(self.lockfile_path, 'r') as f:
+                return json.loads(f.read(LOCK_OFFSET) or 'null')
+        except (OSError, ValueError):
+            return None
+
     def __exit__(self, exc_type, exc_value, traceback):
         self.release()
         if exc_type is not None:
@@ -45,8 +106,16 @@ class ProcessLock:
     def release(self):
         if self.lock_file:
             try:
+                # the file is kept, unlinking it would let a second process lock a new file while a third still holds the old one
+                self.lock_file.seek(0)
+                self.lock_file.truncate()
+                self.lock_file.flush()
+                if fcntl is not None:
+                    fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    self.lock_file.seek(LOCK_OFFSET)
+                    msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
                 self.lock_file.close()
-                os.unlink(self.lockfile_path)
                 self.lock_file = None
                 self.logger.debug(f'ProcessLock lock file released: {self.lockfile_path}')
             except OSError as e:
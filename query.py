@@ -0,0 +1,107 @@
+'''
+SQLite_WSS_Data query functions
+- read time ranges of websocket_data straight into NumPy column arrays
+- meant for a read-only connection, see storage.connect_read_only()
+'''
+
+import numpy as np
+from schema import READINGS_VIEW
+from common import COLUMNS, VALUE_COLUMNS
+
+FETCH_SIZE = 8192 # rows fetched per fetchmany() call
+
+def check_columns(columns):
+    columns = tuple(columns)
+    unknown = [column for column in columns if column not in COLUMNS]
+    if unknown:
+        raise ValueError(f'Unknown columns: {unknown}')
+    return columns
+
+def empty_arrays(columns, size):
+    return {column: np.empty(size, dtype=np.int64 if column == 'ts' else np.float64) for column in columns}
+
+def fill_arrays(cursor, columns, size):
+    # Copy the cursor's rows into preallocated column arrays one fetchmany() block at a time, returns the arrays trimmed to the rows read
+    arrays = empty_arrays(columns, size)
+    filled = 0
+    while filled < size:
+        rows = cursor.fetchmany(min(FETCH_SIZE, size - filled))
+        if not rows:
+            break
+        block = np.array(rows, dtype=np.float64)
+        for i, column in enumerate(columns):
+            arrays[column][filled:filled + len(rows)] = block[:, i]
+        filled += len(rows)
+    return {column: array[:filled] for column, array in arrays.items()}
+
+# Function to read a station's records with start_ts <= ts < end_ts, returns {column: array} in ts order.
+# With recent (a RecentReadings from ring_buffer.py) a range it still holds is returned from memory as views, without a query.
+def get_range(connection, station_id, start_ts, end_ts, columns=COLUMNS, recent=None):
+    columns = check_columns(columns)
+    if recent is not None and recent.ring(station_id).covers(start_ts):
+        return recent.get_range(station_id, start_ts, end_ts, columns)
+    cursor = connection.cursor()
+    # one read transaction so the count and the rows come from the same snapshot
+    own_transaction = not connection.in_transaction
+    if own_transaction:
+        cursor.execute('BEGIN')
+    try:
+        cursor.execute('SELECT COUNT(*) FROM websocket_data WHERE station_id = ? AND ts >= ? AND ts < ?', (station_id, start_ts, end_ts))
+        size = cursor.fetchone()[0]
+        cursor.execute(f'SELECT {", ".join(columns)} FROM {READINGS_VIEW} WHERE station_id = ? AND ts >= ? AND ts < ? ORDER BY ts', (station_id, start_ts, end_ts))
+        return fill_arrays(cursor, columns, size)
+    finally:
+        if own_transaction:
+            cursor.execute('COMMIT')
+
+# Function to read a station's newest n records, returns {column: array} in ts order. recent as for get_range().
+def get_latest(connection, station_id, n, columns=COLUMNS, recent=None):
+    columns = check_columns(columns)
+    if recent is not None and len(recent.ring(station_id)) >= n:
+        return recent.get_latest(station_id, n, columns)
+    cursor = connection.cursor()
+    cursor.execute(f'SELECT {", ".join(columns)} FROM {READINGS_VIEW} WHERE station_id = ? ORDER BY ts DESC LIMIT ?', (station_id, n))
+    arrays = fill_arrays(cursor, columns, n)
+    return {column: array[::-1] for column, array in arrays.items()}
+
+# Function to average a station's records into step second buckets, on a grid aligned to step (ts % step == 0).
+# Every bucket is whole: the range is widened to the bucket holding start and the bucket holding end - 1, so the first and last
+# buckets may average records before start and from end on. Returns {'ts': bucket starts, 'count': records per bucket, column: mean},
+# empty buckets are NaN. Steps that are whole minutes or hours read the rollup tables instead of the 5-second records.
+def resample(connection, station_id, start, end, step, columns=VALUE_COLUMNS):
+    columns = tuple(column for column in check_columns(columns) if column != 'ts')
+    step = int(step)
+    if step <= 0:
+        raise ValueError('step must be at least 1 second')
+
+    first = start - start % step
+    last = end + (-end) % step
+    grid = np.arange(first, last, step, dtype=np.int64)
+
+    if step % 60 == 0:
+        table = 'rollup_1h' if step % 3600 == 0 else 'rollup_1m'
+        sums = ', '.join(f'SUM({column}_sum)' for column in columns)
+        sql = f'''SELECT bucket_ts - bucket_ts % ? AS bucket, SUM(count), {sums} FROM {table}
+                  WHERE station_id = ? AND bucket_ts >= ? AND bucket_ts < ? GROUP BY bucket ORDER BY bucket'''
+    else:
+        sums = ', '.join(f'SUM({column})' for column in columns)
+        sql = f'''SELECT ts - ts % ? AS bucket, COUNT(*), {sums} FROM {READINGS_VIEW}
+                  WHERE station_id = ? AND ts >= ? AND ts < ? GROUP BY bucket ORDER BY bucket'''
+
+    rows = connection.execute(sql, (step, station_id, first, last)).fetchall()
+
+    result = {'ts': grid, 'count': np.zeros(len(grid), dtype=np.int64)}
+    for column in columns:
+        result[column] = np.full(len(grid), np.nan)
+    if not rows:
+        return result
+
+    block = np.array(rows, dtype=np.float64)
+    index = ((block[:, 0] - first) // step).astype(np.int64)
+    keep = (index >= 0) & (index < len(grid))
+    index, block = index[keep], block[keep]
+    counts = block[:, 1]
+    result['count'][index] = counts
+    for i, column in enumerate(columns):
+        result[column][index] = block[:, 2 + i] / counts
+    return result
@@ -0,0 +1,56 @@
+import time, heapq
+
+DEFAULT_WINDOW = 10 # seconds, two reading intervals
+
+##### ReorderBuffer class to hold one station's readings for a short reorder window and release them in ts order.
+##### A reading is released once a reading window seconds newer has arrived, or once it has been held window seconds,
+##### so a late or out of order reading lands in order and fill_time_gaps() only sees gaps that are really there.
+##### Readings are released as (reading, received_at) pairs, received_at from time.perf_counter() like DatabaseWriter.put() takes it.
+class ReorderBuffer:
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        # (ts, sequence, received_at, reading) entries, the sequence keeps equal ts in arrival order
+        self.heap = []
+        self.sequence = 0
+        self.newest_ts = None
+        # readings that arrived with a ts older than one already received
+        self.reordered = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, reading, now=None):
+        # Add a reading received at now, returns the (reading, received_at) pairs released by it in ts order.
+        # Without a window the reading is released at once.
+        now = time.perf_counter() if now is None else now
+        if self.window <= 0:
+            return [(reading, now)]
+        if self.newest_ts is not None and reading.ts < self.newest_ts:
+            self.reordered += 1
+        else:
+            self.newest_ts = reading.ts
+        heapq.heappush(self.heap, (reading.ts, self.sequence, now, reading))
+        self.sequence += 1
+        return self.release_due(now)
+
+    def release_due(self, now=None):
+        # Release every reading up to the newest one that is due, called on each push and periodically for a stalled station
+        if not self.heap:
+            return []
+        now = time.perf_counter() if now is None else now
+        cutoff = self.newest_ts - self.window
+        for ts, _, received_at, _ in self.heap:
+            if now - received_at >= self.window and ts > cutoff:
+                cutoff = ts
+        released = []
+        while self.heap and self.heap[0][0] <= cutoff:
+            _, _, received_at, reading = heapq.heappop(self.heap)
+            released.append((reading, received_at))
+        return released
+
+    def flush(self):
+        # Release everything held, e.g. on shutdown
+        released = [(reading, received_at) for _, _, received_at, reading in sorted(self.heap)]
+        self.heap = []
+        return released
@@ -0,0 +1,133 @@
+'''
+SQLite_WSS_Data gap repair tool
+- finds every time gap of a station over a time range in one LAG(ts) window scan and fills it with interpolated records
+- repairs gaps left by crashes, manual deletes or out of order readings, which fill_time_gaps() never sees as it only looks at the latest record
+- run directly, e.g. nightly: python repair.py websocket_data.db --dry-run
+'''
+
+import sys, time, sqlite3, argparse
+import datetime as dt
+import numpy as np
+from storage import STORAGE_PROFILE, apply_storage_profile
+from schema import SCHEMA_VERSION, get_user_version, SchemaVersionError, INSERT_SQL, READINGS_VIEW
+from common import PrintLogger, COLUMNS
+from rollups import RollupTables
+from gaps import GAP_THRESHOLD, interpolate_gaps, missed_readings
+
+MAX_TS = 2 ** 63 - 1
+
+def gap_sql():
+    previous = ', '.join(f'LAG({column}) OVER w AS prev_{column}' for column in COLUMNS)
+    return f'''
+        SELECT {", ".join(f"prev_{column}" for column in COLUMNS)}, {", ".join(COLUMNS)} FROM (
+            SELECT {previous}, {", ".join(COLUMNS)} FROM {READINGS_VIEW}
+            WHERE station_id = ? AND ts >= ? AND ts < ?
+            WINDOW w AS (ORDER BY ts)
+        ) WHERE ts - prev_ts > {GAP_THRESHOLD}'''
+
+# Function to find the gaps of a station with start_ts <= ts < end_ts in one scan.
+# Returns (before, after), g x 5 arrays of the records on either side of each gap. Values stored as NULL are NaN.
+def find_gaps(cursor, station_id, start_ts=0, end_ts=MAX_TS):
+    cursor.execute(gap_sql(), (station_id, start_ts, end_ts))
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 10)
+    return rows[:, :5], rows[:, 5:]
+
+# Function to repair the gaps of one station, inserting every interpolated record with one executemany(). Does not commit.
+# Returns a report of the gaps found and the records inserted, or that would be inserted with dry_run.
+def repair_station(cursor, station_id, logger, start_ts=0, end_ts=MAX_TS, max_gap=None, dry_run=False):
+    before, after = find_gaps(cursor, station_id, start_ts, end_ts)
+    seconds = (after[:, 0] - before[:, 0]).astype(np.int64)
+    missed = missed_readings(seconds)
+
+    # gaps next to a record with NULL values can't be interpolated, and gaps longer than max_gap seconds are left alone when set
+    repairable = (missed > 0) & np.isfinite(before).all(axis=1) & np.isfinite(after).all(axis=1)
+    if max_gap is not None:
+        repairable &= seconds <= max_gap
+
+    report = {
+        'station_id': station_id,
+        'gaps': int(repairable.sum()),
+        'skipped_gaps': int((~repairable & (missed > 0)).sum()),
+        'rows': int(missed[repairable].sum()),
+        'inserted': 0,
+        'gap_list': [(int(b), int(a), int(m)) for b, a, m in zip(before[repairable, 0], after[repairable, 0], missed[repairable])],
+    }
+    if dry_run or report['rows'] == 0:
+        return report
+
+    filled = interpolate_gaps(before[repairable], after[repairable])
+    filled = filled[np.argsort(filled[:, 0], kind='stable')]
+    ts = filled[:, 0].astype(np.int64)
+    # the scan and the inserts run in the same write transaction, so none of these ts can exist yet
+    cursor.executemany(INSERT_SQL,
+                       zip([station_id] * len(filled), ts.tolist(), *filled[:, 1:].T.tolist()))
+    # the touched buckets are recomputed from the table rather than added to, they may still count records deleted by hand
+    RollupTables(logger).rebuild(cursor, station_id, ts, READINGS_VIEW)
+    report['inserted'] = len(filled)
+    return report
+
+# Function to repair every station, or the given ones, in a single transaction. Returns the report of each station.
+def repair_gaps(connection, logger, station_ids=None, start_ts=0, end_ts=MAX_TS, max_gap=None, dry_run=False):
+    start = time.perf_counter()
+    cursor = connection.cursor()
+    # dry runs only read, a repair takes the write lock before the scan so no reading can land in a gap being filled
+    connection.execute('BEGIN' if dry_run else 'BEGIN IMMEDIATE')
+    try:
+        if station_ids is None:
+            station_ids = [row[0] for row in cursor.execute('SELECT DISTINCT station_id FROM websocket_data')]
+        reports = [repair_station(cursor, station_id, logger, start_ts, end_ts, max_gap, dry_run) for station_id in station_ids]
+        connection.execute('ROLLBACK' if dry_run else 'COMMIT')
+    except sqlite3.Error:
+        connection.execute('ROLLBACK')
+        raise
+    logger.debug(f'Gap repair {"dry run " if dry_run else ""}done - stations: {len(reports)}, gaps: {sum(r["gaps"] for r in reports)}, '
+                 f'rows: {sum(r["rows"] for r in reports)}, seconds: {time.perf_counter() - start:.2f}')
+    return reports
+
+def format_ts(ts):
+    return dt.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+def parse_time(value):
+    # unix seconds or an ISO date/datetime in local time
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    return int(dt.datetime.fromisoformat(value).timestamp())
+
+def print_report(reports, dry_run, verbose):
+    for report in reports:
+        action = 'would insert' if dry_run else 'inserted'
+        count = report['rows'] if dry_run else report['inserted']
+        print(f'{report["station_id"]}: {report["gaps"]} gaps, {action} {count} records, {report["skipped_gaps"]} gaps skipped')
+        if verbose:
+            for before_ts, after_ts, missed in report['gap_list']:
+                print(f'    {format_ts(before_ts)} -> {format_ts(after_ts)}  {after_ts - before_ts:>8} s  {missed:>7} records')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Find and fill time gaps in a SQLite_WSS_Data database with interpolated records.')
+    parser.add_argument('database_path')
+    parser.add_argument('--station-id', action='append', help='station to repair, repeat for more, default every station in the database')
+    parser.add_argument('--start', help='repair from this time, unix seconds or ISO local time, e.g. 2023-10-01')
+    parser.add_argument('--end', help='repair up to (not including) this time')
+    parser.add_argument('--max-gap', type=int, help='leave gaps longer than this many seconds unfilled')
+    parser.add_argument('--dry-run', action='store_true', help='report the gaps without changing the database')
+    parser.add_argument('--verbose', action='store_true', help='list every gap')
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.database_path, timeout=STORAGE_PROFILE['busy_timeout'] / 1000, isolation_level=None)
+    try:
+        apply_storage_profile(connection, STORAGE_PROFILE)
+        version = get_user_version(connection)
+        if version != SCHEMA_VERSION:
+            # an older database needs the station_id of its records to migrate, see schema.py
+            raise SchemaVersionError(f'Database schema version {version} is not the current version {SCHEMA_VERSION}, migrate it with schema.py first')
+        reports = repair_gaps(connection, PrintLogger(), args.station_id, parse_time(args.start) or 0, parse_time(args.end) or MAX_TS,
+                              args.max_gap, args.dry_run)
+        print_report(reports, args.dry_run, args.verbose)
+    except (sqlite3.Error, SchemaVersionError, ValueError) as err:
+        print(f'Gap repair failed: {err}')
+        sys.exit(1)
+    finally:
+        connection.close()
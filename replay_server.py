@@ -0,0 +1,212 @@
+'''
+SQLite_WSS_Data replay server
+- stand-in for the weatherstem WSS server, replays recorded or synthetic payloads to local connections
+- gaps, duplicates and disconnects can be injected to exercise the gap fill and reconnect paths
+- run directly to serve: python replay_server.py --payloads recorded.jsonl --rate 0.2
+- or to record payloads from a real station: python replay_server.py --record wss://websockets.weatherstem.com?target=001D0A71267A --output recorded.jsonl
+'''
+
+import sys, json, random, asyncio, argparse
+import datetime as dt
+import websockets
+from common import query_param, PrintLogger, READING_INTERVAL
+
+
+def midnight_ts():
+    return int(dt.datetime.combine(dt.date.today(), dt.time()).timestamp())
+
+# Function to build count weatherstem style messages, one every READING_INTERVAL seconds from start_ts
+def synthetic_payloads(count, start_ts=None, seed=0):
+    rng = random.Random(seed)
+    ts = midnight_ts() if start_ts is None else start_ts
+    temp, hum = 70.0, 50.0
+    payloads = []
+    for _ in range(count):
+        # slow random walk so interpolation and rollups see plausible values
+        temp = min(110.0, max(-20.0, temp + rng.uniform(-0.2, 0.2)))
+        hum = min(100.0, max(5.0, hum + rng.uniform(-0.5, 0.5)))
+        dew_point = temp - (100.0 - hum) / 5
+        heat_index = temp + hum / 50
+        payloads.append(json.dumps({
+            'ts': ts,
+            'station': 'replay',
+            'polledConditions': [{'temp': round(temp, 1), 'hum': round(hum, 1), 'dew_point': round(dew_point, 1), 'heat_index': round(heat_index, 1),
+                                  'wind_speed': round(rng.uniform(0, 10), 1), 'wind_dir': rng.randrange(360), 'pressure': 29.92}],
+        }))
+        ts += READING_INTERVAL
+    return payloads
+
+# Function to load recorded messages, one raw message per line. With start_ts the ts of every message is shifted so the first one is start_ts.
+def load_payloads(path, start_ts=None):
+    with open(path, encoding='utf-8') as f:
+        payloads = [line.strip() for line in f if line.strip()]
+    if start_ts is None or not payloads:
+        return payloads
+
+    shifted = []
+    offset = None
+    for message in payloads:
+        try:
+            data = json.loads(message)
+            if offset is None:
+                offset = start_ts - int(data['ts'])
+            data['ts'] = int(data['ts']) + offset
+            shifted.append(json.dumps(data))
+        except (ValueError, KeyError, TypeError):
+            # malformed recordings are replayed as is, they exercise the decoder's error path
+            shifted.append(message)
+    return shifted
+
+# Function to append count messages received from a real station to path
+async def record_payloads(wss_uri, path, count):
+    async with websockets.connect(wss_uri) as websocket:
+        with open(path, 'a', encoding='utf-8') as f:
+            for i in range(count):
+                message = await websocket.recv()
+                if isinstance(message, bytes):
+                    message = message.decode('utf-8')
+                f.write(message.replace('\n', ' ') + '\n')
+                f.flush()
+                print(f'Recorded {i + 1}/{count}')
+
+##### ReplayServer class to serve payloads over WebSocket at rate messages per second, rate 0 sends as fast as the client reads.
+##### Each ?target=STATION_ID has its own position in the payloads, a reconnecting client resumes where it left off.
+##### gap_prob skips 1..max_gap messages, duplicate_prob sends a message twice, swap_prob sends the next message before this one,
+##### disconnect_every closes the connection every n messages.
+class ReplayServer:
+
+    def __init__(self, payloads, host='127.0.0.1', port=8780, logger=None, rate=0.2, gap_prob=0.0, max_gap=12, duplicate_prob=0.0, swap_prob=0.0, disconnect_every=0, seed=0):
+        self.payloads = payloads
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.rate = rate
+        self.gap_prob = gap_prob
+        self.max_gap = max(1, int(max_gap))
+        self.duplicate_prob = duplicate_prob
+        self.swap_prob = swap_prob
+        self.disconnect_every = disconnect_every
+        self.rng = random.Random(seed)
+        self.server = None
+        # target -> index of the next payload
+        self.positions = {}
+        # target -> asyncio.Event set once every payload was replayed
+        self.finished = {}
+        self.stats = {'sent': 0, 'skipped': 0, 'gaps': 0, 'duplicates': 0, 'swaps': 0, 'disconnects': 0, 'connections': 0}
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.debug(message)
+
+    def uri(self, target):
+        return f'ws://{self.host}:{self.port}/?target={target}'
+
+    def finished_event(self, target):
+        event = self.finished.get(target)
+        if event is None:
+            event = self.finished[target] = asyncio.Event()
+        return event
+
+    async def wait_finished(self, targets):
+        await asyncio.gather(*(self.finished_event(target).wait() for target in targets))
+
+    async def start(self):
+        self.server = await websockets.serve(self.handler, self.host, self.port)
+        self.log(f'Replay server listening on ws://{self.host}:{self.port}, payloads: {len(self.payloads)}')
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            self.log(f'Replay server stopped - {self.stats}')
+
+    async def handler(self, websocket):
+        target = query_param(websocket, 'target', '')
+        self.stats['connections'] += 1
+        self.log(f'Replay client connected: {websocket.remote_address}, target: {target}')
+
+        interval = 1 / self.rate if self.rate else 0
+        sent_on_connection = 0
+        try:
+            while self.positions.get(target, 0) < len(self.payloads):
+                position = self.positions.get(target, 0)
+
+                if self.gap_prob and self.rng.random() < self.gap_prob:
+                    # the messages of the gap are never sent, as if the station went quiet
+                    skip = min(self.rng.randint(1, self.max_gap), len(self.payloads) - position)
+                    self.positions[target] = position + skip
+                    self.stats['skipped'] += skip
+                    self.stats['gaps'] += 1
+                    continue
+
+                message = self.payloads[position]
+                self.positions[target] = position + 1
+                if self.swap_prob and position + 1 < len(self.payloads) and self.rng.random() < self.swap_prob:
+                    # the next message overtakes this one, as if this one was delayed on the way
+                    await websocket.send(self.payloads[position + 1])
+                    self.positions[target] = position + 2
+                    self.stats['sent'] += 1
+                    self.stats['swaps'] += 1
+                await websocket.send(message)
+                self.stats['sent'] += 1
+                if self.duplicate_prob and self.rng.random() < self.duplicate_prob:
+                    await websocket.send(message)
+                    self.stats['sent'] += 1
+                    self.stats['duplicates'] += 1
+
+                sent_on_connection += 1
+                if self.disconnect_every and sent_on_connection >= self.disconnect_every and self.positions[target] < len(self.payloads):
+                    self.stats['disconnects'] += 1
+                    await websocket.close(code=1012, reason='replay disconnect')
+                    return
+
+                # yields to the event loop even at rate 0 so every connection makes progress
+                await asyncio.sleep(interval)
+
+            # everything was replayed, stay connected and idle like a live server with no new readings
+            self.finished_event(target).set()
+            await websocket.wait_closed()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.log(f'Replay client disconnected: {websocket.remote_address}, target: {target}, position: {self.positions.get(target, 0)}')
+
+##### command line replay server and recorder
+async def serve_forever(server):
+    await server.start()
+    try:
+        await asyncio.Future()
+    finally:
+        await server.stop()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Replay weatherstem style payloads over WebSocket, or record them from a real station.')
+    parser.add_argument('--payloads', help='file of recorded messages, one per line, synthetic payloads are generated without it')
+    parser.add_argument('--count', type=int, default=17280, help='synthetic messages to generate, or messages to record')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8780)
+    parser.add_argument('--rate', type=float, default=0.2, help='messages per second, 0 sends as fast as the client reads')
+    parser.add_argument('--gap-prob', type=float, default=0.0)
+    parser.add_argument('--max-gap', type=int, default=12)
+    parser.add_argument('--duplicate-prob', type=float, default=0.0)
+    parser.add_argument('--swap-prob', type=float, default=0.0)
+    parser.add_argument('--disconnect-every', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='WSS_URI', help='record messages from WSS_URI to --output instead of serving')
+    parser.add_argument('--output', default='recorded.jsonl')
+    args = parser.parse_args()
+
+    try:
+        if args.record:
+            asyncio.run(record_payloads(args.record, args.output, args.count))
+            sys.exit(0)
+
+        payloads = load_payloads(args.payloads, midnight_ts()) if args.payloads else synthetic_payloads(args.count, seed=args.seed)
+        server = ReplayServer(payloads, args.host, args.port, PrintLogger(), rate=args.rate, gap_prob=args.gap_prob, max_gap=args.max_gap,
+                              duplicate_prob=args.duplicate_prob, swap_prob=args.swap_prob, disconnect_every=args.disconnect_every, seed=args.seed)
+        print(f'Connect with: {server.uri("001D0A71267A")}')
+        asyncio.run(serve_forever(server))
+    except KeyboardInterrupt:
+        pass
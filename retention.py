@@ -0,0 +1,184 @@
+import time, sqlite3
+import datetime as dt
+from collections import deque
+from flag_manager import FlagManager
+
+DEFAULT_CHUNK_SIZE = 2000 # rows deleted per chunk, each chunk is committed with one writer batch
+
+##### RetentionEngine class to delete expired records in bounded chunks interleaved with ingest.
+##### Records are kept for retention_days days (1 keeps today only) or, when retention_rows is set, the newest retention_rows records per station.
+class RetentionEngine:
+
+    def __init__(self, writer, stations, logger, retention_days=1, retention_rows=None, chunk_size=DEFAULT_CHUNK_SIZE, archive=None, metrics=None):
+        if retention_days is None and retention_rows is None:
+            raise ValueError('A retention window of retention_days or retention_rows is required')
+        self.writer = writer
+        self.stations = list(stations)
+        self.logger = logger
+        self.retention_days = retention_days
+        self.retention_rows = retention_rows
+        self.chunk_size = max(1, int(chunk_size))
+        # optional DailyArchive, expiring records are archived one day at a time and only deleted once the day file is written
+        self.archive = archive
+        # optional Metrics instance, each chunk is timed as the trim stage
+        self.metrics = metrics
+        # set while a pass is in progress so overlapping schedules don't start a second pass
+        self.running = FlagManager()
+        self.pending = deque()
+        self.pass_rows = 0
+        self.pass_chunks = 0
+        self.pass_start = 0.0
+
+    def schedule(self):
+        # Called by the maintenance scheduler, the pass itself runs as writer jobs
+        self.writer.submit(self.start_pass)
+
+    def cutoff_ts(self, station_id, cursor):
+        # Records with ts below the cutoff are expired, None when nothing can be expired
+        if self.retention_rows is not None:
+            cursor.execute('SELECT ts FROM websocket_data WHERE station_id = ? ORDER BY ts DESC LIMIT 1 OFFSET ?', (station_id, self.retention_rows - 1))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+        midnight = dt.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return int((midnight - dt.timedelta(days=self.retention_days - 1)).timestamp())
+
+    def start_pass(self, cursor, caches):
+        if self.running.is_set():
+            self.logger.debug('Retention pass already in progress')
+            return
+        self.running.set_flag()
+
+        try:
+            self.pending = deque((station_id, self.cutoff_ts(station_id, cursor)) for station_id in self.stations)
+        except sqlite3.Error as err:
+            self.logger.debug(f'Error computing retention cutoff: {err}')
+            self.running.clear_flag()
+            return
+
+        self.pass_rows = 0
+        self.pass_chunks = 0
+        self.pass_start = time.perf_counter()
+        if self.archive is not None:
+            self.archive_next_day(cursor, caches)
+        else:
+            self.run_chunk(cursor, caches)
+
+    def run_chunk(self, cursor, caches):
+        while self.pending:
+            station_id, cutoff = self.pending[0]
+            if cutoff is None:
+                self.pending.popleft()
+                continue
+
+            start = time.perf_counter()
+            try:
+                # ts of the first row past this chunk, None when the rest of the expired rows fit in one chunk
+                cursor.execute('SELECT ts FROM websocket_data WHERE station_id = ? AND ts < ? ORDER BY ts LIMIT 1 OFFSET ?', (station_id, cutoff, self.chunk_size))
+                row = cursor.fetchone()
+                bound = row[0] if row else cutoff
+                cursor.execute('DELETE FROM websocket_data WHERE station_id = ? AND ts < ?', (station_id, bound))
+                rows_deleted = cursor.rowcount
+            except sqlite3.Error as err:
+                self.logger.debug(f'Error in retention chunk for station {station_id}: {err}')
+                self.pending.popleft()
+                continue
+
+            if row is None:
+                self.pending.popleft()
+
+            if rows_deleted == 0:
+                continue
+
+            self.record_chunk(station_id, rows_deleted, bound, caches, start)
+
+            if self.pending:
+                # yield the write lock, the next chunk runs after the readings queued behind it are committed
+                self.writer.submit(self.run_chunk)
+                return
+
+        self.finish_pass()
+
+    def record_chunk(self, station_id, rows_deleted, bound, caches, start):
+        cache = caches.get(station_id)
+        if cache is not None:
+            cache.record_delete(rows_deleted, bound)
+
+        if self.metrics is not None:
+            self.metrics.observe('stage_seconds', time.perf_counter() - start, stage='trim')
+            self.metrics.inc('retention_rows_deleted_total', rows_deleted)
+
+        self.pass_rows += rows_deleted
+        self.pass_chunks += 1
+        self.logger.debug(f'Retention chunk - station_id: {station_id}, rows: {rows_deleted}, ms: {(time.perf_counter() - start) * 1000:.1f}')
+
+    def finish_pass(self):
+        self.running.clear_flag()
+        self.logger.debug(f'Retention pass done - rows: {self.pass_rows}, chunks: {self.pass_chunks}, ms: {(time.perf_counter() - self.pass_start) * 1000:.1f}')
+
+    ##### With an archive a pass runs one station day at a time: the day is read in a writer job, written and fsynced on the archive's
+    ##### thread while ingest carries on, and deleted in chunks by writer jobs once the file is on disk. A day whose file couldn't be
+    ##### written is not deleted, the station's expired records are left for the next pass.
+    def archive_next_day(self, cursor, caches):
+        while self.pending:
+            station_id, cutoff = self.pending[0]
+            if cutoff is None:
+                self.pending.popleft()
+                continue
+            try:
+                archive_day = self.archive.read_day(cursor, station_id, cutoff)
+            except (sqlite3.Error, ValueError) as err:
+                self.logger.debug(f'Error reading records to archive for station {station_id}: {err}')
+                self.pending.popleft()
+                continue
+            if archive_day is None:
+                self.pending.popleft()
+                continue
+            self.archive.write(archive_day, self.archived)
+            return
+
+        self.finish_pass()
+
+    def archived(self, archive_day, ok):
+        # Called on the archive's thread, the pass carries on in a writer job
+        if ok:
+            remaining = len(archive_day)
+            self.writer.submit(lambda cursor, caches: self.delete_archived(cursor, caches, archive_day, remaining))
+        else:
+            self.writer.submit(self.skip_station)
+
+    def skip_station(self, cursor, caches):
+        station_id, _ = self.pending.popleft()
+        if self.metrics is not None:
+            self.metrics.inc('archive_errors_total', station=station_id)
+        self.logger.debug(f'Retention pass skips station {station_id}, its expired records could not be archived')
+        self.archive_next_day(cursor, caches)
+
+    def delete_archived(self, cursor, caches, archive_day, remaining):
+        # Delete one chunk of an archived day, remaining is the number of its archived records still in the table
+        station_id, end = archive_day.station_id, archive_day.end
+        start = time.perf_counter()
+        try:
+            cursor.execute('SELECT COUNT(*) FROM websocket_data WHERE station_id = ? AND ts < ?', (station_id, end))
+            if cursor.fetchone()[0] != remaining:
+                # records were added to the day since it was read, e.g. by a gap repair, archive it again
+                self.archive_next_day(cursor, caches)
+                return
+            cursor.execute('SELECT ts FROM websocket_data WHERE station_id = ? AND ts < ? ORDER BY ts LIMIT 1 OFFSET ?', (station_id, end, self.chunk_size))
+            row = cursor.fetchone()
+            bound = row[0] if row else end
+            cursor.execute('DELETE FROM websocket_data WHERE station_id = ? AND ts < ?', (station_id, bound))
+            rows_deleted = cursor.rowcount
+        except sqlite3.Error as err:
+            self.logger.debug(f'Error in retention chunk for station {station_id}: {err}')
+            self.pending.popleft()
+            self.writer.submit(self.archive_next_day)
+            return
+
+        if rows_deleted:
+            self.record_chunk(station_id, rows_deleted, bound, caches, start)
+        # yield the write lock between chunks, the next one runs after the readings queued behind it are committed
+        if row is not None:
+            self.writer.submit(lambda cursor, caches: self.delete_archived(cursor, caches, archive_day, remaining - rows_deleted))
+        else:
+            self.writer.submit(self.archive_next_day)
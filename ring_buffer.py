@@ -0,0 +1,168 @@
+'''
+SQLite_WSS_Data in-memory ring buffer of recent readings
+- the last N hours of every station in fixed-capacity array columns, filled by the ingest path as records are inserted
+- O(1) appends and zero-copy NumPy views of any window, so "last hour" reads never touch the database
+- same {column: array} results as query.py
+'''
+
+import bisect, threading
+from array import array
+from common import COLUMNS, VALUE_COLUMNS, READING_INTERVAL
+
+DEFAULT_HOURS = 1
+MIN_TS = -2 ** 63
+
+##### ReadingRing class to hold one station's newest capacity readings in array columns, in ts order.
+##### Every reading is written twice, at i and i + capacity, so the newest n <= capacity readings are always one contiguous slice
+##### and can be handed out as views without copying. A view stays valid until capacity - n more readings are appended,
+##### or until a late reading is inserted before it.
+class ReadingRing:
+
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        # 2 * capacity zeroed 8-byte items per column
+        self.columns = {column: array('q' if column == 'ts' else 'd', bytes(8 * 2 * self.capacity)) for column in COLUMNS}
+        self.ts = self.columns['ts']
+        # index one past the newest reading in the first half, and the number of readings held
+        self.end = 0
+        self.size = 0
+        # every stored reading with ts >= complete_from is held, None until seed() loaded what the database holds
+        self.complete_from = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def append(self, col_data):
+        # Add one (ts, temperature, humidity, dew_point, heat_index) reading in ts order, returns False for a ts already held
+        # or one older than every reading of a full ring
+        with self.lock:
+            lo, hi = self.bounds()
+            index = bisect.bisect_left(self.ts, col_data[0], lo, hi)
+            if index < hi and self.ts[index] == col_data[0]:
+                return False
+            if index == lo and self.size == self.capacity:
+                return False
+            # a late reading takes the newer readings off and writes them back after it, it is rarely more than a few readings late
+            later = [tuple(column[i] for column in self.columns.values()) for i in range(index, hi)]
+            self.end -= len(later)
+            self.size -= len(later)
+            for reading in (col_data, *later):
+                self.push(reading)
+            return True
+
+    def push(self, col_data):
+        # Write col_data after the newest reading, dropping the oldest one from a full ring. Called with the lock held.
+        i = self.end % self.capacity
+        for column, value in zip(self.columns.values(), col_data):
+            column[i] = column[i + self.capacity] = value
+        self.end = i + 1
+        if self.size < self.capacity:
+            self.size += 1
+        elif self.complete_from is not None:
+            # the dropped reading is no longer held, the ring now only covers from its oldest reading
+            self.complete_from = max(self.complete_from, self.ts[self.bounds()[0]])
+
+    def extend(self, records):
+        for col_data in records:
+            self.append(col_data)
+
+    def seed(self, records):
+        # Load the newest stored readings, in ts order, before ingest starts. Fewer than capacity records means they are
+        # every reading stored, otherwise the ring covers from the oldest one loaded.
+        self.extend(records)
+        with self.lock:
+            self.complete_from = MIN_TS if self.size < self.capacity else self.ts[self.bounds()[0]]
+
+    def replace(self, col_data):
+        # Overwrite the values of the held reading with col_data's ts, returns False if the ring doesn't hold that ts
+        with self.lock:
+            lo, hi = self.bounds()
+            index = bisect.bisect_left(self.ts, col_data[0], lo, hi)
+            if index == hi or self.ts[index] != col_data[0]:
+                return False
+            # the same reading is held at index and at its mirror in the other half
+            mirror = index - self.capacity if index >= self.capacity else index + self.capacity
+            for column, value in zip(self.columns.values(), col_data):
+                column[index] = column[mirror] = value
+            return True
+
+    def bounds(self, n=None):
+        # (start, stop) of the newest n readings (all when None) in the column arrays
+        stop = self.end + self.capacity
+        n = self.size if n is None else max(0, min(n, self.size))
+        return stop - n, stop
+
+    def last(self):
+        # The newest reading as a tuple, None when empty
+        with self.lock:
+            if not self.size:
+                return None
+            i = self.end + self.capacity - 1
+            return tuple(column[i] for column in self.columns.values())
+
+    def views(self, start, stop, columns):
+        import numpy as np
+        return {column: np.frombuffer(self.columns[column], dtype=np.int64 if column == 'ts' else np.float64)[start:stop] for column in columns}
+
+    def get_latest(self, n, columns=COLUMNS):
+        # The newest n readings as {column: array} views in ts order
+        with self.lock:
+            start, stop = self.bounds(n)
+        return self.views(start, stop, columns)
+
+    def get_range(self, start_ts, end_ts, columns=COLUMNS):
+        # Readings with start_ts <= ts < end_ts as {column: array} views in ts order, limited to what the ring still holds
+        with self.lock:
+            lo, hi = self.bounds()
+            start = bisect.bisect_left(self.ts, start_ts, lo, hi)
+            stop = bisect.bisect_left(self.ts, end_ts, start, hi)
+        return self.views(start, stop, columns)
+
+    def covers(self, start_ts):
+        # True if every stored reading from start_ts on is held, i.e. a range from start_ts can be read from memory alone.
+        # Always False for a ring that wasn't seeded, it may be missing what the database held before ingest started.
+        with self.lock:
+            return self.complete_from is not None and start_ts >= self.complete_from
+
+    def summary(self, start_ts, end_ts, columns=VALUE_COLUMNS):
+        # {column: (count, mean, min, max)} of the readings with start_ts <= ts < end_ts, e.g. for rolling statistics
+        import numpy as np
+        arrays = self.get_range(start_ts, end_ts, columns)
+        result = {}
+        for column, values in arrays.items():
+            values = values[~np.isnan(values)]
+            result[column] = (len(values), float(values.mean()), float(values.min()), float(values.max())) if len(values) else (0, None, None, None)
+        return result
+
+##### RecentReadings class to hold one ReadingRing per station, sized for hours of readings at the 5 second reading interval.
+##### Appended to on the DatabaseWriter's thread, readable from any thread.
+class RecentReadings:
+
+    def __init__(self, hours=DEFAULT_HOURS, interval=READING_INTERVAL):
+        self.capacity = int(hours * 3600 / interval)
+        self.rings = {}
+
+    def ring(self, station_id):
+        ring = self.rings.get(station_id)
+        if ring is None:
+            ring = self.rings.setdefault(station_id, ReadingRing(self.capacity))
+        return ring
+
+    def append(self, station_id, col_data):
+        return self.ring(station_id).append(col_data)
+
+    def extend(self, station_id, records):
+        self.ring(station_id).extend(records)
+
+    def seed(self, station_id, records):
+        self.ring(station_id).seed(records)
+
+    def replace(self, station_id, col_data):
+        return self.ring(station_id).replace(col_data)
+
+    def get_latest(self, station_id, n, columns=COLUMNS):
+        return self.ring(station_id).get_latest(n, columns)
+
+    def get_range(self, station_id, start_ts, end_ts, columns=COLUMNS):
+        return self.ring(station_id).get_range(start_ts, end_ts, columns)
@@ -0,0 +1,225 @@
+import datetime as dt
+from common import VALUE_COLUMNS
+
+# rollup tables and their bucket size in seconds, None is a local calendar day
+RESOLUTIONS = (('rollup_1m', 60), ('rollup_1h', 3600), ('rollup_1d', None))
+FETCH_SIZE = 4096 # rows fetched per fetchmany() call by backfill()
+
+##### Each rollup bucket holds count, sum, min, max and last of every metric. count includes interpolated gap records,
+##### interpolated counts them separately, so avg = sum / count matches a scan of websocket_data.
+def create_rollup_tables(cursor):
+    metric_columns = ',\n'.join(f'{metric}_{stat} FLOAT' for metric in VALUE_COLUMNS for stat in ('sum', 'min', 'max', 'last'))
+    for table_name, _ in RESOLUTIONS:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                station_id TEXT NOT NULL,
+                bucket_ts INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                interpolated INTEGER NOT NULL,
+                last_ts INTEGER NOT NULL,
+                {metric_columns},
+                PRIMARY KEY (station_id, bucket_ts)
+            ) WITHOUT ROWID'''
+        )
+
+def rollup_columns():
+    columns = ['station_id', 'bucket_ts', 'count', 'interpolated', 'last_ts']
+    for metric in VALUE_COLUMNS:
+        columns += [f'{metric}_sum', f'{metric}_min', f'{metric}_max', f'{metric}_last']
+    return columns
+
+def upsert_sql(table_name):
+    columns = rollup_columns()
+    updates = ['count = count + excluded.count', 'interpolated = interpolated + excluded.interpolated']
+    for metric in VALUE_COLUMNS:
+        updates += [
+            f'{metric}_sum = {metric}_sum + excluded.{metric}_sum',
+            f'{metric}_min = min({metric}_min, excluded.{metric}_min)',
+            f'{metric}_max = max({metric}_max, excluded.{metric}_max)',
+            # every right hand side sees the old row, so last_ts here is the stored one
+            f'{metric}_last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.{metric}_last ELSE {metric}_last END',
+        ]
+    updates.append('last_ts = max(last_ts, excluded.last_ts)')
+    return (f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT (station_id, bucket_ts) DO UPDATE SET {", ".join(updates)}')
+
+def replace_sql(table_name):
+    # Overwrites a bucket with one recomputed from websocket_data
+    columns = rollup_columns()
+    return f'INSERT OR REPLACE INTO {table_name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+
+##### RollupTables class to maintain the rollup tables incrementally from the write path.
+##### Inserted records are accumulated in memory per bucket and flushed with one upsert per touched bucket, in the same transaction as the records.
+class RollupTables:
+
+    def __init__(self, logger):
+        self.logger = logger
+        # table_name -> {(station_id, bucket_ts): [count, interpolated, last_ts, sum, min, max, last for each metric...]}
+        self.pending = {table_name: {} for table_name, _ in RESOLUTIONS}
+        self.sql = {table_name: upsert_sql(table_name) for table_name, _ in RESOLUTIONS}
+        # local day containing the most recent record, avoids a datetime conversion per record
+        self.day_start = 0
+        self.day_end = 0
+
+    def day_bucket(self, ts):
+        if not self.day_start <= ts < self.day_end:
+            day = dt.date.fromtimestamp(ts)
+            self.day_start = int(dt.datetime.combine(day, dt.time()).timestamp())
+            self.day_end = int(dt.datetime.combine(day + dt.timedelta(days=1), dt.time()).timestamp())
+        return self.day_start
+
+    def add(self, station_id, col_data, interpolated=False):
+        # Called for each record actually inserted into websocket_data
+        ts = int(col_data[0])
+        values = col_data[1:]
+        for table_name, size in RESOLUTIONS:
+            bucket_ts = ts - ts % size if size else self.day_bucket(ts)
+            buckets = self.pending[table_name]
+            acc = buckets.get((station_id, bucket_ts))
+            if acc is None:
+                acc = [0, 0, ts]
+                for value in values:
+                    acc += [0.0, value, value, value]
+                buckets[(station_id, bucket_ts)] = acc
+            acc[0] += 1
+            acc[1] += interpolated
+            newest = ts >= acc[2]
+            if newest:
+                acc[2] = ts
+            for i, value in enumerate(values):
+                j = 3 + i * 4
+                acc[j] += value
+                if value < acc[j + 1]:
+                    acc[j + 1] = value
+                if value > acc[j + 2]:
+                    acc[j + 2] = value
+                if newest:
+                    acc[j + 3] = value
+
+    def replace(self, station_id, old_data, col_data):
+        # Called for a stored interpolated record whose values were replaced by a real reading with the same ts.
+        # count is unchanged, interpolated drops by one and sums take the difference. min and max only widen,
+        # the replaced values can't be taken out of them.
+        ts = int(col_data[0])
+        deltas = [new - old for new, old in zip(col_data[1:], old_data[1:])]
+        values = col_data[1:]
+        for table_name, size in RESOLUTIONS:
+            bucket_ts = ts - ts % size if size else self.day_bucket(ts)
+            buckets = self.pending[table_name]
+            acc = buckets.get((station_id, bucket_ts))
+            if acc is None:
+                acc = [0, 0, ts]
+                for value in values:
+                    acc += [0.0, value, value, value]
+                buckets[(station_id, bucket_ts)] = acc
+            acc[1] -= 1
+            newest = ts >= acc[2]
+            if newest:
+                acc[2] = ts
+            for i, value in enumerate(values):
+                j = 3 + i * 4
+                acc[j] += deltas[i]
+                if value < acc[j + 1]:
+                    acc[j + 1] = value
+                if value > acc[j + 2]:
+                    acc[j + 2] = value
+                if newest:
+                    acc[j + 3] = value
+
+    def flush(self, cursor):
+        # DatabaseWriter pre-commit hook, writes the accumulated buckets in the batch's transaction
+        for table_name, buckets in self.pending.items():
+            if buckets:
+                cursor.executemany(self.sql[table_name], [(station_id, bucket_ts, *acc) for (station_id, bucket_ts), acc in buckets.items()])
+                buckets.clear()
+
+    def discard(self):
+        # The batch was rolled back, drop what it accumulated
+        for buckets in self.pending.values():
+            buckets.clear()
+
+    def day_buckets(self, ts):
+        # Local midnight of every ts in a sorted int64 array, one datetime conversion per day rather than per record
+        import numpy as np
+        day = dt.date.fromtimestamp(int(ts[0]))
+        last_day = dt.date.fromtimestamp(int(ts[-1]))
+        midnights = []
+        while day <= last_day:
+            midnights.append(int(dt.datetime.combine(day, dt.time()).timestamp()))
+            day += dt.timedelta(days=1)
+        midnights = np.array(midnights, dtype=np.int64)
+        return midnights[np.searchsorted(midnights, ts, side='right') - 1]
+
+    def aggregate(self, ts, values, interpolated, size):
+        # Rows of (bucket_ts, count, interpolated, last_ts, sum, min, max, last for each metric...) of the records in each bucket of size seconds,
+        # None for local days. ts sorted ascending (int64), values (n x 4) and interpolated (bool).
+        import numpy as np
+        buckets = ts - ts % size if size else self.day_buckets(ts)
+        # ts is sorted so each bucket is one contiguous run of records
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(ts)] - 1
+        columns = [buckets[starts].tolist(), np.diff(np.r_[starts, len(ts)]).tolist(),
+                   np.add.reduceat(interpolated.astype(np.int64), starts).tolist(), ts[ends].tolist()]
+        sums = np.add.reduceat(values, starts, axis=0)
+        mins = np.minimum.reduceat(values, starts, axis=0)
+        maxs = np.maximum.reduceat(values, starts, axis=0)
+        lasts = values[ends]
+        for i in range(len(VALUE_COLUMNS)):
+            columns += [sums[:, i].tolist(), mins[:, i].tolist(), maxs[:, i].tolist(), lasts[:, i].tolist()]
+        return [list(row) for row in zip(*columns)]
+
+    def upsert_block(self, cursor, station_id, ts, values, interpolated):
+        # Vectorized add() and flush() for records already inserted, ts sorted ascending (int64), values (n x 4) and interpolated (bool)
+        # numpy is only imported by the bulk paths, the live ingest path doesn't need it
+        if len(ts) == 0:
+            return
+        for table_name, size in RESOLUTIONS:
+            cursor.executemany(self.sql[table_name], ((station_id, *row) for row in self.aggregate(ts, values, interpolated, size)))
+
+    def rebuild(self, cursor, station_id, ts, source):
+        # Recompute every bucket holding one of the interpolated records just inserted at ts (sorted int64) from the records in source,
+        # the decoded readings view. Unlike upsert_block() this doesn't add to the stored buckets, which still count rows deleted by hand.
+        # Interpolated records can't be told apart in the table, a bucket keeps its stored interpolated count plus the new records.
+        import numpy as np
+        if len(ts) == 0:
+            return
+        for table_name, size in RESOLUTIONS:
+            starts = np.unique(ts - ts % size if size else self.day_buckets(ts))
+            # a local day is 23 to 25 hours long, so 26 hours after a midnight is always in the next day
+            ends = starts + size if size else self.day_buckets(starts + 26 * 3600)
+            # adjacent buckets are read in one span
+            first = np.flatnonzero(np.r_[True, starts[1:] != ends[:-1]])
+            last = np.r_[first[1:], len(starts)] - 1
+            for span_start, span_end in zip(starts[first].tolist(), ends[last].tolist()):
+                cursor.execute(f'SELECT bucket_ts, interpolated FROM {table_name} WHERE station_id = ? AND bucket_ts >= ? AND bucket_ts < ?',
+                               (station_id, span_start, span_end))
+                stored = dict(cursor.fetchall())
+                cursor.execute(f'SELECT ts, {", ".join(VALUE_COLUMNS)} FROM {source} WHERE station_id = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                               (station_id, span_start, span_end))
+                rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 1 + len(VALUE_COLUMNS))
+                # records with NULL values are left out of the rollups, as in backfill()
+                rows = rows[np.isfinite(rows).all(axis=1)]
+                if not len(rows):
+                    continue
+                row_ts = rows[:, 0].astype(np.int64)
+                buckets = self.aggregate(row_ts, rows[:, 1:], np.isin(row_ts, ts), size)
+                for row in buckets:
+                    row[2] = min(row[1], row[2] + stored.get(row[0], 0))
+                cursor.executemany(replace_sql(table_name), ((station_id, *row) for row in buckets))
+
+    def backfill(self, cursor):
+        # Build the rollups from every record already in websocket_data, interpolated records can't be told apart here.
+        # Only run by the version 3 migration, before the sensor columns are stored as integer tenths (version 4).
+        rows = 0
+        read_cursor = cursor.connection.cursor()
+        read_cursor.execute('SELECT station_id, ts, temperature, humidity, dew_point, heat_index FROM websocket_data ORDER BY station_id, ts')
+        while True:
+            block = read_cursor.fetchmany(FETCH_SIZE)
+            if not block:
+                break
+            for row in block:
+                if None not in row:
+                    self.add(row[0], row[1:])
+            rows += len(block)
+            self.flush(cursor)
+        return rows
@@ -0,0 +1,68 @@
+import time, asyncio, inspect, contextlib
+import datetime as dt
+
+MAX_SLEEP = 60 # seconds, daily jobs re-check the wall clock at least this often so clock changes and suspends don't delay them
+
+##### LoopScheduler class to run maintenance jobs (retention, metrics flush, ...) from the asyncio event loop the ingest already runs in,
+##### without a scheduler thread. A job is a callable or a coroutine function, it should be quick or hand its work to the DatabaseWriter.
+class LoopScheduler:
+
+    def __init__(self, logger, metrics=None):
+        self.logger = logger
+        # optional Metrics instance, every run is timed by job name
+        self.metrics = metrics
+        # (name, job, next_delay()) entries, next_delay() returns the seconds until the job is due next
+        self.jobs = []
+        self.tasks = []
+
+    def every(self, seconds, job, name=None):
+        # Run job every seconds, the first run seconds after start()
+        seconds = max(0.001, seconds)
+        self.add(name or job.__name__, job, lambda: seconds)
+
+    def daily(self, hour, minute, job, name=None):
+        # Run job every day at hour:minute local time
+        def next_delay():
+            now = dt.datetime.now()
+            due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if due <= now:
+                due += dt.timedelta(days=1)
+            return (due - now).total_seconds()
+        self.add(name or job.__name__, job, next_delay, wall_clock=True)
+
+    def add(self, name, job, next_delay, wall_clock=False):
+        self.jobs.append((name, job, next_delay, wall_clock))
+        if self.tasks:
+            # added after start()
+            self.tasks.append(asyncio.create_task(self.run(name, job, next_delay, wall_clock)))
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run(*entry)) for entry in self.jobs]
+
+    def stop(self):
+        # Cancel every job, safe to call when the event loop has already stopped
+        for task in self.tasks:
+            with contextlib.suppress(RuntimeError):
+                task.cancel()
+        self.tasks = []
+
+    async def run(self, name, job, next_delay, wall_clock):
+        while True:
+            if wall_clock:
+                due = time.time() + next_delay()
+                while (remaining := due - time.time()) > 0:
+                    await asyncio.sleep(min(remaining, MAX_SLEEP))
+            else:
+                await asyncio.sleep(next_delay())
+
+            start = time.perf_counter()
+            try:
+                result = job()
+                if inspect.isawaitable(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                self.logger.debug(f'Error in scheduled job {name}: {err}')
+            if self.metrics is not None:
+                self.metrics.observe('job_seconds', time.perf_counter() - start, job=name)
@@ -0,0 +1,234 @@
+'''
+SQLite_WSS_Data schema version check and migration tool
+- PRAGMA user_version holds the schema version of a database
+- databases in an older layout are migrated in place, chunk by chunk, and an interrupted migration resumes where it stopped
+- run directly to migrate a database offline: python schema.py websocket_data.db --station-id 001D0A71267A
+'''
+
+import sys, time, sqlite3, argparse
+from rollups import create_rollup_tables, RollupTables
+from common import PrintLogger, VALUE_COLUMNS
+
+SCHEMA_VERSION = 4
+MIGRATION_CHUNK_SIZE = 10000 # rows moved per migration transaction
+STAGING_TABLE = 'websocket_data_v2'
+FIXED_POINT_STAGING_TABLE = 'websocket_data_v4'
+
+# from version 4 the sensor columns are stored as integers in tenths, which SQLite stores as 1-2 byte varints instead of 8-byte REALs
+SCALE = 10
+# readers select from this view, which returns the sensor columns in their real units
+READINGS_VIEW = 'websocket_readings'
+
+def encode_sql(value):
+    # SQL expression storing value, a column or a ? parameter, as integer tenths. NULL stays NULL.
+    return f'CAST(round({value} * {SCALE}) AS INTEGER)'
+
+def decode_sql(column):
+    return f'{column} / {SCALE}.0'
+
+# INSERT statement of a (station_id, ts, temperature, humidity, dew_point, heat_index) record, the values are encoded by SQLite
+INSERT_SQL = f'''INSERT INTO websocket_data (station_id, ts, {", ".join(VALUE_COLUMNS)})
+                 VALUES (?, ?, {", ".join(encode_sql('?') for _ in VALUE_COLUMNS)})'''
+INSERT_OR_IGNORE_SQL = INSERT_SQL.replace('INSERT', 'INSERT OR IGNORE', 1)
+# the same record replacing the values of an existing row, e.g. a late real reading replacing an interpolated one
+UPSERT_SQL = f'''{INSERT_SQL}
+                 ON CONFLICT (station_id, ts) DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in VALUE_COLUMNS)}'''
+
+##### Schema versions
+# 0 - id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp, ts INTEGER UNIQUE, plus idx_ts on ts (original layout, no station_id)
+# 1 - version 0 with station_id and UNIQUE (station_id, ts), user_version was not set yet
+# 2 - WITHOUT ROWID table clustered on PRIMARY KEY (station_id, ts), no id, timestamp or secondary index
+# 3 - version 2 plus the rollup_1m, rollup_1h and rollup_1d tables, see rollups.py
+# 4 - version 3 with the sensor columns as INTEGER tenths, plus the websocket_readings view decoding them
+
+# Raised when the database schema is newer than this program supports
+class SchemaVersionError(RuntimeError):
+    pass
+
+def create_table(cursor, table_name='websocket_data', fixed_point=True):
+    # Create a table to store received data, one record per station per ts, stored in primary key order.
+    # fixed_point=False creates the version 2 layout with FLOAT sensor columns.
+    value_type = 'INTEGER' if fixed_point else 'FLOAT'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            station_id TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            temperature {value_type},
+            humidity {value_type},
+            dew_point {value_type},
+            heat_index {value_type},
+            PRIMARY KEY (station_id, ts)
+        ) WITHOUT ROWID'''
+    )
+
+def create_readings_view(cursor):
+    # websocket_data with the sensor columns decoded, range queries on it still use the primary key
+    cursor.execute(f'''
+        CREATE VIEW IF NOT EXISTS {READINGS_VIEW} AS
+        SELECT station_id, ts, {", ".join(f"{decode_sql(column)} AS {column}" for column in VALUE_COLUMNS)} FROM websocket_data'''
+    )
+
+def get_user_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+def table_columns(connection, table_name):
+    return [row[1] for row in connection.execute(f'PRAGMA table_info({table_name})')]
+
+# Function to check the schema version at startup, migrating the database if it is in an older layout. Returns the schema version.
+def check_schema(connection, default_station_id, logger, chunk_size=MIGRATION_CHUNK_SIZE):
+    version = get_user_version(connection)
+
+    if version > SCHEMA_VERSION:
+        raise SchemaVersionError(f'Database schema version {version} is newer than supported version {SCHEMA_VERSION}')
+
+    if version < 2 or table_columns(connection, STAGING_TABLE):
+        migrate_v2(connection, default_station_id, logger, chunk_size)
+
+    if get_user_version(connection) < 3:
+        migrate_v3(connection, logger)
+
+    if get_user_version(connection) < 4 or table_columns(connection, FIXED_POINT_STAGING_TABLE):
+        migrate_v4(connection, logger, chunk_size)
+
+    # tables of a current database that were dropped are recreated empty
+    cursor = connection.cursor()
+    create_table(cursor)
+    create_readings_view(cursor)
+    create_rollup_tables(cursor)
+    connection.commit()
+
+    return get_user_version(connection)
+
+# Function to migrate websocket_data to schema version 2 in place. Safe to interrupt and rerun.
+def migrate_v2(connection, default_station_id, logger, chunk_size=MIGRATION_CHUNK_SIZE):
+    cursor = connection.cursor()
+    old_columns = table_columns(connection, 'websocket_data')
+
+    if not old_columns:
+        # new database, nothing to move
+        connection.execute('BEGIN IMMEDIATE')
+        create_table(cursor, fixed_point=False)
+        connection.execute('PRAGMA user_version = 2')
+        connection.commit()
+        logger.debug('Created websocket_data with schema version 2')
+        return 0
+
+    if 'id' not in old_columns:
+        raise SchemaVersionError(f'websocket_data has an unknown layout: {old_columns}')
+
+    start = time.perf_counter()
+    logger.debug('Migrating websocket_data to schema version 2')
+
+    connection.execute('BEGIN IMMEDIATE')
+    create_table(cursor, STAGING_TABLE, fixed_point=False)
+    connection.commit()
+
+    # version 0 records have no station_id, they are assigned to default_station_id
+    station_column = 'station_id' if 'station_id' in old_columns else '?'
+    station_params = () if 'station_id' in old_columns else (default_station_id,)
+
+    rows_moved = 0
+    while True:
+        # move one chunk of rows per transaction, the rows left in the old table are what remains to be migrated
+        connection.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT id FROM websocket_data ORDER BY id LIMIT 1 OFFSET ?', (chunk_size - 1,))
+        row = cursor.fetchone()
+        bound = row[0] if row else sys.maxsize
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO {STAGING_TABLE} (station_id, ts, temperature, humidity, dew_point, heat_index)
+            SELECT {station_column}, ts, temperature, humidity, dew_point, heat_index FROM websocket_data
+            WHERE id <= ? AND ts IS NOT NULL''', (*station_params, bound))
+        cursor.execute('DELETE FROM websocket_data WHERE id <= ?', (bound,))
+        rows_moved += cursor.rowcount
+        connection.commit()
+        logger.debug(f'Migration chunk - rows moved: {rows_moved}')
+        if row is None:
+            break
+
+    # swap the tables in one transaction, the redundant idx_ts index is dropped with the old table
+    connection.execute('BEGIN IMMEDIATE')
+    cursor.execute('DROP TABLE websocket_data')
+    cursor.execute(f'ALTER TABLE {STAGING_TABLE} RENAME TO websocket_data')
+    connection.execute('PRAGMA user_version = 2')
+    connection.commit()
+
+    logger.debug(f'Migration to schema version 2 done - rows: {rows_moved}, seconds: {time.perf_counter() - start:.1f}')
+    return rows_moved
+
+# Function to add the rollup tables and build them from the records already stored, in one transaction
+def migrate_v3(connection, logger):
+    start = time.perf_counter()
+    cursor = connection.cursor()
+    connection.execute('BEGIN IMMEDIATE')
+    create_rollup_tables(cursor)
+    rows = RollupTables(logger).backfill(cursor)
+    connection.execute('PRAGMA user_version = 3')
+    connection.commit()
+    logger.debug(f'Migration to schema version 3 done - rollup rows backfilled: {rows}, seconds: {time.perf_counter() - start:.1f}')
+
+# Function to migrate websocket_data to schema version 4 in place, storing the sensor columns as integer tenths. Safe to interrupt and rerun.
+def migrate_v4(connection, logger, chunk_size=MIGRATION_CHUNK_SIZE):
+    start = time.perf_counter()
+    cursor = connection.cursor()
+    logger.debug('Migrating websocket_data to schema version 4')
+
+    connection.execute('BEGIN IMMEDIATE')
+    create_table(cursor, FIXED_POINT_STAGING_TABLE)
+    connection.commit()
+
+    encoded = ', '.join(encode_sql(column) for column in VALUE_COLUMNS)
+    rows_moved = 0
+    while True:
+        # move one chunk of rows per transaction in primary key order, the rows left in the old table are what remains to be migrated
+        connection.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT station_id, ts FROM websocket_data ORDER BY station_id, ts LIMIT 1 OFFSET ?', (chunk_size - 1,))
+        row = cursor.fetchone()
+        if row is None:
+            where, params = '1', ()
+        else:
+            where, params = 'station_id < ? OR (station_id = ? AND ts <= ?)', (row[0], row[0], row[1])
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO {FIXED_POINT_STAGING_TABLE} (station_id, ts, {", ".join(VALUE_COLUMNS)})
+            SELECT station_id, ts, {encoded} FROM websocket_data WHERE {where}''', params)
+        cursor.execute(f'DELETE FROM websocket_data WHERE {where}', params)
+        rows_moved += cursor.rowcount
+        connection.commit()
+        logger.debug(f'Migration chunk - rows moved: {rows_moved}')
+        if row is None:
+            break
+
+    # swap the tables and add the decoding view in one transaction
+    connection.execute('BEGIN IMMEDIATE')
+    cursor.execute(f'DROP VIEW IF EXISTS {READINGS_VIEW}')
+    cursor.execute('DROP TABLE websocket_data')
+    cursor.execute(f'ALTER TABLE {FIXED_POINT_STAGING_TABLE} RENAME TO websocket_data')
+    create_readings_view(cursor)
+    connection.execute('PRAGMA user_version = 4')
+    connection.commit()
+
+    logger.debug(f'Migration to schema version 4 done - rows: {rows_moved}, seconds: {time.perf_counter() - start:.1f}')
+    return rows_moved
+
+##### command line migration tool
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check and migrate a SQLite_WSS_Data database to the current schema version.')
+    parser.add_argument('database_path')
+    parser.add_argument('--station-id', required=True, help='station_id assigned to records from a database created before station_id was added')
+    parser.add_argument('--chunk-size', type=int, default=MIGRATION_CHUNK_SIZE)
+    parser.add_argument('--vacuum', action='store_true', help='rebuild the database file after migrating to reclaim free pages')
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.database_path, isolation_level=None)
+    try:
+        print(f'Schema version before: {get_user_version(connection)}')
+        check_schema(connection, args.station_id, PrintLogger(), chunk_size=args.chunk_size)
+        print(f'Schema version after: {get_user_version(connection)}')
+        if args.vacuum:
+            connection.execute('VACUUM')
+            print('Database vacuumed')
+    except (sqlite3.Error, SchemaVersionError) as err:
+        print(f'Migration failed: {err}')
+        sys.exit(1)
+    finally:
+        connection.close()
@@ -0,0 +1,93 @@
+import os, mmap, struct
+
+# one spooled reading: station_id length, station_id (utf-8), ts, temperature, humidity, dew_point, heat_index
+STATION_HEADER = struct.Struct('<H')
+READING_BODY = struct.Struct('<q4d')
+OFFSET = struct.Struct('<Q')
+
+##### ReadingSpool class to implement an append-only, fsync'd file of readings the database couldn't take yet.
+##### Readings are appended in arrival order, read back in the same order through a memory map, and the drained position is kept
+##### in a sidecar .offset file. A reading replayed twice after a crash is ignored by INSERT OR IGNORE, so nothing is counted twice.
+class ReadingSpool:
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.offset_path = f'{path}.offset'
+        self.logger = logger
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.file = open(path, 'ab+')
+        self.offset_file = open(self.offset_path, 'r+b' if os.path.exists(self.offset_path) else 'w+b')
+        data = self.offset_file.read(OFFSET.size)
+        self.read_offset = OFFSET.unpack(data)[0] if len(data) == OFFSET.size else 0
+
+        # count what is left to drain, and cut off a record torn by a crash in the middle of an append
+        self.size = os.path.getsize(path)
+        if self.read_offset > self.size:
+            self.read_offset = 0
+        records, end = self.read(self.read_offset, None)
+        self.depth = len(records)
+        if end < self.size:
+            self.logger.debug(f'Spool {path}: dropping {self.size - end} bytes of a torn record')
+            self.file.truncate(end)
+            self.size = end
+        if self.depth:
+            self.logger.debug(f'Spool {path}: {self.depth} readings left to drain from a previous run')
+
+    @property
+    def pending(self):
+        return self.depth > 0
+
+    def append(self, items):
+        # Append (station_id, reading) items and fsync once for all of them
+        buffer = bytearray()
+        for station_id, reading in items:
+            encoded = station_id.encode('utf-8')
+            buffer += STATION_HEADER.pack(len(encoded))
+            buffer += encoded
+            buffer += READING_BODY.pack(int(reading[0]), *(float('nan') if value is None else float(value) for value in reading[1:]))
+        self.file.write(buffer)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(buffer)
+        self.depth += len(items)
+
+    def read(self, offset=None, max_records=None):
+        # Returns ([(station_id, (ts, temperature, humidity, dew_point, heat_index)), ...], offset after the last whole record)
+        offset = self.read_offset if offset is None else offset
+        if self.size <= offset:
+            return [], offset
+        records = []
+        with mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ) as view:
+            while offset < self.size and (max_records is None or len(records) < max_records):
+                if offset + STATION_HEADER.size > self.size:
+                    break
+                (length,) = STATION_HEADER.unpack_from(view, offset)
+                end = offset + STATION_HEADER.size + length + READING_BODY.size
+                if end > self.size:
+                    break
+                station_id = view[offset + STATION_HEADER.size:offset + STATION_HEADER.size + length].decode('utf-8')
+                records.append((station_id, READING_BODY.unpack_from(view, offset + STATION_HEADER.size + length)))
+                offset = end
+        return records, offset
+
+    def advance(self, offset, count):
+        # Mark the records up to offset as committed to the database
+        self.depth -= count
+        if offset >= self.size:
+            # fully drained, start the file over
+            self.file.truncate(0)
+            self.size = 0
+            self.depth = 0
+            offset = 0
+        self.read_offset = offset
+        self.offset_file.seek(0)
+        self.offset_file.write(OFFSET.pack(offset))
+        self.offset_file.flush()
+        os.fsync(self.offset_file.fileno())
+
+    def close(self):
+        self.file.close()
+        self.offset_file.close()
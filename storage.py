@@ -0,0 +1,30 @@
+import sqlite3, pathlib
+
+# Default SQLite storage profile. WAL lets readers run concurrently with the single ingest writer without blocking it.
+STORAGE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL', # with WAL, NORMAL only syncs at checkpoints and stays crash-safe
+    'cache_size': -16384, # negative value is in KiB, 16 MiB page cache
+    'mmap_size': 64 * 1024 * 1024, # bytes of the database file read through memory mapping
+    'busy_timeout': 5000, # milliseconds to wait on a lock before giving up with SQLITE_BUSY
+}
+
+# Function to apply a storage profile to a connection, returns the values reported back by SQLite
+def apply_storage_profile(connection, profile=STORAGE_PROFILE, read_only=False):
+    applied = {}
+    for pragma, value in profile.items():
+        # the journal mode is a property of the database file, only the writer sets it
+        if read_only and pragma == 'journal_mode':
+            continue
+        connection.execute(f'PRAGMA {pragma} = {value}')
+        applied[pragma] = connection.execute(f'PRAGMA {pragma}').fetchone()[0]
+    if read_only:
+        connection.execute('PRAGMA query_only = 1')
+    return applied
+
+# Function to open a read-only connection for consumers of the database, e.g. dashboards and analytics jobs
+def connect_read_only(database_path, profile=STORAGE_PROFILE, **kwargs):
+    uri = f'{pathlib.Path(database_path).resolve().as_uri()}?mode=ro'
+    connection = sqlite3.connect(uri, uri=True, timeout=profile.get('busy_timeout', 5000) / 1000, **kwargs)
+    apply_storage_profile(connection, profile, read_only=True)
+    return connection
@@ -0,0 +1,23 @@
+import pytest
+from decoder import ReadingDecoder, DecodeError, Reading, msgspec, orjson
+
+BACKENDS = [backend for backend, module in (('json', True), ('orjson', orjson), ('msgspec', msgspec)) if module]
+
+def message(ts='1700000000', temp='21.34'):
+    return f'{{"ts": {ts}, "polledConditions": [{{"temp": {temp}, "hum": 50, "dew_point": 10.06, "heat_index": 21.3}}]}}'
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_decode(backend):
+    assert ReadingDecoder(backend).decode(message()) == Reading(1700000000, 21.3, 50.0, 10.1, 21.3)
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('fields', [{'ts': 'NaN'}, {'ts': '1e400'}, {'temp': 'NaN'}, {'temp': 'Infinity'}, {'temp': '-1e400'}])
+def test_non_finite_values_are_rejected(backend, fields):
+    with pytest.raises(DecodeError):
+        ReadingDecoder(backend).decode(message(**fields))
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('text', ['{"ts": 1}', '{"ts": 1, "polledConditions": []}', '{"ts": "x", "polledConditions": [{}]}', 'polledConditions'])
+def test_malformed_messages_are_rejected(backend, text):
+    with pytest.raises(DecodeError):
+        ReadingDecoder(backend).decode(text)
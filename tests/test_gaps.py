@@ -0,0 +1,22 @@
+import pytest
+from gaps import missed_readings, interpolate_gaps, interpolate_gap
+
+np = pytest.importorskip('numpy')
+
+@pytest.mark.parametrize('gap, missed', [(5, 0), (6, 0), (7, 0), (9, 0), (10, 1), (14, 1), (15, 2), (60, 11)])
+def test_missed_readings(gap, missed):
+    assert missed_readings(gap) == missed
+    assert missed_readings(np.array([gap]))[0] == missed
+
+def test_interpolate_gap():
+    block = interpolate_gap((100, 20.0, 50.0, 10.0, 20.0), (115, 21.0, 53.0, 10.0, 20.3))
+    assert block[:, 0].tolist() == [105, 110]
+    assert block[:, 1].tolist() == [20.3, 20.7]
+    assert block[:, 2].tolist() == [51.0, 52.0]
+
+def test_interpolate_gaps_matches_one_gap_at_a_time():
+    before = np.array([[100, 20.0, 50.0, 10.0, 20.0], [200, 1.0, 2.0, 3.0, 4.0], [300, 0.0, 0.0, 0.0, 0.0]])
+    after = np.array([[130, 23.0, 50.0, 10.0, 20.0], [205, 1.0, 2.0, 3.0, 4.0], [320, 4.0, 4.0, 4.0, 4.0]])
+    expected = np.concatenate([interpolate_gap(b, a) for b, a in zip(before, after)])
+    assert interpolate_gaps(before, after).tolist() == expected.tolist()
+    assert len(expected) == 5 + 0 + 3
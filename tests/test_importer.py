@@ -0,0 +1,39 @@
+import json, sqlite3
+import pytest
+from common import QuietLogger
+
+np = pytest.importorskip('numpy')
+from importer import import_files
+from schema import check_schema, READINGS_VIEW
+
+STATION_ID = 'TEST'
+BASE_TS = 1700000000 - 1700000000 % 3600
+
+def message(ts, temp):
+    return json.dumps({'ts': ts, 'polledConditions': [{'temp': temp, 'hum': 50, 'dew_point': 10, 'heat_index': 20}]})
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(':memory:', isolation_level=None)
+    check_schema(connection, STATION_ID, QuietLogger())
+    yield connection
+    connection.close()
+
+def stored(connection):
+    return connection.execute(f'SELECT ts, temperature FROM {READINGS_VIEW} ORDER BY ts').fetchall()
+
+def test_import_sorts_dedups_and_fills_gaps(connection, tmp_path):
+    path = tmp_path / 'capture.jsonl'
+    # out of order, one duplicate, one bad line and a 15 second gap missing two readings
+    lines = [message(BASE_TS + 5, 20.5), message(BASE_TS, 20.0), message(BASE_TS + 5, 99.0), 'not json', message(BASE_TS + 20, 22.0)]
+    path.write_text('\n'.join(lines) + '\n')
+
+    counts = import_files(connection, [str(path)], STATION_ID, QuietLogger(), workers=1, backend='json')
+    assert counts['lines_skipped'] == 1
+    assert counts['gap_rows'] == 2
+    assert counts['inserted'] == 5
+    assert stored(connection) == [(BASE_TS, 20.0), (BASE_TS + 5, 20.5), (BASE_TS + 10, 21.0), (BASE_TS + 15, 21.5), (BASE_TS + 20, 22.0)]
+    assert connection.execute('SELECT SUM(count), SUM(interpolated) FROM rollup_1d').fetchone() == (5, 2)
+
+    # importing the same file again adds nothing
+    assert import_files(connection, [str(path)], STATION_ID, QuietLogger(), workers=1, backend='json')['inserted'] == 0
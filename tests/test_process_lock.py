@@ -0,0 +1,54 @@
+import os, json
+import pytest
+import process_lock
+from process_lock import ProcessLock, lock_name
+
+class LockLogger:
+    def debug(self, message, *args, category=None):
+        pass
+
+    def close(self, message=None):
+        pass
+
+@pytest.fixture(autouse=True)
+def lock_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_lock.tempfile, 'gettempdir', lambda: str(tmp_path))
+    monkeypatch.setattr(process_lock, 'RETRY_DELAY', 0)
+    return tmp_path
+
+def test_lock_is_exclusive_and_records_its_owner():
+    with ProcessLock('test.lock', LockLogger()) as lock:
+        assert lock.owner()['pid'] == os.getpid()
+        # a second lock on the same file, another open file description, can't be taken
+        assert not ProcessLock('test.lock', LockLogger()).try_acquire()
+
+def test_release_keeps_the_file_and_frees_the_lock():
+    lock = ProcessLock('test.lock', LockLogger())
+    assert lock.try_acquire()
+    lock.release()
+    assert os.path.exists(lock.lockfile_path)
+    assert lock.owner() is None
+    other = ProcessLock('test.lock', LockLogger())
+    assert other.try_acquire()
+    other.release()
+
+def test_stale_lock_file_of_a_dead_process_is_taken_over(lock_dir):
+    # a crashed owner leaves its record behind, but not the kernel lock
+    path = lock_dir / 'test.lock'
+    path.write_text(json.dumps({'pid': 2 ** 22 + 12345, 'started': 0, 'shard': None}))
+    lock = ProcessLock('test.lock', LockLogger())
+    assert lock.try_acquire()
+    assert lock.owner()['pid'] == os.getpid()
+    lock.release()
+
+def test_shards_lock_independently():
+    assert lock_name('test.lock', 'a.db') != lock_name('test.lock', 'b.db')
+    with ProcessLock('test.lock', LockLogger(), shard='a.db'):
+        other = ProcessLock('test.lock', LockLogger(), shard='b.db')
+        assert other.try_acquire()
+        other.release()
+
+def test_held_lock_exits_after_the_retries():
+    with ProcessLock('test.lock', LockLogger()):
+        with pytest.raises(SystemExit):
+            ProcessLock('test.lock', LockLogger()).__enter__()
@@ -0,0 +1,50 @@
+import sqlite3
+import pytest
+from common import QuietLogger
+
+np = pytest.importorskip('numpy')
+import query
+from rollups import RollupTables
+from schema import check_schema, INSERT_SQL
+
+STATION_ID = 'TEST'
+BASE_TS = 1700000000 - 1700000000 % 3600
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(':memory:', isolation_level=None)
+    check_schema(connection, STATION_ID, QuietLogger())
+    ts = np.arange(BASE_TS, BASE_TS + 2 * 3600, 5, dtype=np.int64)
+    values = np.column_stack([(ts - BASE_TS) // 5 % 100 / 10, np.full(len(ts), 50.0), np.full(len(ts), 10.0), np.full(len(ts), 20.0)])
+    cursor = connection.cursor()
+    cursor.execute('BEGIN')
+    cursor.executemany(INSERT_SQL, zip([STATION_ID] * len(ts), ts.tolist(), *values.T.tolist()))
+    RollupTables(QuietLogger()).upsert_block(cursor, STATION_ID, ts, values, np.zeros(len(ts), dtype=bool))
+    cursor.execute('COMMIT')
+    yield connection
+    connection.close()
+
+def test_get_range(connection):
+    arrays = query.get_range(connection, STATION_ID, BASE_TS + 10, BASE_TS + 30)
+    assert arrays['ts'].tolist() == [BASE_TS + 10, BASE_TS + 15, BASE_TS + 20, BASE_TS + 25]
+    assert arrays['temperature'].tolist() == [0.2, 0.3, 0.4, 0.5]
+
+@pytest.mark.parametrize('step', [300, 3600])
+def test_resample_grid_is_aligned_to_step(connection, step):
+    # start and end inside a bucket, the grid still covers whole buckets
+    start, end = BASE_TS + step // 2, BASE_TS + 2 * 3600 - step // 2
+    rollup = query.resample(connection, STATION_ID, start, end, step)
+    assert rollup['ts'][0] == BASE_TS
+    assert rollup['ts'][-1] + step == BASE_TS + 2 * 3600
+    assert (rollup['count'] == step // 5).all()
+
+    # the first bucket averages its whole step, including the records before start
+    records = query.get_range(connection, STATION_ID, BASE_TS, BASE_TS + step)
+    assert rollup['temperature'][0] == pytest.approx(records['temperature'].mean())
+
+def test_resample_from_records(connection):
+    # a step that isn't whole minutes reads websocket_data, with the same whole buckets
+    result = query.resample(connection, STATION_ID, BASE_TS + 3, BASE_TS + 31, 15)
+    assert result['ts'].tolist() == [BASE_TS, BASE_TS + 15, BASE_TS + 30]
+    assert result['count'].tolist() == [3, 3, 3]
+    assert result['temperature'].tolist() == pytest.approx([0.1, 0.4, 0.7])
@@ -0,0 +1,53 @@
+from collections import namedtuple
+from reorder import ReorderBuffer
+
+Reading = namedtuple('Reading', 'ts value')
+
+def released_ts(released):
+    return [reading.ts for reading, _ in released]
+
+def test_no_window_releases_at_once():
+    buffer = ReorderBuffer(window=0)
+    reading = Reading(100, 1)
+    assert buffer.push(reading, now=5.0) == [(reading, 5.0)]
+    assert len(buffer) == 0
+
+def test_readings_are_held_until_a_newer_one_passes_the_window():
+    buffer = ReorderBuffer(window=10)
+    assert buffer.push(Reading(100, 1), now=0.0) == []
+    assert buffer.push(Reading(105, 1), now=0.1) == []
+    # 110 - 10 releases everything up to ts 100
+    assert released_ts(buffer.push(Reading(110, 1), now=0.2)) == [100]
+    assert len(buffer) == 2
+
+def test_out_of_order_reading_is_released_in_ts_order():
+    buffer = ReorderBuffer(window=10)
+    buffer.push(Reading(100, 1), now=0.0)
+    buffer.push(Reading(108, 1), now=0.1)
+    buffer.push(Reading(103, 1), now=0.2)
+    assert buffer.reordered == 1
+    assert released_ts(buffer.push(Reading(120, 1), now=0.3)) == [100, 103, 108]
+
+def test_release_keeps_the_receive_time():
+    buffer = ReorderBuffer(window=10)
+    buffer.push(Reading(100, 1), now=1.5)
+    assert [received_at for _, received_at in buffer.push(Reading(115, 1), now=2.0)] == [1.5]
+
+def test_release_due_after_holding_window_seconds():
+    buffer = ReorderBuffer(window=10)
+    buffer.push(Reading(100, 1), now=0.0)
+    buffer.push(Reading(105, 1), now=5.0)
+    assert buffer.release_due(now=9.9) == []
+    # a stalled station, 100 has been held for the window
+    assert released_ts(buffer.release_due(now=10.0)) == [100]
+    assert released_ts(buffer.release_due(now=15.0)) == [105]
+    assert buffer.release_due(now=100.0) == []
+
+def test_equal_ts_keep_arrival_order_and_flush_empties():
+    buffer = ReorderBuffer(window=10)
+    first, second = Reading(100, 'first'), Reading(100, 'second')
+    buffer.push(first, now=0.0)
+    buffer.push(second, now=0.1)
+    buffer.push(Reading(95, 1), now=0.2)
+    assert [reading for reading, _ in buffer.flush()] == [Reading(95, 1), first, second]
+    assert len(buffer) == 0
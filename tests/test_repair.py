@@ -0,0 +1,37 @@
+import sqlite3
+import pytest
+from common import QuietLogger
+
+np = pytest.importorskip('numpy')
+from repair import repair_gaps, find_gaps
+from schema import check_schema, INSERT_SQL, READINGS_VIEW
+
+STATION_ID = 'TEST'
+BASE_TS = 1700000000 - 1700000000 % 3600
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(':memory:', isolation_level=None)
+    check_schema(connection, STATION_ID, QuietLogger())
+    yield connection
+    connection.close()
+
+def stored(connection):
+    return connection.execute(f'SELECT ts, temperature FROM {READINGS_VIEW} ORDER BY ts').fetchall()
+
+def test_repair_fills_every_gap_and_rebuilds_rollups(connection):
+    rows = [(STATION_ID, ts, 20.0, 50.0, 10.0, 20.0) for ts in (BASE_TS, BASE_TS + 5, BASE_TS + 30, BASE_TS + 35, BASE_TS + 50)]
+    connection.executemany(INSERT_SQL, rows)
+    before, after = find_gaps(connection.cursor(), STATION_ID)
+    assert after[:, 0].tolist() == [BASE_TS + 30, BASE_TS + 50]
+
+    dry_run = repair_gaps(connection, QuietLogger(), dry_run=True)
+    assert dry_run[0]['rows'] == 4 + 2
+    assert len(stored(connection)) == 5
+
+    report = repair_gaps(connection, QuietLogger())[0]
+    assert report['inserted'] == 6
+    assert [ts for ts, _ in stored(connection)] == list(range(BASE_TS, BASE_TS + 55, 5))
+    # the rollups are recomputed from the table, the 5 records inserted before had no rollups at all
+    assert connection.execute('SELECT count, interpolated FROM rollup_1h').fetchall() == [(11, 6)]
+    assert repair_gaps(connection, QuietLogger())[0]['inserted'] == 0
@@ -0,0 +1,77 @@
+import sqlite3
+import pytest
+from common import QuietLogger
+
+pytest.importorskip('websockets')
+pytest.importorskip('numpy')
+import main
+from db_writer import ReadingCache
+from metrics import Metrics
+from rollups import RollupTables
+from ring_buffer import RecentReadings
+from schema import check_schema, READINGS_VIEW
+
+STATION_ID = 'TEST'
+BASE_TS = 1700000000
+
+@pytest.fixture
+def db(monkeypatch):
+    connection = sqlite3.connect(':memory:', isolation_level=None)
+    check_schema(connection, STATION_ID, QuietLogger())
+    monkeypatch.setattr(main, 'logger', QuietLogger(), raising=False)
+    monkeypatch.setattr(main, 'metrics', Metrics())
+    monkeypatch.setattr(main, 'rollup_tables', RollupTables(QuietLogger()))
+    monkeypatch.setattr(main, 'recent_readings', RecentReadings(hours=1))
+    cursor = connection.cursor()
+    cache = ReadingCache()
+    cache.seed(None, 0)
+    # a gap between two real readings filled with two interpolated records
+    main.insert_db_record(STATION_ID, (BASE_TS, 20.0, 50.0, 10.0, 20.0), cursor, cache)
+    main.insert_bulk_records(STATION_ID, [(BASE_TS + 5, 20.5, 50.0, 10.0, 20.0), (BASE_TS + 10, 21.0, 50.0, 10.0, 20.0)], cursor, cache)
+    main.insert_db_record(STATION_ID, (BASE_TS + 15, 21.5, 50.0, 10.0, 20.0), cursor, cache)
+    main.rollup_tables.flush(cursor)
+    yield connection, cursor, cache
+    connection.close()
+
+def stored(cursor, ts):
+    return cursor.execute(f'SELECT temperature FROM {READINGS_VIEW} WHERE station_id = ? AND ts = ?', (STATION_ID, ts)).fetchone()
+
+def counter(name):
+    return main.metrics.counters.get((name, (('station', STATION_ID),)), 0)
+
+def test_late_reading_replaces_interpolated_record(db):
+    connection, cursor, cache = db
+    main.insert_db_record(STATION_ID, (BASE_TS + 5, 25.0, 50.0, 10.0, 20.0), cursor, cache)
+    main.rollup_tables.flush(cursor)
+
+    assert stored(cursor, BASE_TS + 5) == (25.0,)
+    assert cache.count == 4
+    assert counter('interpolated_replaced_total') == 1
+    assert counter('duplicates_ignored_total') == 0
+    # count is unchanged, the record is no longer interpolated and the sum takes the difference
+    assert cursor.execute('SELECT count, interpolated, temperature_sum FROM rollup_1d').fetchone() == (4, 1, pytest.approx(87.5))
+    assert main.recent_readings.get_range(STATION_ID, BASE_TS + 5, BASE_TS + 6)['temperature'].tolist() == [25.0]
+
+    # a second reading with the same ts is a duplicate, not another replacement
+    main.insert_db_record(STATION_ID, (BASE_TS + 5, 26.0, 50.0, 10.0, 20.0), cursor, cache)
+    assert stored(cursor, BASE_TS + 5) == (25.0,)
+    assert counter('interpolated_replaced_total') == 1
+    assert counter('duplicates_ignored_total') == 1
+
+def test_reading_for_a_deleted_interpolated_record_is_inserted(db):
+    connection, cursor, cache = db
+    cursor.execute('DELETE FROM websocket_data WHERE station_id = ? AND ts = ?', (STATION_ID, BASE_TS + 10))
+    main.replace_interpolated_record(STATION_ID, (BASE_TS + 10, 24.0, 50.0, 10.0, 20.0), cursor, cache)
+
+    assert stored(cursor, BASE_TS + 10) == (24.0,)
+    assert counter('interpolated_replaced_total') == 0
+
+def test_midnight_record_can_be_replaced(db, monkeypatch):
+    connection, cursor, cache = db
+    midnight = BASE_TS + 20
+    monkeypatch.setattr(main, 'midnight_time', lambda: (midnight, None, None))
+    main.insert_midnight_record(STATION_ID, (BASE_TS + 15, 21.5, 50.0, 10.0, 20.0), cursor, cache)
+    main.insert_db_record(STATION_ID, (midnight, 22.0, 50.0, 10.0, 20.0), cursor, cache)
+
+    assert stored(cursor, midnight) == (22.0,)
+    assert counter('interpolated_replaced_total') == 1
@@ -0,0 +1,105 @@
+import os, asyncio, sqlite3
+import datetime as dt
+import pytest
+from common import QuietLogger
+
+np = pytest.importorskip('numpy')
+from archive import DailyArchive, load_archived_day, archive_path
+from db_writer import DatabaseWriter
+from metrics import Metrics
+from retention import RetentionEngine
+from schema import check_schema, INSERT_SQL
+
+STATION_ID = 'TEST'
+INTERVAL = 60 # seconds between the test records, a day is 1440 records
+
+def midnight(days_ago):
+    today = dt.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return int((today - dt.timedelta(days=days_ago)).timestamp())
+
+@pytest.fixture
+def connection(tmp_path):
+    connection = sqlite3.connect(tmp_path / 'test.db', isolation_level=None, check_same_thread=False)
+    check_schema(connection, STATION_ID, QuietLogger())
+    # three expired days and a few records of today
+    rows = [(STATION_ID, ts, 20.1, 50.0, None if ts % 7 == 0 else 10.2, -3.5) for ts in range(midnight(3), midnight(0) + 600, INTERVAL)]
+    connection.execute('BEGIN')
+    connection.executemany(INSERT_SQL, rows)
+    connection.execute('COMMIT')
+    yield connection
+    connection.close()
+
+def run_pass(connection, archive, metrics=None, chunk_size=500):
+    async def run():
+        writer = DatabaseWriter(connection, None, QuietLogger(), batch_interval_ms=10)
+        writer.start()
+        retention = RetentionEngine(writer, [STATION_ID], QuietLogger(), retention_days=1, chunk_size=chunk_size, archive=archive, metrics=metrics)
+        retention.schedule()
+        await asyncio.sleep(0.05)
+        for _ in range(500):
+            if not retention.running.is_set():
+                break
+            await asyncio.sleep(0.02)
+        await writer.stop()
+        return retention
+    retention = asyncio.run(run())
+    archive.close()
+    return retention
+
+def count(connection, start=0, end=2 ** 62):
+    return connection.execute('SELECT COUNT(*) FROM websocket_data WHERE ts >= ? AND ts < ?', (start, end)).fetchone()[0]
+
+def test_expired_days_are_archived_then_deleted(connection, tmp_path):
+    retention = run_pass(connection, DailyArchive(str(tmp_path / 'archive'), QuietLogger()))
+
+    assert not retention.running.is_set()
+    assert count(connection, end=midnight(0)) == 0
+    assert count(connection, start=midnight(0)) == 10
+    for days_ago in (3, 2, 1):
+        day = dt.date.fromtimestamp(midnight(days_ago))
+        archived = load_archived_day(str(tmp_path / 'archive'), STATION_ID, day)
+        assert archived['ts'].tolist() == list(range(midnight(days_ago), midnight(days_ago - 1), INTERVAL))
+        assert archived['temperature'][0] == pytest.approx(20.1)
+        # NULL values come back as NaN
+        assert np.isnan(archived['dew_point'][archived['ts'] % 7 == 0]).all()
+    with np.load(archive_path(str(tmp_path / 'archive'), STATION_ID, day)) as data:
+        assert data['temperature'].dtype == np.int16
+
+def test_records_are_kept_when_the_archive_cannot_be_written(connection, tmp_path):
+    # a file where the archive directory should be, creating it fails
+    blocked = tmp_path / 'archive'
+    blocked.write_text('not a directory')
+    metrics = Metrics()
+    retention = run_pass(connection, DailyArchive(str(blocked), QuietLogger()), metrics)
+
+    assert not retention.running.is_set()
+    assert count(connection) == 3 * 1440 + 10
+    assert metrics.counters[('archive_errors_total', (('station', STATION_ID),))] == 1
+
+def test_corrupt_archive_file_keeps_its_day(connection, tmp_path):
+    archive_dir = str(tmp_path / 'archive')
+    day = dt.date.fromtimestamp(midnight(3))
+    path = archive_path(archive_dir, STATION_ID, day)
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as file:
+        file.write(b'not a zip file')
+
+    run_pass(connection, DailyArchive(archive_dir, QuietLogger()))
+
+    # the oldest day couldn't be merged, so the station's expired records wait for the next pass
+    assert count(connection, end=midnight(0)) == 3 * 1440
+    with open(path, 'rb') as file:
+        assert file.read() == b'not a zip file'
+
+def test_archived_day_merges_with_an_earlier_pass(connection, tmp_path):
+    archive_dir = str(tmp_path / 'archive')
+    run_pass(connection, DailyArchive(archive_dir, QuietLogger()))
+    # a late record for an archived day is archived by the next pass, next to the ones already in the file
+    day = midnight(2)
+    connection.execute(INSERT_SQL, (STATION_ID, day + 30, 1.0, 2.0, 3.0, 4.0))
+    run_pass(connection, DailyArchive(archive_dir, QuietLogger()))
+
+    archived = load_archived_day(archive_dir, STATION_ID, dt.date.fromtimestamp(day))
+    assert len(archived['ts']) == 1441
+    assert archived['temperature'][archived['ts'] == day + 30].tolist() == [1.0]
+    assert count(connection, end=midnight(0)) == 0
@@ -0,0 +1,71 @@
+import pytest
+from ring_buffer import ReadingRing, RecentReadings
+
+np = pytest.importorskip('numpy')
+
+def reading(ts):
+    return (ts, ts / 10, 50.0, 10.0, 20.0)
+
+def held_ts(ring):
+    return ring.get_latest(ring.capacity)['ts'].tolist()
+
+def test_append_in_order_drops_oldest_when_full():
+    ring = ReadingRing(3)
+    for ts in (10, 15, 20, 25):
+        assert ring.append(reading(ts))
+    assert held_ts(ring) == [15, 20, 25]
+    assert ring.last() == reading(25)
+
+def test_append_inserts_late_reading_in_ts_order():
+    ring = ReadingRing(5)
+    ring.extend(reading(ts) for ts in (10, 15, 25, 30))
+    assert ring.append(reading(20))
+    assert held_ts(ring) == [10, 15, 20, 25, 30]
+    assert ring.get_range(15, 26)['temperature'].tolist() == [1.5, 2.0, 2.5]
+    # the columns stay mirrored, the same readings come back after more appends wrap the ring
+    ring.append(reading(35))
+    assert held_ts(ring) == [15, 20, 25, 30, 35]
+
+def test_append_refuses_duplicate_and_too_old_readings():
+    ring = ReadingRing(3)
+    ring.extend(reading(ts) for ts in (10, 15, 20))
+    assert not ring.append(reading(15))
+    # older than everything a full ring holds
+    assert not ring.append(reading(5))
+    assert held_ts(ring) == [10, 15, 20]
+
+def test_late_reading_into_full_ring_drops_oldest():
+    ring = ReadingRing(3)
+    ring.extend(reading(ts) for ts in (10, 20, 30))
+    assert ring.append(reading(25))
+    assert held_ts(ring) == [20, 25, 30]
+
+def test_covers_only_after_seeding():
+    ring = ReadingRing(4)
+    ring.extend(reading(ts) for ts in (10, 15))
+    # live readings alone don't say what the database held before them
+    assert not ring.covers(10)
+
+    seeded = ReadingRing(4)
+    seeded.seed([reading(10), reading(15)])
+    # fewer readings than capacity were stored, so the ring holds every one of them
+    assert seeded.covers(0)
+
+def test_covers_moves_forward_as_readings_are_dropped():
+    ring = ReadingRing(3)
+    ring.seed([reading(ts) for ts in (10, 15, 20)])
+    assert ring.covers(10)
+    assert not ring.covers(9)
+    ring.append(reading(25))
+    assert ring.covers(15)
+    assert not ring.covers(10)
+    # a reading too old for the full ring is refused, the range before the oldest held reading stays uncovered
+    assert not ring.append(reading(12))
+    assert not ring.covers(12)
+
+def test_recent_readings_replace():
+    recent = RecentReadings(hours=1)
+    recent.seed('S', [reading(10), reading(15)])
+    assert recent.replace('S', (15, 9.9, 1.0, 2.0, 3.0))
+    assert not recent.replace('S', reading(20))
+    assert recent.get_latest('S', 1)['temperature'].tolist() == [9.9]
@@ -0,0 +1,77 @@
+import sqlite3
+import pytest
+from common import QuietLogger
+from schema import check_schema, get_user_version, table_columns, SCHEMA_VERSION, STAGING_TABLE, FIXED_POINT_STAGING_TABLE, READINGS_VIEW
+
+STATION_ID = '001D0A71267A'
+BASE_TS = 1700000000
+
+def create_v0(connection, rows):
+    # the original layout, no station_id and a separate index on ts
+    connection.execute('''
+        CREATE TABLE websocket_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ts INTEGER UNIQUE,
+            temperature FLOAT,
+            humidity FLOAT,
+            dew_point FLOAT,
+            heat_index FLOAT
+        )''')
+    connection.execute('CREATE INDEX idx_ts ON websocket_data (ts)')
+    connection.executemany('INSERT INTO websocket_data (ts, temperature, humidity, dew_point, heat_index) VALUES (?, ?, ?, ?, ?)', rows)
+
+def readings(count):
+    return [(BASE_TS + i * 5, 20.0 + i * 0.1, 50.0 + i % 7, 10.5, 21.3) for i in range(count)]
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(':memory:', isolation_level=None)
+    yield connection
+    connection.close()
+
+@pytest.mark.parametrize('chunk_size', [7, 10000])
+def test_migrate_v0_to_v4(connection, chunk_size):
+    rows = readings(50)
+    # a record without ts is dropped by the migration
+    create_v0(connection, rows + [(None, 1.0, 1.0, 1.0, 1.0)])
+
+    assert check_schema(connection, STATION_ID, QuietLogger(), chunk_size=chunk_size) == SCHEMA_VERSION
+    assert get_user_version(connection) == 4
+    assert not table_columns(connection, STAGING_TABLE)
+    assert not table_columns(connection, FIXED_POINT_STAGING_TABLE)
+    assert connection.execute('SELECT COUNT(*) FROM websocket_data').fetchone()[0] == len(rows)
+    assert connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'idx_ts'").fetchone()[0] == 0
+
+    # stored as integer tenths, read back in real units through the view
+    assert connection.execute('SELECT temperature, typeof(temperature) FROM websocket_data ORDER BY ts LIMIT 1').fetchone() == (200, 'integer')
+    migrated = connection.execute(f'SELECT station_id, ts, temperature, humidity, dew_point, heat_index FROM {READINGS_VIEW} ORDER BY ts').fetchall()
+    assert [row[0] for row in migrated] == [STATION_ID] * len(rows)
+    assert [row[1:] for row in migrated] == [(ts, round(t, 1), h, d, i) for ts, t, h, d, i in rows]
+
+    # the rollups were backfilled by the version 3 step
+    assert connection.execute('SELECT SUM(count) FROM rollup_1m').fetchone()[0] == len(rows)
+
+def test_interrupted_v4_migration_resumes(connection):
+    create_v0(connection, readings(30))
+    check_schema(connection, STATION_ID, QuietLogger())
+    # put the database back to version 3 with part of the rows already moved to the staging table, as a crash would leave it
+    connection.execute(f'ALTER TABLE websocket_data RENAME TO {FIXED_POINT_STAGING_TABLE}')
+    connection.execute(f'DROP VIEW {READINGS_VIEW}')
+    connection.execute('CREATE TABLE websocket_data (station_id TEXT NOT NULL, ts INTEGER NOT NULL, temperature FLOAT, humidity FLOAT, '
+                       'dew_point FLOAT, heat_index FLOAT, PRIMARY KEY (station_id, ts)) WITHOUT ROWID')
+    connection.execute(f'''INSERT INTO websocket_data SELECT station_id, ts, temperature / 10.0, humidity / 10.0, dew_point / 10.0, heat_index / 10.0
+                           FROM {FIXED_POINT_STAGING_TABLE} WHERE ts >= ?''', (BASE_TS + 10 * 5,))
+    connection.execute(f'DELETE FROM {FIXED_POINT_STAGING_TABLE} WHERE ts >= ?', (BASE_TS + 10 * 5,))
+    connection.execute('PRAGMA user_version = 3')
+
+    assert check_schema(connection, STATION_ID, QuietLogger(), chunk_size=4) == 4
+    assert not table_columns(connection, FIXED_POINT_STAGING_TABLE)
+    assert connection.execute(f'SELECT COUNT(*), MIN(ts), MAX(ts) FROM {READINGS_VIEW}').fetchone() == (30, BASE_TS, BASE_TS + 29 * 5)
+    assert connection.execute(f'SELECT temperature FROM {READINGS_VIEW} WHERE ts = ?', (BASE_TS + 25 * 5,)).fetchone()[0] == 22.5
+
+def test_newer_schema_is_refused(connection):
+    from schema import SchemaVersionError
+    connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION + 1}')
+    with pytest.raises(SchemaVersionError):
+        check_schema(connection, STATION_ID, QuietLogger())
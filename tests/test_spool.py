@@ -0,0 +1,113 @@
+import math, sqlite3
+import pytest
+from common import QuietLogger
+from spool import ReadingSpool
+from db_writer import DatabaseWriter
+
+def reading(ts):
+    return (ts, 20.5, 50.0, None, 21.0)
+
+@pytest.fixture
+def spool_path(tmp_path):
+    return str(tmp_path / 'spool' / 'readings.spool')
+
+def test_append_and_read_back_in_order(spool_path):
+    spool = ReadingSpool(spool_path, QuietLogger())
+    spool.append([('A', reading(1)), ('BB', reading(2))])
+    spool.append([('A', reading(3))])
+    records, _ = spool.read()
+    assert [(station_id, ts) for station_id, (ts, *_) in records] == [('A', 1), ('BB', 2), ('A', 3)]
+    # NULL values are spooled as NaN
+    assert math.isnan(records[0][1][3])
+    assert spool.depth == 3
+    spool.close()
+
+def test_offset_sidecar_survives_a_restart(spool_path):
+    spool = ReadingSpool(spool_path, QuietLogger())
+    spool.append([('A', reading(ts)) for ts in range(5)])
+    records, offset = spool.read(max_records=2)
+    spool.advance(offset, len(records))
+    spool.close()
+
+    spool = ReadingSpool(spool_path, QuietLogger())
+    assert spool.depth == 3
+    assert [record[1][0] for record in spool.read()[0]] == [2, 3, 4]
+    spool.close()
+
+def test_torn_record_is_cut_off_on_open(spool_path):
+    spool = ReadingSpool(spool_path, QuietLogger())
+    spool.append([('A', reading(1)), ('A', reading(2))])
+    spool.close()
+    # a crash in the middle of an append leaves part of a record behind
+    with open(spool_path, 'ab') as file:
+        file.write(b'\x01\x00A\x05')
+    size = len(open(spool_path, 'rb').read())
+
+    spool = ReadingSpool(spool_path, QuietLogger())
+    assert spool.depth == 2
+    assert spool.size == size - 4
+    spool.append([('A', reading(3))])
+    assert [record[1][0] for record in spool.read()[0]] == [1, 2, 3]
+    spool.close()
+
+def test_fully_drained_spool_starts_over(spool_path):
+    spool = ReadingSpool(spool_path, QuietLogger())
+    spool.append([('A', reading(1))])
+    records, offset = spool.read()
+    spool.advance(offset, len(records))
+    assert not spool.pending
+    assert spool.size == 0
+    spool.close()
+    assert ReadingSpool(spool_path, QuietLogger()).depth == 0
+
+##### DatabaseWriter with a spool, batches that can't take the write lock are spooled and drained in order
+@pytest.fixture
+def locked_writer(tmp_path, spool_path):
+    database_path = tmp_path / 'test.db'
+    connection = sqlite3.connect(database_path, isolation_level=None, check_same_thread=False)
+    connection.execute('CREATE TABLE readings (n INTEGER PRIMARY KEY, station_id TEXT, ts INTEGER)')
+
+    def handler(station_id, col_data, cursor, cache):
+        cursor.execute('INSERT INTO readings (station_id, ts) VALUES (?, ?)', (station_id, int(col_data[0])))
+
+    spool = ReadingSpool(spool_path, QuietLogger())
+    writer = DatabaseWriter(connection, handler, QuietLogger(), spool=spool, lock_timeout_ms=10)
+    # a second connection holding the write lock, e.g. another writer or a long maintenance transaction
+    blocker = sqlite3.connect(database_path, isolation_level=None)
+    blocker.execute('BEGIN IMMEDIATE')
+    yield writer, connection, blocker, spool
+    blocker.close()
+    spool.close()
+    connection.close()
+
+def stored(connection):
+    return [ts for _, ts in connection.execute('SELECT station_id, ts FROM readings ORDER BY n')]
+
+def test_locked_batches_are_spooled_and_drained_in_order(locked_writer):
+    writer, connection, blocker, spool = locked_writer
+    jobs = []
+    writer.write_batch([('A', reading(1), 0.0), ('A', reading(2), 0.0), (None, lambda cursor, caches: jobs.append('job'), 0.0)])
+    writer.write_batch([('A', reading(3), 0.0)])
+    assert stored(connection) == []
+    assert spool.depth == 3
+    # the job of a spooled batch is deferred, not lost
+    assert jobs == []
+
+    blocker.execute('COMMIT')
+    writer.write_batch([('A', reading(4), 0.0)])
+    # the spooled readings are committed first, the deferred job runs with the first batch committed after the drain
+    assert stored(connection) == [1, 2, 3, 4]
+    assert jobs == ['job']
+    assert not spool.pending
+
+def test_spooled_readings_are_drained_after_a_restart(locked_writer, spool_path):
+    writer, connection, blocker, spool = locked_writer
+    writer.write_batch([('A', reading(1), 0.0), ('A', reading(2), 0.0)])
+    blocker.execute('COMMIT')
+    spool.close()
+
+    writer.spool = ReadingSpool(spool_path, QuietLogger())
+    writer.drain_spool()
+    assert stored(connection) == [1, 2]
+    assert not writer.spool.pending
+    writer.spool.close()